@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""Load generator: simulated publishers and subscribers against a server
+
+Publishers report their state at 1 Hz, answer latency pings and sometimes
+suggest a seek to their room. Subscribers chat, pause and seek. Each
+publisher has a unique media length and plays at 1s/s, so that every
+report (position/length) can be recognized in the publisher patches that
+the subscribers receive. Chat messages and seeks carry unique ids too.
+
+The report has, per kind of event: end to end latency percentiles (from
+the emit of the sender to the reception, all clients run in this process
+and share its clock), deliveries expected and missed, and when the server
+was started by this script (--spawn), its CPU time and peak memory, plus
+the mean handler times from its /metrics.
+
+Results depend on this machine and on this process keeping up with the
+server: check that its own CPU usage (reported too) isn't close to 100%.
+
+Run from the repository root, e.g.:
+./benchmarks/load.py --spawn -P 50 -S 200 -r 10 -d 60 -o report.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+import urllib.request
+
+import socketio
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+DRAIN_S = 3  # clients stop sending, but stay connected this long
+
+
+class Tracker:
+    """Deliveries of one kind of event: expected, received and latency"""
+
+    def __init__(self, measure_from):
+        self.measure_from = measure_from  # once every client is connected
+        self.pending = {}  # key -> (sent_ts, expected deliveries)
+        self.expected = 0
+        self.received = 0
+        self.latencies = []
+
+    def sent(self, key, expected):
+        if expected and time.time() >= self.measure_from:
+            self.pending[key] = (time.time(), expected)
+            self.expected += expected
+
+    def received_one(self, key):
+        try:
+            sent_ts, _ = self.pending[key]
+        except KeyError:
+            return  # not ours (e.g. an unrelated patch), or too late
+        self.received += 1
+        self.latencies.append(time.time() - sent_ts)
+
+    def report(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            index = min(len(latencies) - 1, int(p / 100 * len(latencies)))
+            return round(latencies[index] * 1000, 2)
+
+        return {
+            'sent': len(self.pending),
+            'expected': self.expected,
+            'received': self.received,
+            'missed': self.expected - self.received,
+            'latency_ms': {f'p{p}': percentile(p) for p in (50, 90, 99)}
+            | {'max': percentile(100)},
+        }
+
+
+class Load:
+    def __init__(self, url, rng, measure_from):
+        self.url = url
+        self.rng = rng
+        self.patches = Tracker(measure_from)
+        self.commands = Tracker(measure_from)  # seeks, to the publishers
+        self.chat = Tracker(measure_from)
+        self.suggestions = 0
+        self.connect_failures = 0
+        self.nick_failures = 0  # subscribers which didn't get a nick
+        self.room_subscribers = {}  # room -> connected subscriber count
+        self.room_publishers = {}
+        self._ids = itertools.count()
+
+    def next_id(self):
+        return next(self._ids)
+
+    async def connect(self, client, room, namespace):
+        try:
+            await client.connect(f"{self.url}?room={room}",
+                                 namespaces=[namespace],
+                                 transports=['websocket'])
+        except socketio.exceptions.ConnectionError:
+            self.connect_failures += 1
+            return False
+        return True
+
+
+async def publisher(load, room, index, stop_at, suggest_every):
+    client = socketio.AsyncClient()
+    length = 100000 + index  # identifies this publisher in the patches
+    position = load.rng.randrange(0, 1000)
+
+    @client.on('latency_ping', namespace='/publish')
+    async def on_ping(msg):
+        received_ts = time.time()
+        await client.emit('latency_pong', {
+            'token': msg['token'], 't1': received_ts, 't2': time.time(),
+        }, namespace='/publish')
+
+    @client.on('seek', namespace='/publish')
+    def on_seek(msg):
+        if msg.get('explicit'):
+            load.commands.received_one(msg['seek'])
+
+    if not await load.connect(client, room, '/publish'):
+        return
+    load.room_publishers[room] = load.room_publishers.get(room, 0) + 1
+    await client.emit('set ua', {'user_agent': 'load'}, namespace='/publish')
+    await asyncio.sleep(load.rng.random())  # spread the reports
+
+    while time.time() < stop_at:
+        position += 1
+        suggest = suggest_every and load.rng.random() < 1 / suggest_every
+        load.patches.sent((room, length, position),
+                          load.room_subscribers.get(room, 0))
+        await client.emit('update state', {
+            'title': f'load {room}', 'status': 'Playing',
+            'position': position, 'length': length, 'show': bool(suggest),
+            'suggest_sync': 'seek' if suggest else None,
+        }, namespace='/publish')
+        load.suggestions += bool(suggest)
+        await asyncio.sleep(1)
+
+    await asyncio.sleep(stop_at + DRAIN_S - time.time())
+    load.room_publishers[room] -= 1
+    await client.disconnect()
+
+
+async def subscriber(load, room, stop_at, chat_every, command_every):
+    client = socketio.AsyncClient()
+    latest = {}  # publisher length -> latest report position received
+
+    @client.on('patch publishers', namespace='/subscribe')
+    def on_patch(msg):
+        for patch in msg['patches']:
+            try:
+                position, length = patch['data']['position'].split('/')
+                # the server extrapolates from the last report (sent every
+                # second, a second further each time), so it's the whole
+                # part. Later patches (e.g. latency updates) count once
+                position, length = math.floor(float(position)), int(length)
+            except (KeyError, ValueError):
+                continue
+            if position > latest.get(length, -1):
+                latest[length] = position
+                load.patches.received_one((room, length, position))
+
+    joined = asyncio.Event()
+
+    @client.on('nick change', namespace='/subscribe')
+    def on_nick_change(msg):
+        joined.set()
+
+    @client.on('log_message', namespace='/subscribe')
+    def on_log_message(msg):
+        if 'nick' in msg:
+            load.chat.received_one(msg['data'])
+
+    if not await load.connect(client, room, '/subscribe'):
+        return
+    try:
+        # the server runs out of nicks/colors for large rooms
+        await asyncio.wait_for(joined.wait(), timeout=5)
+    except asyncio.TimeoutError:
+        load.nick_failures += 1
+        await client.disconnect()
+        return
+    load.room_subscribers[room] = load.room_subscribers.get(room, 0) + 1
+
+    while time.time() < stop_at:
+        await asyncio.sleep(1)
+        if chat_every and load.rng.random() < 1 / chat_every:
+            message = f"chat {load.next_id()}"
+            load.chat.sent(message, load.room_subscribers[room] - 1)
+            await client.emit('broadcast message', {'data': message},
+                              namespace='/subscribe')
+        if command_every and load.rng.random() < 1 / command_every:
+            if load.rng.random() < 0.5:
+                await client.emit('pause', {}, namespace='/subscribe')
+            else:
+                destination = 1000000 + load.next_id()
+                load.commands.sent(destination,
+                                   load.room_publishers.get(room, 0))
+                await client.emit('seek', {'seek': destination},
+                                  namespace='/subscribe')
+
+    await asyncio.sleep(stop_at + DRAIN_S - time.time())
+    load.room_subscribers[room] -= 1
+    await client.disconnect()
+
+
+def process_usage(pid):
+    """CPU seconds (user + system) and peak resident memory (MB)"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    with open(f"/proc/{pid}/status") as f:
+        peak_kb = int(re.search(r"VmHWM:\s+(\d+)", f.read()).group(1))
+    return cpu, peak_kb / 1024
+
+
+def handler_times(url):
+    """Mean handler execution time (ms) and count, from /metrics"""
+    with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+        text = response.read().decode()
+    stats = {}
+    for kind, handler, value in re.findall(
+            r'datenight_handler_seconds_(sum|count)\{handler="(\w+)"\} (\S+)',
+            text):
+        stats.setdefault(handler, {})[kind] = float(value)
+    return {handler: {'count': int(s['count']),
+                      'mean_ms': round(s['sum'] / s['count'] * 1000, 3)}
+            for handler, s in stats.items() if s.get('count')}
+
+
+async def run(args, url):
+    start = time.time()
+    load = Load(url, random.Random(args.seed), start + args.ramp_up)
+    ramp = args.ramp_up / max(1, args.publishers + args.subscribers)
+    stop_at = start + args.ramp_up + args.duration
+    rooms = [f"load-{i}" for i in range(args.rooms)]
+
+    tasks = []
+    for i in range(args.subscribers):
+        tasks.append(asyncio.create_task(subscriber(
+            load, rooms[i % len(rooms)], stop_at, args.chat_every,
+            args.command_every)))
+        await asyncio.sleep(ramp)
+    for i in range(args.publishers):
+        tasks.append(asyncio.create_task(publisher(
+            load, rooms[i % len(rooms)], i, stop_at, args.suggest_every)))
+        await asyncio.sleep(ramp)
+    await asyncio.gather(*tasks)
+    return load
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description=__doc__.split("\n")[0])
+    parser.add_argument('-s', '--server', default="http://127.0.0.1:5000",
+                        help="server to load (see --spawn)")
+    parser.add_argument('--spawn', action='store_true',
+                        help="start ./run_server.py on the --server port, "
+                             "to report its CPU and memory usage")
+    parser.add_argument('--server-args', default="",
+                        help="extra ./run_server.py arguments with --spawn")
+    parser.add_argument('-P', '--publishers', type=int, default=10)
+    parser.add_argument('-S', '--subscribers', type=int, default=40)
+    parser.add_argument('-r', '--rooms', type=int, default=2)
+    parser.add_argument('-d', '--duration', type=float, default=30,
+                        help="seconds, once every client is connected")
+    parser.add_argument('--ramp-up', type=float, default=5,
+                        help="seconds over which the clients connect")
+    parser.add_argument('--suggest-every', type=float, default=60,
+                        help="seconds between seek suggestions of a "
+                             "publisher, on average (0: never)")
+    parser.add_argument('--chat-every', type=float, default=30,
+                        help="seconds between chat messages of a "
+                             "subscriber, on average (0: never)")
+    parser.add_argument('--command-every', type=float, default=120,
+                        help="seconds between pause/seek commands of a "
+                             "subscriber, on average (0: never)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help="also write the report "
+                                               "(json) to this file")
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn:
+        port = args.server.rsplit(":", 1)[1]
+        server = subprocess.Popen(
+            [sys.executable, "run_server.py", "-p", port,
+             *args.server_args.split()], cwd=ROOT, stdout=sys.stderr)
+        time.sleep(2)
+        server_usage = process_usage(server.pid)
+
+    client_cpu = time.process_time()
+    try:
+        load = asyncio.run(run(args, args.server))
+        report = {
+            'config': {k: v for k, v in vars(args).items() if k != 'output'},
+            'connect_failures': load.connect_failures,
+            'nick_failures': load.nick_failures,
+            'sync_suggestions': load.suggestions,
+            'publisher_patches': load.patches.report(),
+            'commands': load.commands.report(),
+            'chat': load.chat.report(),
+            'load_generator_cpu_s': round(time.process_time() - client_cpu,
+                                          2),
+        }
+        if server:
+            cpu, peak_mb = process_usage(server.pid)
+            report['server'] = {
+                'cpu_s': round(cpu - server_usage[0], 2),
+                'peak_rss_mb': round(peak_mb, 1),
+            }
+        try:
+            report['handlers'] = handler_times(args.server)
+        except OSError as e:
+            print(f"Couldn't read the server's metrics: {e}")
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Bytes per 'update state' event and encode/decode cost, json vs msgpack
+
+Sizes are those of the socket.io packets (a msgpack report is a binary
+event: a short text packet with a placeholder, plus the attachment), not
+counting the websocket framing (2 to 14 bytes per frame).
+
+Run from the repository root: ./benchmarks/wire_format.py
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+from socketio import packet
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from client import wire as client_wire  # noqa: E402
+from server import wire as server_wire  # noqa: E402
+
+REPORTS = {
+    "playing": {
+        "title": "Big.Buck.Bunny.2008.1080p.mkv", "status": "Playing",
+        "position": 1234, "length": 5678, "show": False,
+        "suggest_sync": None,
+    },
+    "seek": {
+        "title": "Big.Buck.Bunny.2008.1080p.mkv", "status": "Paused",
+        "position": 42, "length": 5678, "show": True, "suggest_sync": "seek",
+    },
+    "nothing playing": {
+        "title": "", "status": "Stopped", "position": None, "length": None,
+        "show": False, "suggest_sync": None,
+    },
+}
+
+
+def encoded_packet(data):
+    """Encoded socket.io packet(s) of an 'update state' event"""
+    pkt = packet.Packet(packet.EVENT, namespace='/publish',
+                        data=['update state', data])
+    encoded = pkt.encode()
+    return encoded if isinstance(encoded, list) else [encoded]
+
+
+def packet_size(data):
+    return sum(len(p.encode() if isinstance(p, str) else p)
+               for p in encoded_packet(data))
+
+
+def json_round_trip(report):
+    json.loads(json.dumps(report))
+
+
+def msgpack_round_trip(report):
+    server_wire.decode_state(client_wire.encode_state(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help="encode/decode round trips per measure")
+    args = parser.parse_args()
+
+    if client_wire.msgpack is None:
+        print("msgpack isn't installed")
+        return 1
+
+    print(f"{'report':<16} {'json B':>7} {'msgpack B':>10} {'saved':>6}"
+          f" {'json us':>8} {'msgpack us':>11}")
+    for name, report in REPORTS.items():
+        assert server_wire.decode_state(
+            client_wire.encode_state(report)) == report
+
+        json_size = packet_size(report)
+        msgpack_size = packet_size(client_wire.encode_state(report))
+        json_us, msgpack_us = (
+            min(timeit.repeat(lambda: f(report), number=args.number,
+                              repeat=3)) / args.number * 1e6
+            for f in (json_round_trip, msgpack_round_trip))
+        print(f"{name:<16} {json_size:>7} {msgpack_size:>10}"
+              f" {1 - msgpack_size / json_size:>6.0%}"
+              f" {json_us:>8.2f} {msgpack_us:>11.2f}")
+    print("(us: one encode + decode of the report, without the socket.io "
+          "packet)")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
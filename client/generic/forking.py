@@ -20,9 +20,23 @@ class ForkingClient:
     Subclasses should overload the user agent (self.ua)
     and self._define_commands()
 
+    The player's state comes from a long-lived follow command, which prints
+    a metadata line whenever it changes (play/pause, seek, new file). The
+    position in between is extrapolated (see PublishNamespace.update_state)
+    and checked by a poll every FALLBACK_POLL_PERIOD_S seconds, or every
+    POLL_PERIOD_S seconds while there is no follow command running. Polls
+    only report what they find: they never suggest a sync to the others.
+
+    Metadata lines are: status, position, length and url, separated by
+    tabs, with the position and length in microseconds (as in MPRIS).
+
     """
     POLL_PERIOD_S = 0.9
+    FALLBACK_POLL_PERIOD_S = 5
+    FOLLOW_RETRY_S = 10  # after the follow command exited
     POLL_SEEK_TOLERANCE_S = 2.2
+    COMMAND_TIMEOUT_S = 2
+    MAX_PENDING_COMMANDS = 4
     ua = f"{sys.platform}_forking_{'.'.join(map(str, version))}"
 
     def __init__(self, sock, offset=0):
@@ -32,46 +46,60 @@ class ForkingClient:
         self._state: PlayerState = PlayerState.PAUSED
         self._title = ""
         self._position = 0
+        self._position_ts = time.monotonic()
         self._length = 0
         self.offset = offset
+        self._follower = None  # the follow process, while it runs
+        self._commands = asyncio.Queue(self.MAX_PENDING_COMMANDS)
 
         log.info(f"Initialized {self.__class__.__name__} player")
+        asyncio.create_task(self._follow())
+        asyncio.create_task(self._run_commands())
         asyncio.create_task(self._periodic_report_metadata())
 
     def _define_commands(self):
         """Subclasses should implement the following variables
-        self._pause_cmd, self._resume_cmd, self._seek_cmd
-        self._position_cmd, self._status_cmd, self._title_cmd, self._length_cmd
+        self._pause_cmd, self._resume_cmd, self._seek_cmd: strings
+        self._metadata_cmd: argument list of a command printing a metadata
+        line
+        self._follow_cmd: argument list of a command printing a metadata
+        line on every change (None to poll instead)
 
         """
         raise NotImplementedError("Please use a subclass")
 
-    # actions requested
+    # actions requested, executed one at a time by _run_commands(). The
+    # state is updated right away, not to take the player executing them
+    # for a change to suggest to the others
     def pause(self):
         log.info("Received request to pause")
-        asyncio.create_task(self._fork_and_report(
-            self._pause_cmd,
-            self._fetch_state,
-            self._report_state,
-        ))
+        self._state = PlayerState.PAUSED
+        self._queue_command(self._pause_cmd)
 
     def resume(self):
         log.info("Received request to resume")
-        asyncio.create_task(self._fork_and_report(
-            self._resume_cmd,
-            self._fetch_state,
-            self._report_state,
-        ))
+        self._state = PlayerState.PLAYING
+        self._queue_command(self._resume_cmd)
 
     def seek(self, seek_dst):
         adjusted_seek = seek_dst + self.offset
         log.info(f"Received request to seek to {adjusted_seek}")
         self._position = adjusted_seek
-        asyncio.create_task(self._fork_and_report(
-            self._seek_cmd.format(seek=adjusted_seek),
-            self._fetch_position,
-            self._report_state,
-        ))
+        self._position_ts = time.monotonic()
+        self._queue_command(self._seek_cmd.format(seek=adjusted_seek))
+
+    def _queue_command(self, cmd):
+        if self._commands.full():  # the player is stuck, newer ones matter
+            dropped = self._commands.get_nowait()
+            log.warning(f"Too many pending commands, dropping '{dropped}'")
+        self._commands.put_nowait(cmd)
+
+    async def _run_commands(self):
+        while True:
+            cmd = await self._commands.get()
+            await self._fork_process(*cmd.split())
+            # what the player actually did
+            await self._poll_and_report_metadata()
 
     # periodic poll/report
     async def _report_state(
@@ -84,12 +112,13 @@ class ForkingClient:
         match this player's state (for example if played/paused/sought)
 
         """
-        log.debug(f"Reporting state with {suggest_sync=}")
+        log.debug("Reporting state with suggest_sync=%s", suggest_sync,
+                  extra={'event': 'report'})
         if self._length:
             adjusted_position = self._position - self.offset
         else:
             adjusted_position = self._position
-        await self._sock.emit("update state", {
+        await self._sock.update_state({
             "title": self._title,
             "status": self._state.value,
             "position": adjusted_position,
@@ -98,76 +127,127 @@ class ForkingClient:
             "suggest_sync": suggest_sync.value if suggest_sync else None,
         })
 
-    async def _fork_and_report(self, fork_cmd, *callbacks):
-        await self._fork_process(fork_cmd)
-        for cb in callbacks:
-            await cb()
-
-    async def _fork_process(self, cmd):
-        """Note that there is no timeout on the subprocesses"""
+    async def _fork_process(self, *args):
+        """Output of the command, None if it failed or timed out"""
         try:
             proc = await asyncio.create_subprocess_exec(
-                *cmd.split(), stdout=asyncio.subprocess.PIPE,
+                *args, stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.STDOUT)
         except FileNotFoundError:
             log.critical(
-                f"Couldn't launch the command '{cmd}'. Is it installed?")
-            return ""
-        stdout_data, stderr_data = await proc.communicate()
-        await proc.wait()
+                f"Couldn't launch the command '{args[0]}'. Is it installed?")
+            return None
+        try:
+            stdout_data, _ = await asyncio.wait_for(
+                proc.communicate(), self.COMMAND_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            log.warning(f"'{' '.join(args)}' timed out, killing it")
+            proc.kill()
+            await proc.wait()
+            return None
         if proc.returncode:
-            return ""
+            return None
         else:
             return stdout_data.strip().decode("utf-8")
 
-    async def _fetch_state(self) -> bool:
-        status_str = await self._fork_process(self._status_cmd)
-        state = PlayerState(status_str)
-        changed = state != self._state
-        self._state = state
-        return changed
-
-    async def _fetch_position(self, _=None):
+    async def _follow(self):
+        """Report the metadata lines of the follow command, restarting it
+        FOLLOW_RETRY_S seconds after it exits"""
+        if not self._follow_cmd:
+            return
+        while True:
+            try:
+                self._follower = await asyncio.create_subprocess_exec(
+                    *self._follow_cmd, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL)
+            except FileNotFoundError:
+                log.critical(f"Couldn't launch the command "
+                             f"'{self._follow_cmd[0]}'. Is it installed?")
+                return
+            log.info("Following the player's changes")
+            async for line in self._follower.stdout:
+                await self._update(line.decode("utf-8").rstrip("\n"))
+            returncode = await self._follower.wait()
+            self._follower = None
+            log.warning(f"The follow command exited ({returncode}), polling "
+                        f"every {self.POLL_PERIOD_S}s")
+            await asyncio.sleep(self.FOLLOW_RETRY_S)
+
+    @staticmethod
+    def _parse(line):
+        """(state, position, length, title) of a metadata line, None if
+        there is no player"""
+        status, position, length, url = (line.split("\t") + [""] * 3)[:4]
         try:
-            position = round(
-                float(await self._fork_process(self._position_cmd)), 1)
+            state = PlayerState(status)
         except ValueError:
-            position = 0
-        return position
+            return None
 
-    async def _poll_and_report_metadata(self):
-        state_changed = await self._fetch_state()
-        fname = await self._fork_process(self._title_cmd)
-        title = urllib.request.unquote(os.path.basename(fname))
-        position = await self._fetch_position()
-        try:
-            length = int(await self._fork_process(self._length_cmd)) // 1000000
-        except ValueError:
-            length = 0
+        def seconds(microseconds):
+            try:
+                return int(microseconds) / 1_000_000
+            except ValueError:
+                return 0
+
+        title = urllib.request.unquote(os.path.basename(url))
+        return state, round(seconds(position), 1), int(seconds(length)), title
 
-        if state_changed:
-            suggest_sync = SyncSuggestion.STATE
+    def _expected_position(self):
+        if self._state != PlayerState.PLAYING:
+            return self._position
+        return self._position + time.monotonic() - self._position_ts
+
+    async def _update(self, line, suggest=True):
+        """Report a metadata line, suggesting the changes the user made to
+        the others, unless told otherwise
+
+        A player which stopped or is gone (e.g. closed) is reported as
+        such, but never suggested: the others keep watching.
+        """
+        parsed = self._parse(line)
+        if parsed is None:
+            state, position, length, title = PlayerState.STOPPED, 0, 0, ""
+        else:
+            state, position, length, title = parsed
+
+        if state != self._state:
+            suggest_sync = (None if state == PlayerState.STOPPED
+                            else SyncSuggestion.STATE)
             show = True
         elif title != self._title or length != self._length:
             suggest_sync = None
             show = True
-            self._length = length
-            self._title = title
         else:
             suggest_sync = (
-                None if math.isclose(position, self._position,
+                None if math.isclose(position, self._expected_position(),
                                      abs_tol=self.POLL_SEEK_TOLERANCE_S)
                 else SyncSuggestion.SEEK)
             show = True if suggest_sync else False
-            self._position = position
+        self._state = state
+        self._title = title
+        self._length = length
+        self._position = position
+        self._position_ts = time.monotonic()
 
+        if not suggest:
+            show, suggest_sync = False, None
         await self._report_state(show=show, suggest_sync=suggest_sync)
 
+    async def _poll_and_report_metadata(self):
+        line = await self._fork_process(*self._metadata_cmd)
+        if line is None:  # we don't know any better than before
+            log.debug("Couldn't poll the player", extra={'event': 'player'})
+            return
+        await self._update(line, suggest=False)
+
     async def _periodic_report_metadata(self):
         elapsed = 0
         while True:
-            await asyncio.sleep(self.POLL_PERIOD_S - elapsed)
+            period = (self.FALLBACK_POLL_PERIOD_S if self._follower
+                      else self.POLL_PERIOD_S)
+            await asyncio.sleep(max(0, period - elapsed))
             t1 = time.perf_counter()
             await self._poll_and_report_metadata()
             elapsed = time.perf_counter() - t1
-            log.debug("rescheduling poll for next iteration...")
+            log.debug("rescheduling poll for next iteration...",
+                      extra={'event': 'player'})
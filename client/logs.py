@@ -0,0 +1,9 @@
+"""Logging setup of the client, see common/logs.py
+
+Records are capped per event logged with (extra={'event': ...}).
+
+"""
+from common.logs import rate_option, setup  # noqa: F401
+
+# records per second, for the events happening on every player poll
+DEFAULT_RATES = {'player': 2, 'report': 1}
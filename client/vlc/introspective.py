@@ -204,8 +204,9 @@ class IntrospectiveVLCClient(GenericPlayer):
             adjusted_position = self._position - self.offset
         else:
             adjusted_position = self._position
-        log.debug(f"Reporting state with {suggest_sync=}")
-        await self._sock.emit("update state", {
+        log.debug("Reporting state with suggest_sync=%s", suggest_sync,
+                  extra={'event': 'report'})
+        await self._sock.update_state({
             "title": self._title,
             "status": self._state.value,
             "position": adjusted_position,
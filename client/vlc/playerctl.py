@@ -15,7 +15,9 @@ class ForkingPlayerctlClient(ForkingClient):
         self._resume_cmd = "playerctl -p vlc play"
         self._seek_cmd = "playerctl -p vlc position {seek}"
 
-        self._position_cmd = "playerctl -p vlc position"
-        self._status_cmd = "playerctl -p vlc status"
-        self._title_cmd = "playerctl -p vlc metadata xesam:url"
-        self._length_cmd = "playerctl -p vlc metadata mpris:length"
+        # see ForkingClient
+        metadata = ["playerctl", "-p", "vlc", "metadata", "--format",
+                    "{{status}}\t{{position}}\t{{mpris:length}}"
+                    "\t{{xesam:url}}"]
+        self._metadata_cmd = metadata
+        self._follow_cmd = metadata[:1] + ["--follow"] + metadata[1:]
@@ -1,4 +1,6 @@
+import collections
 import logging
+import re
 import sys
 import os
 import urllib.request
@@ -12,6 +14,15 @@ from client.generic import PlayerState, SyncSuggestion, GenericPlayer
 log = logging.getLogger(__name__)
 
 
+class QueryDropped(Exception):
+    """A vlc query was dropped before it got its answer"""
+
+
+def _seconds(answer):
+    """A get_time/get_length answer, None if nothing is playing"""
+    return int(answer) if answer else None
+
+
 class UnixSocketClient(GenericPlayer):
     """Currently specific to vlc, but can be generalized similar to
     ForkingClient """
@@ -19,17 +30,48 @@ class UnixSocketClient(GenericPlayer):
     ua = f"{sys.platform}_unixsocket_{'.'.join(map(str, version))}"
 
     class UnixProtocol(asyncio.Protocol):
+        """VLC's RC interface: a stream of lines, which are answers to our
+        queries (in the order they were sent), results of our commands
+        ("seek: returned 0 (no error)") or status changes
+        ("status change: ( time: 12s )"), which VLC sends on its own
+
+        Lines are reassembled from the received chunks, however VLC's
+        output is split or merged. If an answer doesn't make sense for its
+        query, or doesn't come in time, the pending queries are dropped, and
+        new queries wait for their answers to come (and be discarded), for
+        QUERY_TIMEOUT seconds at most: answers are never given to the wrong
+        query, and those which never come don't shift the next ones.
+        """
+        QUERY_TIMEOUT = 2  # seconds
+        # lines announcing a state change, without their "status change: "
+        _STATE_CHANGES = {
+            "( pause state: 3 ): Pause": PlayerState.PAUSED,
+            "( play state: 2 ): Play": PlayerState.PLAYING,
+            "( play state: 3 )": PlayerState.PLAYING,
+            # think I saw this once as a play state, but can't reproduce:
+            # "( pause state: 4 )"
+            "( play state: 4 ): End": PlayerState.STOPPED,
+            "( stop state: 0 )": PlayerState.STOPPED,
+            "( pause state: 4 ): End": PlayerState.STOPPED,
+        }
+        _STATUS_CHANGE = re.compile(r"status change: (\( ([^:]+): (.*))$")
+        _COMMAND_RESULT = re.compile(r"(\w+): returned (-?\d+)(.*)$")
+
         def __init__(self, client: 'UnixSocketClient', *args, **kwargs):
             self._client = client
-
-            self._pause_strings = ["status change: ( pause state: 3 ): Pause"]
-            self._play_strings = ["status change: ( play state: 2 ): Play",
-                                  "status change: ( play state: 3 )"]
-            # think I saw this once as a play_string, but can't reproduce:
-            # "status change: ( pause state: 4 )"
-            self._stop_strings = ["status change: ( play state: 4 ): End",
-                                  "status change: ( stop state: 0 )",
-                                  "status change: ( pause state: 4 ): End"]
+            self._buffer = b""  # an incomplete line
+            self._queries = collections.deque()  # (parse, future), in order
+            self._orphans = 0  # answers still due to dropped queries
+            self._no_orphans = asyncio.Event()  # see _settle()
+            self._no_orphans.set()
+            # status change -> handler(its line, from the parenthesis on)
+            self._status_changes = {
+                "new input": self._on_new_input,
+                "play state": self._on_state_change,
+                "pause state": self._on_state_change,
+                "stop state": self._on_state_change,
+                "time": self._on_time_change,
+            }
 
             self._state: PlayerState = PlayerState.PAUSED
             self._title = ""
@@ -43,111 +85,173 @@ class UnixSocketClient(GenericPlayer):
             log.debug("Connection to unixsocket established")
 
         def send_data(self, data):
-            log.debug(f"Writing to the unix socket: {data.encode()}")
+            log.debug("Writing to the unix socket: %r", data,
+                      extra={'event': 'player'})
             self._transport.write(data.encode())
 
-        @staticmethod
-        def _droppable_strings(x):
-            if x.startswith('status change:'):
-                # used when state is updated
-                return True
-            elif x.startswith('seek: returned '):
-                # used when seeking and immediately updating/probing
-                return True
-            elif x.startswith('pause: returned'):
-                # used when seeking from a paused state
-                return True
-            else:
-                return False
+        async def query(self, command, parse=str):
+            """The parsed answer to a query (e.g. "get_time")
+
+            Raises asyncio.TimeoutError if VLC doesn't answer in time,
+            QueryDropped if the query was dropped in the meantime
+            """
+            await self._settle()
+            future = asyncio.get_event_loop().create_future()
+            self._queries.append((parse, future))
+            self.send_data(f"{command}\n")
+            try:
+                return await asyncio.wait_for(future, self.QUERY_TIMEOUT)
+            except asyncio.TimeoutError:
+                self._drop_queries(f"no answer to {command}")
+                raise
+
+        async def _settle(self):
+            """Until the answers to the dropped queries came, or
+            QUERY_TIMEOUT seconds, after which they are not expected
+            anymore"""
+            if self._no_orphans.is_set():
+                return
+            try:
+                await asyncio.wait_for(self._no_orphans.wait(),
+                                       self.QUERY_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.debug("%d answers to dropped queries never came",
+                          self._orphans, extra={'event': 'player'})
+                self._forget_orphans()
+
+        def _forget_orphans(self):
+            self._orphans = 0
+            self._no_orphans.set()
+
+        def _drop_queries(self, reason):
+            if not self._queries:
+                return
+            log.warning(f"Dropping {len(self._queries)} pending vlc "
+                        f"queries: {reason}")
+            self._orphans += len(self._queries)
+            self._no_orphans.clear()
+            while self._queries:
+                _, future = self._queries.popleft()
+                if not future.done():
+                    future.set_exception(QueryDropped(reason))
 
         def data_received(self, data):
-            decoded = data.decode('utf-8').strip()
-            log.debug(f'Data received on the unix socket: {decoded}')
-
-            lines = decoded.split('\r\n')
-            one_shots = [line for line in lines
-                         if line.startswith('status change:')]
-            lines = [line for line in lines if
-                     not self._droppable_strings(line)]  # filter
-            for x in one_shots:
-                if x.startswith("status change: ( new input:"):
-                    # VLC possible bug: doesn't emit new input or "play" to the
-                    # socket unless the socket is written to by something else
-                    # first? - strange.
-                    skip = len("status change: ( new input:")
-                    fname = os.path.basename(x[skip:])
-                    self._title = urllib.request.unquote(fname)
-                    asyncio.create_task(self.emit_to_sock(show=True))
-                elif x in self._pause_strings:
-                    suggest_sync = (None if self._client._just_reacted_task
-                                    else SyncSuggestion.STATE)
-                    log.info(f"Reporting pause state with {suggest_sync}")
-                    self._state = PlayerState.PAUSED
-                    asyncio.create_task(self.emit_to_sock(
-                        show=True if suggest_sync else False,
-                        suggest_sync=suggest_sync,
-                    ))
-                elif x in self._play_strings:
-                    suggest_sync = (None if self._client._just_reacted_task
-                                    else SyncSuggestion.STATE)
-                    log.info(f"Reporting playing state with {suggest_sync=}")
-                    self._state = PlayerState.PLAYING
-                    asyncio.create_task(self.emit_to_sock(
-                        show=True if suggest_sync else False,
-                        suggest_sync=suggest_sync,
-                    ))
-                elif x in self._stop_strings:
-                    self._state = PlayerState.STOPPED
-                    self._position = 0
-                    self._length = 0
-                    self._title = ""
-                    log.info("Reporting stopped state")
-                    asyncio.create_task(self.emit_to_sock(show=True))
-                elif x.startswith("status change: ( time: "):
-                    try:
-                        skip = len("status change: ( time: ")
-                        reported_position = int(x[skip:-3])
-                    except ValueError:
-                        pass
-                    else:
-                        suggest_sync = (None if self._client._just_reacted_task
-                                        else SyncSuggestion.SEEK)
-                        self._position = reported_position
-                        asyncio.create_task(self.emit_to_sock(
-                            show=True if suggest_sync else False,
-                            suggest_sync=suggest_sync,
-                        ))
-                else:  # other line starting with "status change" - unsupported
-                    # e.g. volume changed
-                    pass
-
-            log.debug(f"received {len(lines)} lines")
-            if len(lines) == 3:
-                position, title, length = lines
-                try:
-                    position = int(position)
-                    length = int(length)
-                except ValueError:
-                    return
-                else:
-                    if length != self._length or title != self._title:
-                        self._length = length
-                        self._title = title
-                        asyncio.create_task(self.emit_to_sock(show=True))
-                    elif position != self._position:
-                        self._position = position
-                        asyncio.create_task(self.emit_to_sock(show=False))
+            *lines, self._buffer = (self._buffer + data).split(b"\n")
+            for line in lines:
+                self._line_received(line.decode("utf-8", "replace").strip())
+
+        def _line_received(self, line):
+            log.debug('Line received on the unix socket: %s', line,
+                      extra={'event': 'player'})
+            status_change = self._STATUS_CHANGE.match(line)
+            if status_change:
+                body, event, _ = status_change.groups()
+                handler = self._status_changes.get(event)
+                if handler:  # else unsupported, e.g. volume changed
+                    handler(body)
+                return
+            result = self._COMMAND_RESULT.match(line)
+            if result:
+                command, code, message = result.groups()
+                if code != "0":
+                    log.warning(f"vlc: {command} failed{message}")
+                return
+            if self._orphans:
+                self._orphans -= 1
+                if not self._orphans:
+                    self._no_orphans.set()
+                log.debug('Discarding the answer to a dropped query: %s',
+                          line, extra={'event': 'player'})
+                return
+            if not self._queries:
+                if line:
+                    log.debug('Ignoring an unexpected line: %s', line,
+                              extra={'event': 'player'})
+                return
+            parse, future = self._queries.popleft()
+            try:
+                answer = parse(line)
+            except ValueError:
+                reason = f"unexpected answer {line!r}"
+                if not future.done():
+                    future.set_exception(QueryDropped(reason))
+                self._drop_queries(reason)
+            else:
+                if not future.done():
+                    future.set_result(answer)
+
+        # status changes
+        def _on_new_input(self, body):
+            # VLC possible bug: doesn't emit new input or "play" to the
+            # socket unless the socket is written to by something else
+            # first? - strange.
+            url = body[len("( new input: "):-len(" )")]
+            self._title = urllib.request.unquote(os.path.basename(url))
+            asyncio.create_task(self.emit_to_sock(show=True))
+
+        def _on_state_change(self, body):
+            state = self._STATE_CHANGES.get(body)
+            if state == PlayerState.STOPPED:
+                self._state = PlayerState.STOPPED
+                self._position = 0
+                self._length = 0
+                self._title = ""
+                log.info("Reporting stopped state")
+                asyncio.create_task(self.emit_to_sock(show=True))
+            elif state is not None:
+                suggest_sync = (None if self._client._just_reacted_task
+                                else SyncSuggestion.STATE)
+                log.info(f"Reporting {state.value.lower()} state with "
+                         f"{suggest_sync=}")
+                self._state = state
+                asyncio.create_task(self.emit_to_sock(
+                    show=True if suggest_sync else False,
+                    suggest_sync=suggest_sync,
+                ))
+
+        def _on_time_change(self, body):
+            try:
+                reported_position = int(body[len("( time: "):-len("s )")])
+            except ValueError:
+                return
+            suggest_sync = (None if self._client._just_reacted_task
+                            else SyncSuggestion.SEEK)
+            self._position = reported_position
+            asyncio.create_task(self.emit_to_sock(
+                show=True if suggest_sync else False,
+                suggest_sync=suggest_sync,
+            ))
+
+        async def probe(self):
+            """Query the position, title and length, and report them"""
+            try:
+                position, title, length = await asyncio.gather(
+                    self.query("get_time", _seconds),
+                    self.query("get_title"),
+                    self.query("get_length", _seconds))
+            except (asyncio.TimeoutError, QueryDropped):
+                return
+            if position is None or length is None:
+                return  # nothing playing
+            if length != self._length or title != self._title:
+                self._length = length
+                self._title = title
+                await self.emit_to_sock(show=True)
+            elif position != self._position:
+                self._position = position
+                await self.emit_to_sock(show=False)
 
         async def emit_to_sock(
                 self, *, show, suggest_sync: Optional[SyncSuggestion] = None):
             # could reset the periodic probe here, but it's not really required
             # introspective client behavior is to reset it atm
-            log.debug(f"Reporting state with {suggest_sync=}")
+            log.debug("Reporting state with suggest_sync=%s", suggest_sync,
+                      extra={'event': 'report'})
             if self._length:
                 adjusted_position = self._position - self._client.offset
             else:
                 adjusted_position = self._position
-            await self._client.websock.emit("update state", {
+            await self._client.websock.update_state({
                 "title": self._title,
                 "status": self._state.value,
                 "position": adjusted_position,
@@ -159,6 +263,8 @@ class UnixSocketClient(GenericPlayer):
         def connection_lost(self, e):
             log.debug(
                 'The unix socket is now closed, cancelling periodic probe')
+            self._drop_queries("the unix socket is closed")
+            self._forget_orphans()  # they won't come
             if self._client.prober:
                 self._client.prober.cancel()
             # Somehow those are not the same thing
@@ -175,6 +281,7 @@ class UnixSocketClient(GenericPlayer):
         self.websock = websock
         self.offset = offset
         self.prober = None
+        self._probe_task = None
 
         asyncio.ensure_future(self.open_unixsock())
 
@@ -236,10 +343,9 @@ class UnixSocketClient(GenericPlayer):
 
     def _periodic_probe(self):
         self.prober.cancel()
-        log.debug("Probing...")
-        self.protocol.send_data("get_time\n")
-        self.protocol.send_data("get_title\n")
-        self.protocol.send_data("get_length\n")
+        if self._probe_task is None or self._probe_task.done():
+            log.debug("Probing...", extra={'event': 'player'})
+            self._probe_task = asyncio.ensure_future(self.protocol.probe())
 
         loop = asyncio.get_event_loop()
         self.prober = loop.call_later(self.REPORT_PERIOD,
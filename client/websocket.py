@@ -1,16 +1,83 @@
+import asyncio
 import logging
+import time
 
 from socketio import AsyncClientNamespace
 
+from client import wire
+from client.generic import PlayerState
+
 log = logging.getLogger(__name__)
 
 
 class PublishNamespace(AsyncClientNamespace):
+    # don't trust a bad clock offset estimate into a long wait
+    MAX_COMMAND_DELAY_S = 10
+    # with partial reports, see update_state()
+    KEEPALIVE_S = 10
+    POSITION_TOLERANCE_S = 1.5  # players report whole seconds
+    CHANGING_FIELDS = ("title", "status", "length", "rate")
+    LEAVE_TIMEOUT_S = 1  # for the server to close our connection
+
+    def __init__(self, *args, wire_format=wire.JSON, **kwargs):
+        """:param wire_format: preferred format of the state reports, used
+        if the server supports it (json otherwise)"""
+        super().__init__(*args, **kwargs)
+        # our clock - server clock, as estimated by the server
+        self.clock_offset = 0.0
+        self._scheduled_commands = {}  # kind ("state"/"seek") -> handle
+        self._preferred_format = wire_format
+        self.wire_format = wire.JSON  # until the server agrees to another
+        self.partial_reports = False  # until the server agrees
+        self._reported = {}  # CHANGING_FIELDS, as of our last report
+        self._anchor = None  # (position, time, rate, status) of that report
+        self.datenight_client = None  # see initialize_namespace()
+        self._alias = None
+        self._resume_token = None  # see on_session()
+        self._sessions = 0
+        self._disconnected = asyncio.Event()
+
+    def auth(self):
+        """Connect payload (on every reconnection): resume our session, if
+        we have one (the server only holds the sessions of the clients
+        sending a 'resume' key)"""
+        return {'resume': self._resume_token}
+
+    async def on_session(self, msg):
+        """Our session with the server, new or resumed after a reconnection
+
+        A resumed session has our nick, user agent and wire format already.
+        """
+        self._resume_token = msg['token']
+        self._sessions += 1
+        if msg.get('resumed'):
+            log.info(f"Resumed our session as {msg.get('nick')}")
+            # reports may have been lost with the connection (or the
+            # server restarted): the next one is complete
+            self._reported = {}
+            self._anchor = None
+        elif self._sessions > 1 and self.datenight_client is not None:
+            log.info("Couldn't resume our session, starting a new one")
+            await self._introduce()
+
     def on_connect(self):
-        pass
+        self._disconnected.clear()
 
     def on_disconnect(self):
-        pass
+        self._disconnected.set()
+
+    async def disconnect(self):
+        """Leave for good: the server is asked to close our connection,
+        as closing it ourselves looks like a drop, for which our session
+        would be held (see server.sessions)"""
+        if self.client.connected:
+            await self.emit('disconnect request')
+            try:
+                await asyncio.wait_for(self._disconnected.wait(),
+                                       self.LEAVE_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                pass
+        await super().disconnect()
 
     async def update_alias(self, new_alias):
         # would have been done in on_connect() if it were possible to send
@@ -20,23 +87,134 @@ class PublishNamespace(AsyncClientNamespace):
 
     async def initialize_namespace(self, client, alias=None):
         self.datenight_client = client
+        self._alias = alias
+        await self._introduce()
+
+    async def _introduce(self):
+        """Tell the server who we are, at the start of a session"""
+        client = self.datenight_client
+        self.wire_format = wire.JSON  # until the server agrees to another
+        self.partial_reports = False
+        self._reported, self._anchor = {}, None  # the server knows nothing
         log.info(f"Requesting ua update to {client.ua}...")
-        await self.emit('set ua', {"user_agent": client.ua})
-        if alias:
-            await self.update_alias(alias)
+        # older servers acknowledge without picking a format, nor accepting
+        # partial reports
+        reply = await self.call('set ua', {
+            "user_agent": client.ua,
+            "wire_formats": [self._preferred_format, wire.JSON],
+        })
+        if reply and reply.get('wire_format') == self._preferred_format:
+            self.wire_format = self._preferred_format
+        self.partial_reports = bool(reply and reply.get('partial'))
+        log.info(f"Reporting state as {self.wire_format}"
+                 f"{', partially' if self.partial_reports else ''}")
+        if self._alias:
+            await self.update_alias(self._alias)
         # self._initialized = True
 
+    async def update_state(self, state):
+        """Report our player's state, in the negotiated wire format
+
+        If the server accepts partial reports, they only have the fields
+        which changed since the previous one, plus the position as of
+        their (server) time 'at' and the playback rate, which the server
+        extrapolates from. While playback goes on as that predicts, with
+        nothing else changing, only a keepalive is sent every KEEPALIVE_S
+        seconds.
+        """
+        now = time.time()
+        if self.partial_reports:
+            report = self._partial_report(state, now)
+            if report is None:
+                return
+        else:
+            report = state
+        if self.wire_format == wire.MSGPACK:
+            await self.emit('update state', wire.encode_state(report))
+        else:
+            await self.emit('update state', report)
+        if self.partial_reports:
+            self._reported.update(
+                (field, report[field]) for field in self.CHANGING_FIELDS
+                if field in report)
+            self._anchor = (report['position'], now, self._reported['rate'],
+                            self._reported.get('status'))
+
+    def _partial_report(self, state, now):
+        """What to send of the state, None if nothing"""
+        state = {"rate": 1.0, **state}
+        report = {field: state[field] for field in self.CHANGING_FIELDS
+                  if field in state
+                  and (field not in self._reported
+                       or self._reported[field] != state[field])}
+        for field in ("show", "suggest_sync"):
+            if state.get(field):
+                report[field] = state[field]
+        position = state.get("position")
+        if (not report and self._anchor is not None
+                and now - self._anchor[1] < self.KEEPALIVE_S
+                and not self._off_anchor(position, now)):
+            return None
+        report["position"] = position
+        report["at"] = round(now - self.clock_offset, 3)  # server time
+        return report
+
+    def _off_anchor(self, position, now):
+        """Whether the position isn't where our last report predicted"""
+        anchored, at, rate, status = self._anchor
+        if not isinstance(position, (int, float)) or not isinstance(
+                anchored, (int, float)):
+            return position != anchored
+        expected = anchored
+        if status == PlayerState.PLAYING.value:
+            expected += (now - at) * rate
+        return abs(position - expected) > self.POSITION_TOLERANCE_S
+
     async def on_latency_ping(self, msg):
+        received_ts = time.time()
         log.debug("Received latency_ping...")
-        await self.emit('latency_pong', msg)
+        if msg.get('offset') is not None:
+            self.clock_offset = msg['offset']
+        # the server estimates our clock offset/round trip from these
+        await self.emit('latency_pong', {
+            'token': msg['token'],
+            't1': received_ts,
+            't2': time.time(),
+        })
+
+    def _execute_at(self, payload, kind, action, *args):
+        """Run the action at the server time requested in the payload ('at'),
+        converted to our clock, or right away if there is none
+
+        A newer command replaces a pending command of the same kind
+        """
+        pending = self._scheduled_commands.pop(kind, None)
+        if pending:
+            pending.cancel()
+
+        try:
+            at = float(payload['at'])
+        except (KeyError, TypeError, ValueError):
+            action(*args)
+            return
+
+        delay = min(at + self.clock_offset - time.time(),
+                    self.MAX_COMMAND_DELAY_S)
+        if delay <= 0:
+            action(*args)
+        else:
+            log.debug(f"Executing {action.__name__} in {delay:.3f}s")
+            loop = asyncio.get_event_loop()
+            self._scheduled_commands[kind] = loop.call_later(
+                delay, action, *args)
 
     def on_pause(self, payload):
         log.info(f"Received pause request: {payload}")
-        self.datenight_client.pause()
+        self._execute_at(payload, "state", self.datenight_client.pause)
 
     def on_resume(self, payload):
         log.info(f"Received resume request: {payload}")
-        self.datenight_client.resume()
+        self._execute_at(payload, "state", self.datenight_client.resume)
 
     def on_seek(self, payload):
         log.info(f"Received seek request to {payload}")
@@ -45,7 +223,8 @@ class PublishNamespace(AsyncClientNamespace):
         except (KeyError, ValueError):
             log.info("Invalid seek destination, ignoring...")
         else:
-            self.datenight_client.seek(seek_dst)
+            self._execute_at(
+                payload, "seek", self.datenight_client.seek, seek_dst)
 
     async def on_log_message(self, msg):
         """Server asked us to inform the user of a msg"""
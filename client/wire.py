@@ -0,0 +1,44 @@
+"""Compact encoding of the 'update state' reports sent to the server
+
+Reports are json by default. If the server agrees (see
+PublishNamespace.initialize_namespace), they are sent as a binary msgpack
+map keyed by small integers instead of the field names, with the usual
+player states as small integers too.
+
+The tables must match the server's (server/wire.py).
+
+"""
+import logging
+
+try:
+    import msgpack
+except ImportError:  # optional, see client_requirements.txt
+    msgpack = None
+
+log = logging.getLogger(__name__)
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+STATE_FIELDS = (
+    "title", "status", "position", "length", "show", "suggest_sync", "at",
+    "rate",
+)
+STATUSES = ("Playing", "Paused", "Stopped", "Unknown")
+
+_field_ids = {name: i for i, name in enumerate(STATE_FIELDS)}
+_status_ids = {name: i for i, name in enumerate(STATUSES)}
+
+
+def supported_formats():
+    return [MSGPACK, JSON] if msgpack is not None else [JSON]
+
+
+def encode_state(state):
+    """msgpack bytes for an 'update state' dict"""
+    packed = {}
+    for name, value in state.items():
+        if name == "status":
+            value = _status_ids.get(value, value)
+        packed[_field_ids.get(name, name)] = value
+    return msgpack.packb(packed)
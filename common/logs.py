@@ -0,0 +1,141 @@
+"""Logging off the request path (or the event loop): records are queued by
+the handlers, then formatted and written by a background thread
+
+Records logged with an event (extra={'event': ...}, or the socket.io event
+being handled on the server) can be capped to a number per second and per
+event (see --log-rate), the others being counted and mentioned by the next
+record written. Warnings and errors are never dropped.
+
+Messages are only formatted once a record is accepted: hot paths log with
+%-style arguments, so that disabled levels cost nothing.
+
+Shared by the server and the client, see server/logs.py and client/logs.py
+for their own filters and caps.
+
+"""
+import argparse
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+FORMAT = '%(asctime)s: %(levelname)s:\t%(message)s'
+
+
+class Sampler(logging.Filter):
+    """At most rates[event] records of each event per second (none: no cap)
+    """
+
+    def __init__(self, rates, on_suppressed=None):
+        """:param on_suppressed: called with the event of every record
+        dropped"""
+        super().__init__()
+        self.rates = rates
+        self._on_suppressed = on_suppressed
+        self._windows = {}  # event -> [second, accepted, suppressed]
+
+    def filter(self, record):
+        record.event = getattr(record, 'event', None)
+        rate = self.rates.get(record.event)
+        if not rate or record.levelno >= logging.WARNING:
+            return True
+        second = int(time.monotonic())
+        window = self._windows.setdefault(record.event, [second, 0, 0])
+        if window[0] != second:
+            if window[2]:
+                record.suppressed = window[2]
+            window[:] = second, 0, 0
+        if window[1] >= rate:
+            window[2] += 1
+            if self._on_suppressed:
+                self._on_suppressed(record.event)
+            return False
+        window[1] += 1
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        if getattr(record, 'suppressed', None):
+            text += f" (+{record.suppressed} suppressed)"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line"""
+    FIELDS = ('sid', 'room', 'event', 'suppressed')
+
+    def format(self, record):
+        data = {'ts': round(record.created, 3), 'level': record.levelname,
+                'logger': record.name, 'message': record.getMessage()}
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        """Only merge the message with its arguments (which may change
+        after the call), the rest of the formatting is left to the writer
+        thread"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def rate_option(value):
+    """Parses a --log-rate option: <event>=<records per second>"""
+    event, _, rate = value.rpartition("=")
+    try:
+        return event, float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"expected <event>=<records per second>, got {value!r}")
+
+
+def setup(level, logger_names, json_format=False, rates=None, filters=(),
+          on_suppressed=None):
+    """Log the records of those loggers to stderr, from a background thread
+
+    :param rates: event -> records per second, see Sampler
+    :param filters: run before the Sampler, e.g. to set the records' event
+    :param on_suppressed: see Sampler
+    """
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter() if json_format
+                        else TextFormatter(FORMAT))
+    handler = QueueHandler(queue.SimpleQueue())
+    for log_filter in filters:
+        handler.addFilter(log_filter)
+    handler.addFilter(Sampler(rates or {}, on_suppressed))
+    for name in logger_names:
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.addHandler(handler)
+
+    def start():
+        listener = logging.handlers.QueueListener(handler.queue, stream)
+        listener.start()
+        atexit.register(listener.stop)  # writes what is left
+
+    start()
+
+    def restart():  # the thread doesn't survive a fork, see run_workers()
+        handler.queue = queue.SimpleQueue()
+        start()
+
+    os.register_at_fork(after_in_child=restart)
@@ -4,11 +4,12 @@ import argparse
 import asyncio
 import sys
 import subprocess
+import urllib.parse
 
 import socketio
 import socketio.exceptions
 
-from client import version
+from client import logs, version, wire
 from client.websocket import PublishNamespace
 from client.vlc.playerctl import ForkingPlayerctlClient
 from client.vlc.unixsocket import UnixSocketClient
@@ -64,11 +65,34 @@ def main():
                              "80 for http:// and 443 for https://)")
     parser.add_argument('-c', '--client', default=default_client, type=str,
                         choices=clients.keys(), help="Choice of client to use")
+    parser.add_argument('-r', '--room', type=str, default=None,
+                        help="Room (watch party) to join on the server "
+                             "(if unspecified, the server's default room)")
     parser.add_argument('-a', '--alias', type=str, default=None,
                         help="Name by which this publisher will be known as")
     parser.add_argument('-o', '--offset', default=0, type=int,
                         help="Offset (+/- <seconds> if any), to apply on the "
                              "local file")
+    parser.add_argument('-w', '--wire-format', default=wire.JSON,
+                        choices=wire.supported_formats(),
+                        help="format of the state reports, if the server "
+                             "supports it (msgpack is more compact)")
+    parser.add_argument('--websocket-only', action='store_true',
+                        help="connect with a websocket right away, instead "
+                             "of starting with http long-polling")
+    parser.add_argument('--compress', action='store_true',
+                        help="offer permessage-deflate compression of the "
+                             "websocket messages to the server")
+    parser.add_argument('--log-json', action='store_true',
+                        help="log json lines")
+    parser.add_argument('--log-rate', action='append', default=[],
+                        type=logs.rate_option, metavar='EVENT=RATE',
+                        help="log at most RATE records of an event per "
+                             "second (warnings and errors excepted), e.g. "
+                             "'player=2', 0 for no cap (preset caps: "
+                             "%s)" % ", ".join(
+                                 f"{e}={r:g}" for e, r
+                                 in logs.DEFAULT_RATES.items()))
     parser.add_argument('-V', '--version', action='version',
                         version="%(prog)s v{} ({})".format(
                             '.'.join(map(str, version)), get_commit_id()),
@@ -116,16 +140,8 @@ def main():
     # logger setup
     level = max(10, 50 - (10 * args.v))
     print(f'Logging level is: {logging.getLevelName(level)}')
-    logger = logging.getLogger(__name__)
-    logger.setLevel(level)
-    formatter = logging.Formatter('%(asctime)s: %(levelname)s:\t%(message)s')
-    sh = logging.StreamHandler()
-    sh.setFormatter(formatter)
-    logger.addHandler(sh)
-
-    logger = logging.getLogger('client')
-    logger.setLevel(level)
-    logger.addHandler(sh)
+    logs.setup(level, (__name__, 'client'), json_format=args.log_json,
+               rates={**logs.DEFAULT_RATES, **dict(args.log_rate)})
 
     if args.port is None:
         if args.server.startswith("https"):
@@ -137,18 +153,28 @@ def main():
 
 
 async def start_loop(args, clients):
-    socket_io = socketio.AsyncClient(logger=False)
+    websocket_options = {}
+    if args.compress:
+        websocket_options['compress'] = 15  # deflate window bits
+    socket_io = socketio.AsyncClient(
+        logger=False, websocket_extra_options=websocket_options)
+    # registered first, not to miss the events sent on connect
+    publish = PublishNamespace(namespace='/publish',
+                               wire_format=args.wire_format)
+    socket_io.register_namespace(publish)
 
     host = f'{args.server}:{args.port}'
+    url = host
+    if args.room:
+        url += '?' + urllib.parse.urlencode({'room': args.room})
     try:
-        await socket_io.connect(host, namespaces=['/publish'])
+        await socket_io.connect(
+            url, namespaces=['/publish'], auth=publish.auth,
+            transports=['websocket'] if args.websocket_only else None)
     except socketio.exceptions.ConnectionError:
         print(f"Fatal: Couldn't connect to {host}")
         return 1
 
-    publish = PublishNamespace(namespace='/publish')
-    socket_io.register_namespace(publish)
-
     client = clients[args.client](publish, args.offset)
     await publish.initialize_namespace(client, args.alias)
 
@@ -157,6 +183,9 @@ async def start_loop(args, clients):
     except ConnectionResetError:
         print("Aborting client...")
         return 1
+    except asyncio.CancelledError:  # interrupted
+        await publish.disconnect()
+        raise
 
 
 if __name__ == '__main__':
@@ -1,8 +1,20 @@
 #!/usr/bin/env python3
 import logging
 import argparse
+import os
+import signal
+import tempfile
+import uuid
 
-from server import app, socketio
+from server import app, socketio, init_app
+from server.clock import CommandTiming
+from server.consensus import SyncConsensus
+from server.heartbeat import HeartbeatService
+from server import logs, ratelimit
+from server.playback import PlaybackClock
+from server.scheduler import PublisherUpdateScheduler
+from server.sessions import PublisherSessions
+from server.store import open_store
 
 log = logging.getLogger(__name__)
 __version__ = (0, 0, 1)
@@ -26,6 +38,113 @@ def main():
     parser.add_argument('-d', '--debug', action="store_true",
                         help="run in debug mode "
                              "(Warning: don't run this with -a)")
+    parser.add_argument('-e', '--engine', default="eventlet",
+                        choices=("eventlet", "asyncio"),
+                        help="server implementation: Flask-SocketIO's on "
+                             "eventlet, or python-socketio's asyncio server "
+                             "on aiohttp")
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help="number of server processes, listening on "
+                             "consecutive ports from --port (to be put "
+                             "behind a proxy with sticky sessions)")
+    parser.add_argument('--store', default=None, type=str,
+                        help="state shared by the workers: memory, "
+                             "file:///path/to/file.json or redis://... "
+                             "(default: memory for a single worker, a "
+                             "temporary file otherwise). A single worker "
+                             "may use journal:///path/to/directory to "
+                             "recover its state when restarted")
+    parser.add_argument('--message-queue', default=None, type=str,
+                        help="queue relaying emits between the workers: "
+                             "redis://, amqp://, kafka://, zmq+tcp:// or "
+                             "file:///path/to/file (default: none for a "
+                             "single worker, a temporary file otherwise)")
+    parser.add_argument('--websocket-only', action='store_true',
+                        help="refuse http long-polling: clients connect "
+                             "with a websocket right away (the proxy must "
+                             "let websockets through)")
+    parser.add_argument('--transport-ping-interval', type=float, default=25,
+                        help="seconds between two Engine.IO pings, which "
+                             "keep connections (and proxies) alive")
+    parser.add_argument('--transport-ping-timeout', type=float, default=20,
+                        help="seconds without a reply to an Engine.IO ping "
+                             "after which a client is disconnected")
+    parser.add_argument('--compression-threshold', type=int, default=1024,
+                        help="bytes under which long-polling responses "
+                             "aren't compressed (websocket messages are "
+                             "compressed if the client offers it, see "
+                             "run_client.py --compress)")
+    parser.add_argument('--no-compression', action='store_true',
+                        help="never compress long-polling responses")
+    parser.add_argument('--flush-interval', type=int,
+                        default=int(PublisherUpdateScheduler.FLUSH_INTERVAL
+                                    * 1000),
+                        help="milliseconds during which publisher updates "
+                             "are batched before being sent to subscribers "
+                             "(0 to send every update immediately)")
+    parser.add_argument('--ping-delay', type=float,
+                        default=HeartbeatService.PING_DELAY,
+                        help="seconds between two latency pings of a "
+                             "publisher")
+    parser.add_argument('--timeout-threshold', type=float,
+                        default=HeartbeatService.TIMEOUT_THRESHOLD,
+                        help="seconds without a ping reply after which a "
+                             "publisher's latency is reset to -1")
+    parser.add_argument('--reap-grace', type=float,
+                        default=HeartbeatService.REAP_GRACE,
+                        help="seconds a timed out publisher is kept before "
+                             "being disconnected")
+    parser.add_argument('--resume-grace', type=float,
+                        default=PublisherSessions.RESUME_GRACE,
+                        help="seconds a publisher whose connection dropped "
+                             "can reconnect and resume its session, "
+                             "unnoticed by the subscribers (0 to disable)")
+    parser.add_argument('--command-lead', type=float,
+                        default=CommandTiming.LEAD,
+                        help="minimum seconds ahead at which pause/resume/"
+                             "seek commands are scheduled, for all "
+                             "publishers to execute them at once (0 to "
+                             "execute them on reception)")
+    parser.add_argument('--resume-countdown', type=float,
+                        default=CommandTiming.RESUME_COUNTDOWN,
+                        help="seconds of countdown before a resume "
+                             "requested by a subscriber")
+    parser.add_argument('--drift-threshold', type=float,
+                        default=PlaybackClock.DRIFT_THRESHOLD,
+                        help="seconds a publisher may drift from the room's "
+                             "expected position before being sought back "
+                             "(0 to disable drift correction)")
+    parser.add_argument('--suggestion-window', type=float,
+                        default=SyncConsensus.WINDOW,
+                        help="seconds during which concurrent sync "
+                             "suggestions of a room are collected, the "
+                             "earliest one being relayed (0 to relay every "
+                             "suggestion immediately)")
+    parser.add_argument('--chat-rate', type=float,
+                        default=ratelimit.chat.rate,
+                        help="chat messages and nick changes per second a "
+                             "subscriber may send, on average (0: no limit)")
+    parser.add_argument('--room-chat-rate', type=float,
+                        default=ratelimit.chat.room_rate,
+                        help="same, for all the subscribers of a room")
+    parser.add_argument('--command-rate', type=float,
+                        default=ratelimit.commands.rate,
+                        help="pause/resume/seek requests and sync "
+                             "suggestions per second a client may send, on "
+                             "average (0: no limit)")
+    parser.add_argument('--room-command-rate', type=float,
+                        default=ratelimit.commands.room_rate,
+                        help="same, for all the clients of a room")
+    parser.add_argument('--log-json', action='store_true',
+                        help="log json lines, with the event's context")
+    parser.add_argument('--log-rate', action='append', default=[],
+                        type=logs.rate_option, metavar='EVENT=RATE',
+                        help="log at most RATE records of an event per "
+                             "second (warnings and errors excepted), e.g. "
+                             "'update state=5', 0 for no cap (preset caps: "
+                             "%s)" % ", ".join(
+                                 f"{e}={r:g}" for e, r
+                                 in logs.DEFAULT_RATES.items()))
     parser.add_argument('-V', '--version', action='version',
                         version="%(prog)s v{}".format(
                             '.'.join(map(str, __version__))),
@@ -36,20 +155,85 @@ def main():
     # logger setup
     level = max(10, 50 - (10 * args.v))
     print(f'Logging level is: {logging.getLevelName(level)}')
-    logger = logging.getLogger(__name__)
-    logger.setLevel(level)
-    formatter = logging.Formatter('%(asctime)s: %(levelname)s:\t%(message)s')
-    sh = logging.StreamHandler()
-    sh.setFormatter(formatter)
-    logger.addHandler(sh)
+    logs.setup(level, (__name__, 'server'), json_format=args.log_json,
+               rates={**logs.DEFAULT_RATES, **dict(args.log_rate)})
 
-    logger = logging.getLogger('server')
-    logger.setLevel(level)
-    logger.addHandler(sh)
+    PublisherUpdateScheduler.FLUSH_INTERVAL = args.flush_interval / 1000
+    HeartbeatService.PING_DELAY = args.ping_delay
+    HeartbeatService.TIMEOUT_THRESHOLD = args.timeout_threshold
+    HeartbeatService.REAP_GRACE = args.reap_grace
+    PublisherSessions.RESUME_GRACE = args.resume_grace
+    CommandTiming.LEAD = args.command_lead
+    CommandTiming.RESUME_COUNTDOWN = args.resume_countdown
+    PlaybackClock.DRIFT_THRESHOLD = args.drift_threshold
+    SyncConsensus.WINDOW = args.suggestion_window
+    ratelimit.chat.rate = args.chat_rate
+    ratelimit.chat.room_rate = args.room_chat_rate
+    ratelimit.commands.rate = args.command_rate
+    ratelimit.commands.room_rate = args.room_command_rate
+
+    if args.workers > 1:
+        if (args.store or "").split(":")[0] in ("memory", "journal"):
+            parser.error("workers can't share an in-process store")
+        if args.debug:
+            parser.error("workers can't run in debug mode")
+        if args.engine == "asyncio" and not args.message_queue:
+            parser.error("asyncio workers need a redis --message-queue")
+        run_dir = tempfile.mkdtemp(prefix="datenight-")
+        args.store = args.store or f"file://{run_dir}/store.json"
+        args.message_queue = (args.message_queue
+                              or f"file://{run_dir}/queue")
+        log.info(f"Workers share {args.store} and {args.message_queue}")
+    if args.engine == "asyncio" and args.debug:
+        parser.error("the asyncio engine has no debug mode")
+    try:
+        init_app(store=open_store(args.store or "memory"),
+                 message_queue=args.message_queue, engine=args.engine,
+                 transports=(["websocket"] if args.websocket_only
+                             else ["polling", "websocket"]),
+                 ping_interval=args.transport_ping_interval,
+                 ping_timeout=args.transport_ping_timeout,
+                 http_compression=not args.no_compression,
+                 compression_threshold=args.compression_threshold)
+    except ValueError as e:
+        parser.error(str(e))
 
     # run flask
     host = "0.0.0.0" if args.all_interfaces else "127.0.0.1"
-    socketio.run(app, host=host, port=args.port, debug=args.debug)
+    if args.workers > 1:
+        run_workers(args.engine, host, args.port, args.workers)
+    else:
+        run(args.engine, host, args.port, debug=args.debug)
+
+
+def run(engine, host, port, debug=False):
+    if engine == "asyncio":
+        from server import asyncio_engine  # needs aiohttp
+        asyncio_engine.run(app, socketio, host=host, port=port)
+    else:
+        socketio.run(app, host=host, port=port, debug=debug)
+
+
+def run_workers(engine, host, first_port, count):
+    workers = []
+    for port in range(first_port, first_port + count):
+        pid = os.fork()
+        if pid == 0:
+            # the message queue tells the workers apart by this id, which
+            # was picked before forking
+            socketio.server.manager.host_id = uuid.uuid4().hex
+            run(engine, host, port)
+            os._exit(0)
+        log.info(f"Started worker {pid} on port {port}")
+        workers.append(pid)
+
+    try:
+        for pid in workers:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        log.info("Stopping workers...")
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
 
 
 if __name__ == '__main__':
@@ -6,7 +6,7 @@ from flask_socketio import SocketIO
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
-socketio = SocketIO(app)
+socketio = SocketIO()  # see init_app()
 log = logging.getLogger(__name__)
 
 
@@ -17,11 +17,6 @@ class PlayerState(Enum):
     UNKNOWN = "Unknown"
 
 
-# globals
-subscribers = {}
-publishers = {}
-current_state = PlayerState.PAUSED
-
 # presets
 subscribers_nick_presets = [
     "macaw", "rhino", "addax", "gharial", "vaquita", "bonobo", "dhole",
@@ -36,4 +31,38 @@ subscribers_color_presets = [  # valid css colors
     "green",
 ]
 
+
+def init_app(store=None, message_queue=None, engine="eventlet",
+             **socketio_options):
+    """Set up the socket.io server, must be called before running the app
+
+    :param store: State shared by the server workers (server.store.Store),
+                  in-process by default
+    :param message_queue: url of the queue relaying emits between the
+                          server workers (see server.message_queue)
+    :param engine: "eventlet" (Flask-SocketIO's server, run with
+                   socketio.run()) or "asyncio" (see server.asyncio_engine)
+    """
+    from server import rooms
+    from server.message_queue import client_manager
+
+    if store is not None:
+        rooms.use_store(store)
+    # for the socket.io clients of the pages
+    app.config['SOCKETIO_TRANSPORTS'] = socketio_options.get(
+        'transports', ["polling", "websocket"])
+    if engine == "asyncio":
+        from server import asyncio_engine
+        asyncio_engine.init_app(app, socketio, message_queue,
+                                **socketio_options)
+        return
+    if message_queue:
+        manager = client_manager(message_queue)
+        if manager:
+            socketio_options['client_manager'] = manager
+        else:
+            socketio_options['message_queue'] = message_queue
+    socketio.init_app(app, **socketio_options)
+
+
 from server.views import general, publisher, subscriber  # noqa
@@ -0,0 +1,73 @@
+"""Static files, served from memory under fingerprinted urls
+
+Every file of the static folder is read once, when the server starts, along
+with its gzip (and brotli, if installed) variants, when they are smaller.
+Templates link to them with asset_url('js/util.js'), which gives e.g.
+/assets/js/util.3f2a9c1b7d4e.js: the url changes with the content, so the
+responses can be cached forever by browsers and proxies.
+
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:  # optional, see server_requirements.txt
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+FINGERPRINT_LENGTH = 12
+
+COMPRESSORS = [("gzip", lambda data: gzip.compress(data, mtime=0))]
+if brotli is not None:
+    COMPRESSORS.insert(0, ("br", brotli.compress))  # smaller, preferred
+
+
+class Asset:
+    def __init__(self, filename, data):
+        self.fingerprint = hashlib.sha256(data).hexdigest()[
+            :FINGERPRINT_LENGTH]
+        root, extension = os.path.splitext(filename)
+        self.url_path = f"{root}.{self.fingerprint}{extension}"
+        self.mimetype = (mimetypes.guess_type(filename)[0]
+                         or "application/octet-stream")
+        self.variants = {}  # content-encoding -> bytes, by preference
+        for encoding, compress in COMPRESSORS:
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                self.variants[encoding] = compressed
+        self.variants["identity"] = data
+
+    def etag(self, encoding):
+        return f"{self.fingerprint}-{encoding}"
+
+    def negotiate(self, accept_encodings):
+        """The content-encoding to send, given the Accept-Encoding header
+        (identity is always acceptable)"""
+        for encoding in self.variants:
+            if encoding == "identity" or accept_encodings[encoding] > 0:
+                return encoding
+
+
+def load(static_folder):
+    """Fingerprinted url path -> Asset, filename -> fingerprinted url path"""
+    by_url, urls = {}, {}
+    size = 0
+    for directory, _, filenames in os.walk(static_folder):
+        for name in filenames:
+            path = os.path.join(directory, name)
+            filename = os.path.relpath(path, static_folder)
+            filename = filename.replace(os.sep, "/")
+            with open(path, "rb") as f:
+                asset = Asset(filename, f.read())
+            by_url[asset.url_path] = asset
+            urls[filename] = asset.url_path
+            size += sum(len(v) for v in asset.variants.values())
+    log.info(f"Loaded {len(by_url)} static files "
+             f"({size / 1024:.0f} KiB with their compressed variants)")
+    return by_url, urls
@@ -0,0 +1,164 @@
+"""Runs the server on asyncio (python-socketio's AsyncServer on aiohttp)
+
+The views are the same as with the default (eventlet) engine: Flask-SocketIO
+keeps dispatching the events to them, with the same request context, and
+only the socket.io server underneath changes. The views' emits, room
+changes and disconnections are queued and carried out in order by a single
+task, since synchronous handlers can't wait for them (neither do they wait
+with eventlet, where emits only queue packets).
+
+The pages and static files are still served by the Flask app, which is
+called in-process for every http request that isn't socket.io's (room
+snapshot long polls wait for changes before it is, see server.snapshots).
+
+"""
+import asyncio
+import functools
+import logging
+import urllib.parse
+
+import socketio as python_socketio
+from aiohttp import web
+from multidict import CIMultiDict
+from werkzeug.test import EnvironBuilder
+
+log = logging.getLogger(__name__)
+
+ASYNC_MODE = 'aiohttp'
+
+
+class SyncServer:
+    """The part of socketio.Server used by Flask-SocketIO and the views, on
+    top of an AsyncServer"""
+
+    def __init__(self, server, app):
+        self.server = server
+        self.app = app
+        self.async_mode = server.async_mode
+        self._outbox = None  # started with the event loop, see run()
+
+    @property
+    def manager(self):
+        return self.server.manager
+
+    def start(self):
+        self._outbox = asyncio.Queue()
+        return asyncio.create_task(self._send_all())
+
+    async def _send_all(self):
+        while True:
+            operation = await self._outbox.get()
+            try:
+                await operation
+            except Exception:
+                log.exception("socket.io operation failed")
+
+    def _queue(self, operation):
+        self._outbox.put_nowait(operation)
+
+    def on(self, event, handler=None, namespace=None):
+        return self.server.on(event, handler, namespace=namespace)
+
+    def emit(self, event, data=None, to=None, room=None, skip_sid=None,
+             namespace=None, callback=None, ignore_queue=False):
+        self._queue(self.server.emit(
+            event, data, to=to or room, skip_sid=skip_sid,
+            namespace=namespace, callback=callback,
+            ignore_queue=ignore_queue))
+
+    def enter_room(self, sid, room, namespace=None):
+        self._queue(self.server.enter_room(sid, room, namespace=namespace))
+
+    def leave_room(self, sid, room, namespace=None):
+        self._queue(self.server.leave_room(sid, room, namespace=namespace))
+
+    def disconnect(self, sid, namespace=None, ignore_queue=False):
+        self._queue(self.server.disconnect(sid, namespace=namespace,
+                                           ignore_queue=ignore_queue))
+
+    def get_environ(self, sid, namespace=None):
+        environ = self.server.get_environ(sid, namespace=namespace)
+        if environ is not None:
+            # set by Flask-SocketIO's wsgi middleware with the other engine
+            environ.setdefault('flask.app', self.app)
+        return environ
+
+    def start_background_task(self, target, *args, **kwargs):
+        if asyncio.iscoroutinefunction(target):
+            return asyncio.create_task(target(*args, **kwargs))
+        # runs on the event loop, so it must not block
+        return asyncio.get_running_loop().call_soon(
+            lambda: target(*args, **kwargs))
+
+    def sleep(self, seconds=0):
+        raise RuntimeError("Can't sleep synchronously on the asyncio engine,"
+                           " see helpers.run_periodically()")
+
+
+def client_manager(message_queue):
+    if not message_queue:
+        return None
+    if urllib.parse.urlparse(message_queue).scheme in ("redis", "rediss"):
+        return python_socketio.AsyncRedisManager(message_queue,
+                                                 channel='flask-socketio')
+    raise ValueError(f"Unsupported message queue on the asyncio engine: "
+                     f"{message_queue} (use redis://)")
+
+
+def init_app(app, socketio, message_queue=None, **socketio_options):
+    """Flask-SocketIO's init_app(), with an AsyncServer underneath"""
+    manager = client_manager(message_queue)
+    if manager:
+        socketio_options['client_manager'] = manager
+    server = python_socketio.AsyncServer(async_mode=ASYNC_MODE,
+                                         **socketio_options)
+    app.extensions['socketio'] = socketio
+    socketio.server = SyncServer(server, app)
+    socketio.async_mode = ASYNC_MODE
+    # the views registered their handlers before there was a server
+    for event, handler, namespace in socketio.handlers:
+        server.on(event, handler, namespace=namespace)
+
+
+async def _flask_view(app, request):
+    environ = EnvironBuilder(
+        path=request.path, method=request.method,
+        query_string=request.query_string,
+        headers=list(request.headers.items()),
+        data=await request.read()).get_environ()
+    response = app.response_class.from_app(app.wsgi_app, environ,
+                                           buffered=True)
+    headers = CIMultiDict(
+        (k, v) for k, v in response.headers.items()
+        if k.lower() not in ('content-length', 'transfer-encoding'))
+    return web.Response(body=response.get_data(),
+                        status=response.status_code, headers=headers)
+
+
+async def _room_snapshot(app, request):
+    """Long polls wait in here, before the (synchronous) view"""
+    from server.snapshots import snapshots, wait_args
+    try:
+        wait = wait_args(request.query)
+    except ValueError:
+        wait = None  # the view answers 400
+    if wait is not None and snapshots.get(request.match_info['room_id']):
+        await snapshots.wait_async(request.match_info['room_id'], *wait)
+    return await _flask_view(app, request)
+
+
+def run(app, socketio, host, port):
+    web_app = web.Application()
+    socketio.server.server.attach(web_app)
+    web_app.router.add_route('GET', '/api/rooms/{room_id}',
+                             functools.partial(_room_snapshot, app))
+    web_app.router.add_route('*', '/{tail:.*}',
+                             functools.partial(_flask_view, app))
+    tasks = []  # keep a reference, tasks are otherwise weakly referenced
+
+    async def start_sending(_):
+        tasks.append(socketio.server.start())
+
+    web_app.on_startup.append(start_sending)
+    log.info(f"Serving on http://{host}:{port} (asyncio engine)")
+    web.run_app(web_app, host=host, port=port, print=None)
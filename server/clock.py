@@ -0,0 +1,97 @@
+import logging
+import time
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+
+class ClockEstimator:
+    """NTP-style round trip, jitter and clock offset estimates of a peer
+
+    Built from latency_ping/latency_pong exchanges:
+    t0: server sends the ping      t1: client receives it
+    t2: client sends the pong      t3: server receives it
+    (t0/t3 are read on the server's clock, t1/t2 on the client's clock)
+
+    delay = (t3 - t0) - (t2 - t1)
+    offset = ((t1 - t0) + (t2 - t3)) / 2, i.e. client clock - server clock
+
+    The round trip and jitter are smoothed like TCP's SRTT/RTTVAR. The offset
+    is the one of the sample with the lowest delay within the last WINDOW
+    samples, since it is the least affected by queuing.
+
+    """
+    WINDOW = 8
+    RTT_ALPHA = 0.125
+    JITTER_BETA = 0.25
+
+    def __init__(self):
+        self._samples = deque(maxlen=self.WINDOW)  # (delay, offset)
+        self.srtt = None
+        self.jitter = None
+        self.offset = None
+
+    def add_sample(self, t0, t3, t1=None, t2=None):
+        """t1 and t2 are missing for clients which don't report them, in
+        which case only the round trip and jitter are estimated"""
+        if t1 is None or t2 is None:
+            delay = t3 - t0
+        else:
+            delay = max(0.0, (t3 - t0) - (t2 - t1))
+            self._samples.append((delay, ((t1 - t0) + (t2 - t3)) / 2))
+            self.offset = min(self._samples)[1]
+
+        if self.srtt is None:
+            self.srtt = delay
+            self.jitter = delay / 2
+        else:
+            self.jitter += self.JITTER_BETA * (
+                abs(self.srtt - delay) - self.jitter)
+            self.srtt += self.RTT_ALPHA * (delay - self.srtt)
+        return delay
+
+    def sent_at(self, received_ts):
+        """Server time at which a message received at received_ts was sent
+        (assuming a symmetric path)"""
+        return received_ts - (self.srtt / 2 if self.srtt is not None else 0)
+
+    def dict_repr(self):
+        def rounded(x):
+            return None if x is None else round(x, 3)
+
+        return {
+            'rtt': rounded(self.srtt),
+            'jitter': rounded(self.jitter),
+            'offset': rounded(self.offset),
+        }
+
+
+class CommandTiming:
+    """Picks the server time at which the publishers of a room should
+    execute a pause/resume/seek command
+
+    Commands are scheduled far enough in the future for the slowest
+    publisher to receive them in time (one way delay + jitter), but at least
+    LEAD seconds and at most MAX_LEAD seconds ahead. Each client converts
+    that time with its clock offset and acts at the same moment as the
+    others. A LEAD of 0 sends "do it now" commands instead.
+
+    """
+    LEAD = 0.5
+    MAX_LEAD = 5
+    RESUME_COUNTDOWN = 3
+
+    @classmethod
+    def execution_time(cls, estimates, countdown=0):
+        """None if the command should be executed right away
+
+        :param estimates: (round trip, jitter) of every recipient, see
+        ClockEstimator (None if not known yet)
+        """
+        if not cls.LEAD and not countdown:
+            return None
+        slowest = max((rtt / 2 + 2 * (jitter or 0)
+                       for rtt, jitter in estimates if rtt is not None),
+                      default=0)
+        lead = min(max(cls.LEAD, slowest), cls.MAX_LEAD)
+        return time.time() + max(lead, countdown)
@@ -0,0 +1,126 @@
+"""Turns concurrent sync suggestions of a room into a single command
+
+When several players are paused or sought at about the same time, each of
+their publishers suggests it to the room. Instead of relaying every one of
+them (each of which makes the other players react, and maybe suggest in
+turn), the first suggestion opens a WINDOW seconds long decision window for
+its room. The suggestions received until it closes compete, and the one
+made first (by the time its report was sent, in server time) is the only
+one relayed to the room.
+
+After a command (relayed suggestion or subscriber request), suggestions
+agreeing with the room's playback clock for ECHO_PERIOD seconds are only
+publishers confirming they executed it, and are ignored too.
+
+"""
+import logging
+import time
+
+from server import PlayerState, rooms
+from server.helpers import run_periodically
+from server.metrics import Counter
+from server.views import SyncSuggestion
+
+log = logging.getLogger(__name__)
+
+outcomes = Counter("datenight_sync_suggestions_total",
+                   "Publisher sync suggestions, by what became of them",
+                   ("outcome",))
+
+
+class Suggestion:
+    """What a publisher suggested, kept until its window closes"""
+    __slots__ = ("sid", "nick", "kind", "status", "title", "position",
+                 "reported_at")
+
+    def __init__(self, sid, nick, kind: SyncSuggestion, status: PlayerState,
+                 title, position, reported_at):
+        self.sid = sid
+        self.nick = nick
+        self.kind = kind
+        self.status = status
+        self.title = title
+        self.position = position
+        self.reported_at = reported_at  # server time
+
+
+class SyncConsensus:
+    WINDOW = 0.25  # seconds, 0 relays every suggestion right away
+    ECHO_PERIOD = 1.5  # seconds after the execution of a command
+    ECHO_TOLERANCE = 2  # seconds between the reported and expected positions
+    TICK = 0.05  # seconds, granularity of the window deadlines
+
+    def __init__(self):
+        self._windows = {}  # room -> (deadline, [Suggestion], relay)
+        self._task = None
+        self._relayed = outcomes.labels("relayed")
+        self._merged = outcomes.labels("merged")
+        self._echoes = outcomes.labels("echo")
+
+    def suggest(self, room, suggestion, relay):
+        """Take part in the room's window, which relay(room, suggestion)s
+        its winner when it closes
+
+        Returns False if the suggestion is an echo of the last command, to
+        be handled like a plain report
+        """
+        if self._is_echo(room, suggestion):
+            log.debug("%s: ignoring an echo of the last command (%s)",
+                      suggestion.sid, suggestion.kind.value)
+            self._echoes.inc()
+            return False
+
+        if not self.WINDOW:
+            self._relay(room, [suggestion], relay)
+            return True
+        try:
+            self._windows[room][1].append(suggestion)
+        except KeyError:
+            self._windows[room] = (time.time() + self.WINDOW, [suggestion],
+                                   relay)
+            if self._task is None:
+                log.info(f"Starting sync suggestion windows "
+                         f"({self.WINDOW}s)")
+                self._task = run_periodically(
+                    self.TICK, self.close_due,
+                    "Failed to relay sync suggestions")
+        return True
+
+    def close_due(self):
+        now = time.time()
+        due = [room for room, (deadline, _, _) in self._windows.items()
+               if deadline <= now]
+        for room in due:
+            _, suggestions, relay = self._windows.pop(room)
+            if rooms.rooms.get(room.id) is room:  # else everyone left since
+                self._relay(room, suggestions, relay)
+
+    def _relay(self, room, suggestions, relay):
+        winner = min(suggestions, key=lambda s: s.reported_at)
+        if len(suggestions) > 1:
+            log.info(f"{len(suggestions)} concurrent sync suggestions in "
+                     f"{room.id!r}, relaying {winner.nick}'s "
+                     f"({winner.kind.value})")
+            self._merged.inc(len(suggestions) - 1)
+        self._relayed.inc()
+        relay(room, winner)
+
+    def commanded(self, room, at=None):
+        """A command was sent to the room, to be executed at server time at
+        (now by default)"""
+        room.echoes_until = ((time.time() if at is None else at)
+                             + self.ECHO_PERIOD)
+
+    def _is_echo(self, room, suggestion):
+        if time.time() > room.echoes_until:
+            return False
+        playback = room.playback
+        if suggestion.kind == SyncSuggestion.STATE:
+            return suggestion.status == playback.state
+        expected = playback.position(suggestion.reported_at)
+        return (expected is not None
+                and abs(suggestion.position - expected)
+                <= self.ECHO_TOLERANCE)
+
+
+sync_consensus = SyncConsensus()
@@ -0,0 +1,92 @@
+import logging
+import time
+
+from server import socketio
+from server.helpers import run_periodically
+
+log = logging.getLogger(__name__)
+
+
+class HeartbeatService:
+    """Pings every publisher from a single hashed timer wheel
+
+    Publishers are hashed (by sid) into one of WHEEL_SLOTS slots. A single
+    background task advances the wheel every PING_DELAY / WHEEL_SLOTS
+    seconds and handles the current slot in one batch: each publisher in it
+    is pinged and its last sign of life (kept in one dict for everyone) is
+    checked. Publishers silent for more than TIMEOUT_THRESHOLD seconds are
+    flagged (latency -1), and dropped once silent for REAP_GRACE more.
+
+    Deadlines are checked when a publisher's slot comes around, so timeouts
+    are detected with a granularity of PING_DELAY seconds.
+
+    """
+    PING_DELAY = 5
+    TIMEOUT_THRESHOLD = 12
+    REAP_GRACE = 60
+    WHEEL_SLOTS = 20
+
+    def __init__(self):
+        self._wheel = [set() for _ in range(self.WHEEL_SLOTS)]  # sids
+        self._cursor = 0
+        self._publishers = {}  # sid -> Publisher
+        self._last_seen = {}  # sid -> time.monotonic() of the last pong
+        self._task = None
+
+    def _slot(self, sid):
+        return self._wheel[hash(sid) % len(self._wheel)]
+
+    def add(self, publisher):
+        sid = publisher.sid
+        self._publishers[sid] = publisher
+        self._last_seen[sid] = time.monotonic()
+        self._slot(sid).add(sid)
+        # don't wait for the wheel for the first sample, but let the connect
+        # handler complete first
+        socketio.start_background_task(publisher.ping)
+
+        if self._task is None:
+            log.info(f"Starting heartbeat service (ping every "
+                     f"{self.PING_DELAY}s, timeout {self.TIMEOUT_THRESHOLD}s,"
+                     f" reaped after {self.REAP_GRACE}s more)")
+            self._task = run_periodically(
+                self.PING_DELAY / len(self._wheel), self.tick,
+                "Heartbeat tick failed")
+
+    def remove(self, sid):
+        log.info(f"Removing {sid} from the heartbeat service")
+        self._publishers.pop(sid, None)
+        self._last_seen.pop(sid, None)
+        self._slot(sid).discard(sid)
+
+    def alive(self, sid):
+        if sid in self._last_seen:
+            self._last_seen[sid] = time.monotonic()
+
+    def __len__(self):
+        return len(self._publishers)
+
+    def tick(self):
+        slot = self._wheel[self._cursor]
+        self._cursor = (self._cursor + 1) % len(self._wheel)
+
+        now = time.monotonic()
+        for sid in list(slot):
+            silence = now - self._last_seen[sid]
+            if silence > self.TIMEOUT_THRESHOLD + self.REAP_GRACE:
+                self._reap(sid, silence)
+                continue
+            publisher = self._publishers[sid]
+            if silence > self.TIMEOUT_THRESHOLD:
+                publisher.timed_out(silence)
+            publisher.ping()
+
+    def _reap(self, sid, silence):
+        log.info(f"{sid}: no ping reply in {silence:.0f} seconds, "
+                 f"disconnecting the publisher")
+        self.remove(sid)
+        # the disconnect handler takes care of the room and the subscribers
+        socketio.server.disconnect(sid, namespace='/publish')
+
+
+heartbeat = HeartbeatService()
@@ -1,15 +1,107 @@
+import asyncio
 import logging
+import time
 
-from server import publishers, subscribers
+from server import socketio
+from server.clock import CommandTiming
+from server.metrics import fanout
 
 log = logging.getLogger(__name__)
 
+_patches_fanout = fanout.labels('patch publishers')
 
-def clean_publishers():
+
+def clean_subscribers(room):
     # index by nick instead of request.sid (which is private info)
-    return {p.nick: p.dict_repr() for p in publishers.values()}
+    # (from the store: includes subscribers connected to other workers)
+    return room.subscribers_snapshot()
 
 
-def clean_subscribers():
-    # index by nick instead of request.sid (which is private info)
-    return {s.nick: s.dict_repr() for s in subscribers.values()}
+def emit_publishers_snapshot(room, to, **extra):
+    """Complete (versioned) publisher list, sent once per subscriber
+
+    Subsequent changes are sent as patches (see emit_publisher_patches)
+    """
+    socketio.emit('update publishers',
+                  {'data': room.publishers_snapshot(),
+                   'version': room.publishers_version, **extra},
+                  namespace='/subscribe', room=to)
+
+
+def emit_publisher_patches(room, patches):
+    patches = [patch for patch in patches
+               if patch is not None]  # None: nothing changed
+    if not patches:
+        return
+    _patches_fanout.observe(len(room.subscribers))
+    socketio.emit('patch publishers', {'patches': patches},
+                  namespace='/subscribe', room=room.id)
+
+
+def run_periodically(interval, callback, error_message):
+    """Call callback every interval seconds, from a background task
+
+    If callback returns a function, it is called in a thread (e.g. disk
+    writes, which would hold up every connection), the next call waiting
+    for it to return.
+    """
+    def call():
+        try:
+            return callback()
+        except Exception:
+            log.exception(error_message)
+
+    def call_blocking(blocking):
+        try:
+            blocking()
+        except Exception:
+            log.exception(error_message)
+
+    if socketio.async_mode == 'aiohttp':  # see server.asyncio_engine
+        async def run():
+            loop = asyncio.get_running_loop()
+            while True:
+                await asyncio.sleep(interval)
+                blocking = call()
+                if blocking is not None:
+                    await loop.run_in_executor(None, call_blocking, blocking)
+    else:
+        def run():
+            while True:
+                socketio.sleep(interval)
+                blocking = call()
+                if blocking is not None:
+                    in_thread(call_blocking, blocking)
+    return socketio.start_background_task(run)
+
+
+def in_thread(function, *args):
+    """function(*args), run in a thread by the eventlet hub, which goes on
+    with the other greenthreads in the meantime"""
+    if socketio.async_mode != 'eventlet':  # threads already
+        return function(*args)
+    from eventlet import tpool
+    return tpool.execute(function, *args)
+
+
+def command_timing(room, countdown=0, publishers=None):
+    """When the publishers of the room should execute a command
+
+    'at' is a server timestamp (for publishers, which know their clock
+    offset), 'in' is relative (for subscribers' countdowns). Empty if the
+    command should be executed right away.
+    :param publishers: The recipients, if not the whole room
+    """
+    estimates = {}  # nick -> (round trip, jitter)
+    if publishers is None:
+        # the whole room, including the publishers of the other workers,
+        # as of their last publication (ours are fresher)
+        estimates = {nick: (data.get('rtt'), data.get('jitter'))
+                     for nick, data in room.publishers_snapshot().items()}
+        publishers = room.publishers.values()
+    estimates.update((p.nick, (p.clock.srtt, p.clock.jitter))
+                     for p in publishers)
+    at = CommandTiming.execution_time(estimates.values(), countdown)
+    if at is None:
+        return {}
+    return {'at': at, 'in': round(at - time.time(), 3)}
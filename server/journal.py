@@ -0,0 +1,202 @@
+"""Durable store for a single server process: an append-only journal of the
+store operations, plus periodic snapshots
+
+Every change is applied in memory, then appended to the journal, which is
+fsynced by a background task every FSYNC_INTERVAL seconds (a crash loses at
+most that much). Every SNAPSHOT_INTERVAL seconds, the whole store is written
+to a snapshot and the journal starts over. Only the records (and a copy
+of the store, for snapshots) are taken on the event loop: the writes and
+fsyncs are done in a thread, see run_periodically().
+
+On startup, the snapshot is loaded and the journal records it doesn't
+include yet are replayed, then server.rooms.recover() adapts the rooms to
+their clients being gone.
+
+Journal records are json lines: [sequence number, operation, *arguments].
+Operations which aren't deterministic are recorded by their effect (e.g. the
+member spop() removed).
+
+"""
+import atexit
+import functools
+import json
+import logging
+import os
+import time
+
+from server.store import MemoryStore
+
+log = logging.getLogger(__name__)
+
+
+class JournalStore(MemoryStore):
+    FSYNC_INTERVAL = 0.1  # seconds
+    SNAPSHOT_INTERVAL = 60
+
+    def __init__(self, directory):
+        super().__init__()
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._snapshot_path = os.path.join(directory, "snapshot.json")
+        self._journal_path = os.path.join(directory, "journal.log")
+        self._seq = 0  # of the last record
+        self._snapshot_seq = 0  # last record included in the snapshot
+        self._snapshot_ts = time.time()
+        self._pending = []  # records not written yet
+        self._task = None
+
+        self.recovered = self._recover()
+        if self.recovered:
+            log.info(f"Recovered the store from {directory} "
+                     f"(up to record {self._seq})")
+            self._write_snapshot(self._snapshot_data())
+            self._snapshot_seq = self._seq
+        # start over from an empty journal, whatever the state of its tail
+        self._journal = open(self._journal_path, "w")
+        atexit.register(self.flush)
+
+    def _recover(self):
+        try:
+            with open(self._snapshot_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = None
+        if data is not None:
+            self._seq = self._snapshot_seq = data['seq']
+            self._values = data['values']
+            self._sets = {k: set(v) for k, v in data['sets'].items()}
+            self._lists = data['lists']
+            self._hashes = data['hashes']
+
+        replayed = 0
+        try:
+            with open(self._journal_path) as f:
+                for line in f:
+                    try:
+                        seq, operation, *args = json.loads(line)
+                    except ValueError:
+                        # the end of the last batch was never fsynced
+                        log.warning(f"Ignoring the journal from record "
+                                    f"{self._seq + 1}: torn write")
+                        break
+                    if seq <= self._seq:  # already in the snapshot
+                        continue
+                    getattr(MemoryStore, operation)(self, *args)
+                    self._seq = seq
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        return data is not None or replayed > 0
+
+    def _record(self, operation, *args):
+        self._seq += 1
+        self._pending.append(json.dumps([self._seq, operation, *args]))
+        if self._task is None:
+            from server.helpers import run_periodically  # needs the server
+            self._task = run_periodically(self.FSYNC_INTERVAL, self._tick,
+                                          "Failed to write the journal")
+
+    def _tick(self):
+        """Takes the pending records (and the snapshot's data, when it is
+        due), returns their writes, for a thread"""
+        lines, self._pending = self._pending, []
+        snapshot = None
+        if (self._seq != self._snapshot_seq
+                and time.time() - self._snapshot_ts > self.SNAPSHOT_INTERVAL):
+            snapshot = self._snapshot_data()
+            self._snapshot_seq = self._seq
+            self._snapshot_ts = time.time()
+        if not lines and snapshot is None:
+            return None
+        return functools.partial(self._write, lines, snapshot)
+
+    def _write(self, lines, snapshot):
+        """Append and fsync those records, then write the snapshot (which
+        includes them) and start the journal over, if there is one"""
+        self._append(lines)
+        if snapshot is not None:
+            self._write_snapshot(snapshot)
+            self._journal.close()
+            self._journal = open(self._journal_path, "w")
+
+    def flush(self):
+        """Write and fsync the pending records"""
+        lines, self._pending = self._pending, []
+        self._append(lines)
+
+    def _append(self, lines):
+        if not lines:
+            return
+        self._journal.write("\n".join(lines) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _snapshot_data(self):
+        """A copy of the store, which can be written while it changes"""
+        return {
+            'seq': self._seq,
+            'values': dict(self._values),
+            'sets': {k: list(v) for k, v in self._sets.items()},
+            'lists': {k: list(v) for k, v in self._lists.items()},
+            'hashes': {k: dict(v) for k, v in self._hashes.items()},
+        }
+
+    def _write_snapshot(self, data):
+        tmp_path = f"{self._snapshot_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+        directory = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)  # the rename itself
+        finally:
+            os.close(directory)
+        log.debug(f"Store snapshot written (up to record {data['seq']})")
+
+    def set(self, key, value):
+        super().set(key, value)
+        self._record("set", key, value)
+
+    def delete(self, *keys):
+        super().delete(*keys)
+        self._record("delete", *keys)
+
+    def incr(self, key):
+        value = super().incr(key)
+        self._record("set", key, value)
+        return value
+
+    def sadd(self, key, *members):
+        added = super().sadd(key, *members)
+        if added:
+            self._record("sadd", key, *members)
+        return added
+
+    def srem(self, key, member):
+        super().srem(key, member)
+        self._record("srem", key, member)
+
+    def spop(self, key):
+        member = super().spop(key)
+        if member is not None:
+            self._record("srem", key, member)
+        return member
+
+    def rpush(self, key, value):
+        length = super().rpush(key, value)
+        self._record("rpush", key, value)
+        return length
+
+    def ltrim(self, key, start, stop):
+        super().ltrim(key, start, stop)
+        self._record("ltrim", key, start, stop)
+
+    def hset(self, key, field, value):
+        super().hset(key, field, value)
+        self._record("hset", key, field, value)
+
+    def hdel(self, key, field):
+        super().hdel(key, field)
+        self._record("hdel", key, field)
@@ -0,0 +1,49 @@
+"""Logging setup of the server, see common/logs.py
+
+Records logged while handling a socket.io event carry its sid, room and
+event name (also in the json output, see --log-json), and the records of
+busy events (e.g. one per publisher report) are capped.
+
+"""
+import logging
+
+from flask import has_request_context, request
+
+from common import logs
+from common.logs import rate_option  # noqa: F401
+from server.metrics import Counter
+
+# records per second, for the events sent periodically by every publisher
+DEFAULT_RATES = {'update state': 5, 'latency_pong': 5}
+
+suppressed = Counter("datenight_log_records_suppressed_total",
+                     "Log records dropped by the --log-rate caps",
+                     ("event",))
+
+
+class ContextFilter(logging.Filter):
+    """Adds the sid, room and event of the socket.io event being handled"""
+
+    def filter(self, record):
+        record.sid = record.room = None
+        if not hasattr(record, 'event'):
+            record.event = None
+        if not has_request_context():
+            return True
+        sid = getattr(request, 'sid', None)
+        if sid is None:  # plain http request
+            return True
+        from server import rooms
+        room = rooms.sid_rooms.get(sid)
+        record.sid = sid
+        record.room = room.id if room is not None else None
+        if record.event is None:
+            record.event = request.event['message']
+        return True
+
+
+def setup(level, logger_names, json_format=False, rates=None):
+    """See common.logs.setup()"""
+    logs.setup(level, logger_names, json_format, rates,
+               filters=(ContextFilter(),),
+               on_suppressed=lambda event: suppressed.labels(event).inc())
@@ -0,0 +1,64 @@
+"""Relays socket.io emits between the server workers
+
+Any message queue supported by Flask-SocketIO (redis://, amqp://,
+kafka://, zmq+tcp://) can be used, plus file:///path/to/file as a stand-in
+for workers of a single host, with no external service.
+
+"""
+import fcntl
+import logging
+import os
+import urllib.parse
+
+import socketio
+
+log = logging.getLogger(__name__)
+
+
+class FileQueueManager(socketio.PubSubManager):
+    """Pub/sub over an append-only local file, one json message per line
+
+    Every worker appends its messages to the file and tails it for the
+    messages of the others. The file is never truncated while running.
+    """
+    name = 'file'
+    POLL_INTERVAL = 0.005
+
+    def __init__(self, url, channel='flask-socketio', write_only=False,
+                 logger=None):
+        super().__init__(channel=channel, write_only=write_only,
+                         logger=logger)
+        self.path = urllib.parse.urlparse(url).path
+
+    def _publish(self, data):
+        line = (self.json.dumps(data) + "\n").encode()
+        with open(self.path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # lines must not interleave
+            try:
+                f.write(line)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _listen(self):
+        with open(self.path, "ab"):  # create it if needed
+            pass
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)  # older messages aren't for us
+            pending = b""
+            while True:
+                chunk = f.readline()
+                if not chunk:
+                    self.server.sleep(self.POLL_INTERVAL)
+                    continue
+                pending += chunk
+                if pending.endswith(b"\n"):  # else: still being written
+                    yield pending.decode()
+                    pending = b""
+
+
+def client_manager(url):
+    """socket.io client manager for the url, None if Flask-SocketIO's
+    own message_queue support handles it"""
+    if urllib.parse.urlparse(url).scheme == "file":
+        return FileQueueManager(url)
+    return None
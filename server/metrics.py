@@ -0,0 +1,187 @@
+"""Operational metrics, served at /metrics in the Prometheus text format
+
+Metrics are per process: with several workers, each one is scraped on its
+own port. Every label combination gets its own child, created once (e.g.
+when a handler is decorated) and kept by the caller, so that recording a
+value is a couple of additions and a bisect, with no lookup or allocation.
+
+"""
+import bisect
+import functools
+import inspect
+import logging
+import time
+
+from flask import request
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return (str(value).replace("\\", r"\\").replace('"', r'\"')
+            .replace("\n", r"\n"))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # label values -> child
+        registry.append(self)
+
+    def labels(self, *values):
+        """The child for these label values, keep it around"""
+        values = tuple(str(v) for v in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        try:
+            return self._children[values]
+        except KeyError:
+            child = self._children[values] = self._new_child()
+            return child
+
+    def _new_child(self):
+        raise NotImplementedError("Please use a subclass")
+
+    def samples(self):
+        """(name suffix, label names, label values, value) tuples"""
+        raise NotImplementedError("Please use a subclass")
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}"
+                         f"{_format_labels(names, values)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    class Child:
+        __slots__ = ("value",)
+
+        def __init__(self):
+            self.value = 0
+
+        def inc(self, amount=1):
+            self.value += amount
+
+    def _new_child(self):
+        return self.Child()
+
+    def samples(self):
+        for values, child in list(self._children.items()):
+            yield "", self.labelnames, values, child.value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    class Child:
+        __slots__ = ("buckets", "counts", "sum")
+
+        def __init__(self, buckets):
+            self.buckets = buckets
+            self.counts = [0] * (len(buckets) + 1)  # last one: +Inf
+            self.sum = 0.0
+
+        def observe(self, value):
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return self.Child(self.buckets)
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), child.counts):
+                cumulative += count
+                yield "_bucket", names, values + (bound,), cumulative
+            yield "_count", self.labelnames, values, cumulative
+            yield "_sum", self.labelnames, values, child.sum
+
+
+class Gauge(_Metric):
+    """Computed when scraped, by a function returning {label values: value}"""
+    type = "gauge"
+
+    def __init__(self, name, documentation, collect, labelnames=()):
+        self._collect = collect
+        super().__init__(name, documentation, labelnames)
+
+    def samples(self):
+        for values, value in self._collect().items():
+            yield "", self.labelnames, values, value
+
+
+registry = []  # every metric, in creation order
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1)
+RTT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+events = Counter("datenight_socketio_events_total",
+                 "Socket.io events handled", ("event", "namespace"))
+handler_seconds = Histogram("datenight_handler_seconds",
+                            "Socket.io handler execution time",
+                            LATENCY_BUCKETS, ("handler",))
+fanout = Histogram("datenight_broadcast_fanout",
+                   "Recipients (connected to this worker) of room broadcasts",
+                   FANOUT_BUCKETS, ("event",))
+heartbeat_rtt = Histogram("datenight_heartbeat_rtt_seconds",
+                          "Publisher latency_ping round trips",
+                          RTT_BUCKETS).labels()
+
+
+def instrumented(handler):
+    """Counts and times a socket.io handler, to be placed under @socketio.on
+
+    The handler is called with as many arguments as it accepts, like
+    Flask-SocketIO does for connect/disconnect handlers that don't take the
+    auth data or the disconnect reason.
+    """
+    duration = handler_seconds.labels(handler.__name__)
+    counters = {}  # (event, namespace) -> counter, a handler has one or two
+    accepted_args = len(inspect.signature(handler).parameters)
+
+    @functools.wraps(handler)
+    def wrapper(*args):
+        key = (request.event['message'], request.namespace)
+        try:
+            counter = counters[key]
+        except KeyError:
+            counter = counters[key] = events.labels(*key)
+        counter.inc()
+        start = time.perf_counter()
+        try:
+            return handler(*args[:accepted_args])
+        finally:
+            duration.observe(time.perf_counter() - start)
+
+    return wrapper
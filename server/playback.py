@@ -0,0 +1,125 @@
+import logging
+import time
+
+from server import PlayerState
+
+log = logging.getLogger(__name__)
+
+
+class PlaybackClock:
+    """Where the playback of a room should be at any given server time
+
+    The model is an anchor (position at a server timestamp), a rate and a
+    state. It is re-anchored by explicit commands (at their execution time),
+    by sync suggestions from publishers and by reports of a new state all
+    the publishers agree on (e.g. everyone paused their player without
+    suggesting it), and extrapolated in between.
+
+    Publishers drifting from it by more than DRIFT_THRESHOLD seconds are
+    corrected individually, at most once every CORRECTION_COOLDOWN seconds,
+    and never in the SETTLE_PERIOD following a command (reports sent in the
+    meantime reflect players which haven't caught up yet).
+
+    """
+    DRIFT_THRESHOLD = 2.5  # seconds, positions are reported in seconds
+    CORRECTION_COOLDOWN = 10
+    SETTLE_PERIOD = 3
+
+    def __init__(self, on_change=None):
+        """:param on_change: called with dict_repr() after every change
+        (e.g. to save it in the store shared by the server workers)"""
+        self.state = PlayerState.PAUSED
+        self.title = None
+        self.rate = 1.0
+        self._anchor_position = None  # unknown until the first report
+        self._anchor_ts = time.time()
+        self._settled_at = self._anchor_ts
+        self._on_change = on_change
+
+    def dict_repr(self):
+        return {
+            'state': self.state.value,
+            'title': self.title,
+            'rate': self.rate,
+            'anchor_position': self._anchor_position,
+            'anchor_ts': self._anchor_ts,
+            'settled_at': self._settled_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data, on_change=None):
+        clock = cls(on_change)
+        if data:
+            clock.state = PlayerState(data['state'])
+            clock.title = data['title']
+            clock.rate = data['rate']
+            clock._anchor_position = data['anchor_position']
+            clock._anchor_ts = data['anchor_ts']
+            clock._settled_at = data['settled_at']
+        return clock
+
+    def _changed(self):
+        if self._on_change:
+            self._on_change(self.dict_repr())
+
+    def position(self, at=None):
+        """Expected position at server time 'at' (now by default)"""
+        if self._anchor_position is None:
+            return None
+        if self.state != PlayerState.PLAYING:
+            return self._anchor_position
+        at = time.time() if at is None else at
+        return self._anchor_position + (at - self._anchor_ts) * self.rate
+
+    def _anchor(self, position, at):
+        self._anchor_position = position
+        self._anchor_ts = at
+        self._settled_at = at + self.SETTLE_PERIOD
+
+    def set_state(self, state, at=None):
+        at = time.time() if at is None else at
+        self._anchor(self.position(at), at)
+        self.state = state
+        self._changed()
+
+    def seek(self, position, at=None):
+        self._anchor(position, time.time() if at is None else at)
+        self._changed()
+
+    def report(self, status, title, position, at, agreed=None):
+        """A publisher's report, as of server time 'at'
+
+        Returns the drift (reported - expected position) if the report is
+        comparable to the model, None otherwise
+        :param agreed: called if the report has another state or title than
+        the model: whether the reports of all the publishers agree with it,
+        in which case it becomes the reference
+        """
+        if status not in (PlayerState.PLAYING, PlayerState.PAUSED):
+            return None
+        if self._anchor_position is None or self.title is None:
+            # first report: it becomes the reference
+            self.title = title
+            self.state = status
+            self._anchor(position, at)
+            self._changed()
+            return None
+        if at < self._settled_at:
+            return None
+        if status != self.state or title != self.title:
+            if agreed is not None and agreed():
+                self.sync_suggested(status, title, position, at)
+            return None
+        return position - self.position(at)
+
+    def sync_suggested(self, status, title, position, at):
+        """A publisher's play/pause/seek is authoritative for the room"""
+        self.title = title
+        self.state = status
+        self._anchor(position, at)
+        self._changed()
+
+    def needs_correction(self, drift, last_correction):
+        return (self.DRIFT_THRESHOLD and drift is not None
+                and abs(drift) > self.DRIFT_THRESHOLD
+                and time.time() - last_correction > self.CORRECTION_COOLDOWN)
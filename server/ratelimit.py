@@ -0,0 +1,131 @@
+"""Token buckets limiting how often clients can trigger room broadcasts
+
+Each kind of event has a bucket per client and a bucket per room, both of
+which must have a token for an event to go through. Events beyond the
+limits are dropped (see rate_limited()) or, for sync suggestions, handled
+as plain reports. Rejections are counted in datenight_rate_limited_total.
+
+Room buckets are per worker: with several workers, a room may get up to
+room_rate events per second on each of them.
+
+"""
+import functools
+import logging
+import time
+
+from flask import request
+from flask_socketio import emit
+
+from server import rooms
+from server.metrics import Counter
+
+log = logging.getLogger(__name__)
+
+rejections = Counter("datenight_rate_limited_total",
+                     "Socket.io events dropped by the rate limits",
+                     ("kind", "scope"))
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """False if there is no token left"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter:
+    """Limits for one kind of event, in events per second (0: no limit)
+
+    Bursts of up to BURST_WINDOW seconds worth of events are accepted.
+    """
+    BURST_WINDOW = 5  # seconds
+
+    def __init__(self, kind, rate, room_rate):
+        self.kind = kind
+        self.rate = rate  # per client
+        self.room_rate = room_rate
+        self._buckets = {}  # sid -> TokenBucket
+        self._warned = set()  # sids told to slow down, until accepted again
+        self._client_rejections = rejections.labels(kind, "client")
+        self._room_rejections = rejections.labels(kind, "room")
+        limiters.append(self)
+
+    def _new_bucket(self, rate):
+        return TokenBucket(rate, max(1, rate * self.BURST_WINDOW))
+
+    def allow(self, sid, room):
+        """Take a token for an event of sid, in room"""
+        if self.rate:
+            try:
+                bucket = self._buckets[sid]
+            except KeyError:
+                bucket = self._buckets[sid] = self._new_bucket(self.rate)
+            if not bucket.take():
+                self._client_rejections.inc()
+                return False
+        if self.room_rate:
+            try:
+                bucket = room.rate_buckets[self.kind]
+            except KeyError:
+                bucket = room.rate_buckets[self.kind] = self._new_bucket(
+                    self.room_rate)
+            if not bucket.take():
+                self._room_rejections.inc()
+                return False
+        self._warned.discard(sid)
+        return True
+
+    def warn(self, sid):
+        """Tell the client its events are dropped, once until one isn't"""
+        if sid in self._warned:
+            return
+        self._warned.add(sid)
+        log.info(f"{sid}: rate limited ({self.kind})")
+        emit("log_message",
+             {"data": f"Too many {self.kind} events, some were dropped"})
+
+    def forget(self, sid):
+        self._buckets.pop(sid, None)
+        self._warned.discard(sid)
+
+
+limiters = []
+chat = RateLimiter("chat", rate=1, room_rate=10)
+# pause/resume/seek requests and sync suggestions, relayed to every player
+commands = RateLimiter("command", rate=0.5, room_rate=2)
+
+
+def rate_limited(limiter):
+    """Drops the events of a socket.io handler beyond limiter's rates, to be
+    placed under @instrumented"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args):
+            if not limiter.allow(request.sid, rooms.room_of(request.sid)):
+                limiter.warn(request.sid)
+                return None
+            return handler(*args)
+
+        return wrapper
+
+    return decorator
+
+
+def forget(sid):
+    """Drop the buckets of a disconnected client"""
+    for limiter in limiters:
+        limiter.forget(sid)
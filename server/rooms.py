@@ -0,0 +1,392 @@
+import logging
+import time
+
+from server import subscribers_nick_presets, subscribers_color_presets
+from server.metrics import Gauge
+from server.playback import PlaybackClock
+from server.store import MemoryStore
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ROOM = "default"
+MAX_ROOM_ID_LENGTH = 64
+ROOMS_KEY = "rooms"  # ids of the rooms with shared state, see recover()
+
+_nick_presets = frozenset(subscribers_nick_presets)
+_color_presets = frozenset(subscribers_color_presets)
+
+
+class Room:
+    """A watch party: its own publishers, subscribers and playback state
+
+    Socket.io emits for a room target the room id, which every sid of the
+    room joins in both the /publish and /subscribe namespaces.
+
+    With several server workers, each worker has its own Room object holding
+    the publishers and subscribers connected to it, while what has to be
+    consistent across workers (nicks in use, the publisher/subscriber lists
+    sent to subscribers and their version, the playback clock) lives in the
+    shared store.
+
+    The room also keeps its recent chat lines and commands, replayed to
+    subscribers joining late: the last HISTORY_SIZE entries, each of at most
+    MAX_ENTRY_LENGTH characters, which bounds the memory used per room.
+
+    """
+    HISTORY_SIZE = 200
+    REPLAY_SIZE = 50  # entries sent at once
+    MAX_ENTRY_LENGTH = 500
+    RECONNECT_GRACE = 30  # seconds, see hold_departed()
+
+    def __init__(self, room_id, store):
+        self.id = room_id
+        self.store = store
+        self.publishers = {}  # sid -> Publisher, connected to this worker
+        self.subscribers = {}  # sid -> Subscriber, connected to this worker
+        # resume token -> Publisher, disconnected but which may come back
+        self.departed = {}  # see server.sessions
+
+        # subscribers get one snapshot, then versioned publisher patches
+        self._published = {}  # nick -> last dict_repr sent, our publishers
+        self.dirty_publishers = set()  # sids, see PublisherUpdateScheduler
+        self.rate_buckets = {}  # kind -> TokenBucket, see server.ratelimit
+        self.echoes_until = 0  # see SyncConsensus.commanded()
+        self._pools_filled = False  # see _fill_pools()
+        self._holds_released = False  # see release_expired_holds()
+
+        key = f"room:{room_id}"
+        self._nicks_key = f"{key}:nicks"
+        self._free_nicks_key = f"{key}:free_nicks"
+        self._free_colors_key = f"{key}:free_colors"
+        self._pools_key = f"{key}:pools"
+        self._publishers_key = f"{key}:publishers"
+        self._subscribers_key = f"{key}:subscribers"
+        self._version_key = f"{key}:version"
+        self._playback_key = f"{key}:playback"
+        self._history_key = f"{key}:history"
+        self._history_ids_key = f"{key}:history_ids"
+        self._held_key = f"{key}:held"
+        self._held_until_key = f"{key}:held_until"
+        self._changes_key = f"{key}:changes"
+        self._sessions_key = f"{key}:sessions"
+
+    # nicks are unique within a room, across workers. The preset nicks and
+    # colors nobody uses are kept in free pools, so that every operation is
+    # a constant number of set operations, whatever the size of the room
+    def _fill_pools(self):
+        if self._pools_filled:
+            return
+        if self.store.incr(self._pools_key) == 1:  # first use of the room
+            self.store.sadd(self._free_nicks_key, *subscribers_nick_presets)
+            self.store.sadd(self._free_colors_key,
+                            *subscribers_color_presets)
+        self._pools_filled = True
+
+    def claim_nick(self, nick):
+        """False if someone else has that nick already"""
+        if not self.store.sadd(self._nicks_key, nick):
+            return False
+        if nick in _nick_presets:
+            self._fill_pools()
+            self.store.srem(self._free_nicks_key, nick)
+        return True
+
+    def release_nick(self, nick):
+        self.store.srem(self._nicks_key, nick)
+        if nick in _nick_presets:
+            self.store.sadd(self._free_nicks_key, nick)
+
+    def allocate_nick(self):
+        """Claim a free preset nick, None if they are all taken"""
+        self._fill_pools()
+        while True:
+            nick = self.store.spop(self._free_nicks_key)
+            if nick is None or self.store.sadd(self._nicks_key, nick):
+                return nick
+            # else: claimed by a rename since it was released, try another
+
+    def allocate_color(self):
+        """A free preset color, None if they are all taken"""
+        self._fill_pools()
+        return self.store.spop(self._free_colors_key)
+
+    def release_color(self, color):
+        if color in _color_presets:
+            self.store.sadd(self._free_colors_key, color)
+
+    # sessions of the publishers which can resume them (see server.sessions),
+    # kept in the store to outlive a server restart
+    def save_session(self, publisher):
+        self.store.hset(self._sessions_key, publisher.resume_token, {
+            'nick': publisher.nick,
+            'ua': publisher.ua,
+            'wire_format': publisher.wire_format,
+        })
+
+    def forget_session(self, token):
+        self.store.hdel(self._sessions_key, token)
+
+    # after a server restart (see recover()), the subscribers of the previous
+    # run get their nick and color back if they reconnect in time, and the
+    # publishers their session
+    def hold_departed(self):
+        """Forget the clients of a previous server run, but hold the nicks
+        and colors of its subscribers for RECONNECT_GRACE seconds
+
+        Returns the sessions of its publishers (resume token -> session, with
+        their last published 'state'), which keep their nick and their place
+        in the publisher list, see server.views.publisher.restore_sessions()
+        """
+        publishers = self.publishers_snapshot()
+        sessions = {}
+        for token, session in self.store.hgetall(self._sessions_key).items():
+            state = publishers.pop(session['nick'], None)
+            if state is None:
+                self.forget_session(token)
+            else:
+                sessions[token] = {**session, 'state': state}
+        for nick in publishers:  # without a session
+            self.release_nick(nick)
+            self.store.hdel(self._publishers_key, nick)
+        for nick, subscriber in self.subscribers_snapshot().items():
+            self.store.hset(self._held_key, nick, subscriber['color'])
+        self.store.delete(self._subscribers_key)
+        self._changed()
+        self.store.set(self._held_until_key,
+                       time.time() + self.RECONNECT_GRACE)
+        return sessions
+
+    def restored(self, publisher, state):
+        """A publisher of a previous server run, as last published"""
+        self._published[publisher.nick] = state
+
+    def reclaim(self, nick):
+        """The color held for that nick, None if it isn't held (anymore)"""
+        self.release_expired_holds()
+        color = self.store.hgetall(self._held_key).get(nick)
+        if color is not None:
+            self.store.hdel(self._held_key, nick)
+        return color
+
+    def release_expired_holds(self):
+        if self._holds_released:
+            return
+        if time.time() < self.store.get(self._held_until_key, 0):
+            return
+        for nick, color in self.store.hgetall(self._held_key).items():
+            self.release_nick(nick)
+            self.release_color(color)
+        self.store.delete(self._held_key, self._held_until_key)
+        self._holds_released = True
+
+    @property
+    def playback(self):
+        def save(data):
+            self.store.set(self._playback_key, data)
+            self._changed()
+
+        return PlaybackClock.from_dict(
+            self.store.get(self._playback_key), on_change=save)
+
+    @property
+    def current_state(self):
+        return self.playback.state
+
+    # subscribers list
+    def subscribers_snapshot(self):
+        return self.store.hgetall(self._subscribers_key)
+
+    def subscriber_joined(self, subscriber):
+        self.store.hset(self._subscribers_key, subscriber.nick,
+                        subscriber.dict_repr())
+        self._changed()
+
+    def subscriber_left(self, nick):
+        self.store.hdel(self._subscribers_key, nick)
+        self._changed()
+
+    def subscriber_renamed(self, old_nick, subscriber):
+        self.store.hdel(self._subscribers_key, old_nick)
+        self.subscriber_joined(subscriber)
+
+    # versioned publishers list
+    @property
+    def publishers_version(self):
+        return self.store.get(self._version_key, 0)
+
+    def publishers_snapshot(self):
+        """Complete publisher list, as of (at least) publishers_version"""
+        return self.store.hgetall(self._publishers_key)
+
+    def _next_patch(self, **patch):
+        patch['version'] = self.store.incr(self._version_key)
+        self._changed()
+        return patch
+
+    # any change of the publishers, subscribers or playback, see
+    # server.snapshots
+    @property
+    def changes(self):
+        return self.store.get(self._changes_key, 0)
+
+    def _changed(self):
+        self.store.incr(self._changes_key)
+
+    def _publish(self, nick, data):
+        self._published[nick] = data
+        self.store.hset(self._publishers_key, nick, data)
+
+    def publisher_joined(self, publisher):
+        data = publisher.dict_repr()
+        self._publish(publisher.nick, data)
+        return self._next_patch(new=publisher.nick, old=None, data=data)
+
+    def publisher_left(self, nick):
+        self._published.pop(nick, None)
+        self.store.hdel(self._publishers_key, nick)
+        return self._next_patch(new=None, old=nick)
+
+    def publisher_renamed(self, old_nick, new_nick):
+        self.store.hdel(self._publishers_key, old_nick)
+        self._publish(new_nick, self._published.pop(old_nick))
+        return self._next_patch(new=new_nick, old=old_nick)
+
+    def publisher_updated(self, publisher, show=False):
+        """Patch with the fields that changed since the last patch
+
+        Returns None if there is nothing worth sending
+        """
+        current = publisher.dict_repr()
+        previous = self._published.get(publisher.nick, {})
+        changed = {k: v for k, v in current.items() if previous.get(k) != v}
+        if not changed and not show:
+            return None
+        self._publish(publisher.nick, current)
+        return self._next_patch(update=publisher.nick, data=changed, show=show)
+
+    # chat and commands history
+    def remember(self, data, nick=None, color=None):
+        """Add a log_message to the history (without its command timing)"""
+        entry = {'id': self.store.incr(self._history_ids_key),
+                 'ts': time.time(),
+                 'data': str(data)[:self.MAX_ENTRY_LENGTH]}
+        if nick is not None:
+            entry.update(nick=nick, color=color)
+        if self.store.rpush(self._history_key, entry) > self.HISTORY_SIZE:
+            self.store.ltrim(self._history_key, -self.HISTORY_SIZE, -1)
+
+    def history(self, before=None):
+        """The REPLAY_SIZE latest entries (older than the 'before' id), and
+        whether there are older ones"""
+        entries = self.store.lrange(self._history_key, 0, -1)
+        if before is not None:
+            entries = [e for e in entries if e['id'] < before]
+        page = entries[-self.REPLAY_SIZE:]
+        return page, len(entries) > len(page)
+
+    def is_empty(self):
+        """Nobody is connected to this worker, or expected back"""
+        return (not self.publishers and not self.subscribers
+                and not self.departed)
+
+    def forget_if_abandoned(self):
+        """Drop the shared state if nobody is connected to any worker"""
+        if (self.is_empty() and not self.publishers_snapshot()
+                and not self.subscribers_snapshot()):
+            self.store.delete(self._nicks_key, self._free_nicks_key,
+                              self._free_colors_key, self._pools_key,
+                              self._publishers_key, self._subscribers_key,
+                              self._version_key, self._playback_key,
+                              self._history_key, self._history_ids_key,
+                              self._held_key, self._held_until_key,
+                              self._changes_key, self._sessions_key)
+            self.store.srem(ROOMS_KEY, self.id)
+
+    def __repr__(self):
+        return (f"Room({self.id!r}, publishers={len(self.publishers)}, "
+                f"subscribers={len(self.subscribers)})")
+
+
+store = MemoryStore()  # see use_store()
+_recovered = False  # see recover()
+# room id -> Room
+rooms = {}
+# sid -> Room (sids are unique per namespace connection)
+sid_rooms = {}
+
+
+Gauge("datenight_room_publishers", "Publishers connected to this worker",
+      lambda: {(room.id,): len(room.publishers) for room in rooms.values()},
+      ("room",))
+Gauge("datenight_room_subscribers", "Subscribers connected to this worker",
+      lambda: {(room.id,): len(room.subscribers) for room in rooms.values()},
+      ("room",))
+
+
+def use_store(new_store):
+    """Share rooms with other server workers through new_store"""
+    global store
+    if rooms:
+        raise RuntimeError("Can't change the store once rooms exist")
+    store = new_store
+
+
+def recover():
+    """Adapt the rooms of a previous server run to their clients being gone
+
+    Called once, when the first client connects after a restart on a store
+    which kept the state of the previous run (see server.journal). Rooms keep
+    their playback state and history.
+    """
+    from server.views.publisher import restore_sessions  # needs the server
+    global _recovered
+    _recovered = True
+    for room_id in store.smembers(ROOMS_KEY):
+        log.info(f"Recovering room {room_id!r}")
+        room = Room(room_id, store)
+        sessions = room.hold_departed()
+        if sessions:  # held by this room object, until they expire
+            rooms[room_id] = room
+            restore_sessions(room, sessions)
+
+
+def room_id_from_request(args):
+    """Room id requested in the connect url (e.g. /subscribe?room=xyz)"""
+    room_id = args.get('room', '').strip()
+    if not room_id:
+        return DEFAULT_ROOM
+    return room_id[:MAX_ROOM_ID_LENGTH]
+
+
+def join(sid, room_id):
+    if sid in sid_rooms:
+        raise RuntimeError(f"{sid} joined a room twice.")
+    if store.recovered and not _recovered:
+        recover()
+    try:
+        room = rooms[room_id]
+    except KeyError:
+        log.info(f"Creating room {room_id!r}")
+        room = rooms[room_id] = Room(room_id, store)
+        store.sadd(ROOMS_KEY, room_id)
+    sid_rooms[sid] = room
+    return room
+
+
+def room_of(sid):
+    return sid_rooms[sid]
+
+
+def leave(sid):
+    """Forget about the sid, and about its room if nobody is left in it"""
+    room = sid_rooms.pop(sid, None)
+    if room is not None:
+        drop_if_empty(room)
+    return room
+
+
+def drop_if_empty(room):
+    if room.is_empty() and rooms.get(room.id) is room:
+        log.info(f"Removing empty room {room.id!r}")
+        del rooms[room.id]
+        room.forget_if_abandoned()
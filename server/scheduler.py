@@ -0,0 +1,54 @@
+import logging
+
+from server.helpers import emit_publisher_patches, run_periodically
+
+log = logging.getLogger(__name__)
+
+
+class PublisherUpdateScheduler:
+    """Coalesces publisher telemetry into one 'patch publishers' per tick
+
+    Publishers report their state about once a second and every pong updates
+    their latency. Instead of one broadcast per report, changed publishers
+    are marked dirty and a single flush loop emits one combined patch per
+    room every FLUSH_INTERVAL seconds. Updates which are meant to be seen
+    right away (show/suggest_sync) bypass the batch.
+
+    """
+    FLUSH_INTERVAL = 0.2  # seconds, 0 disables batching
+
+    def __init__(self):
+        self._dirty_rooms = set()
+        self._task = None
+
+    def schedule(self, room, publisher, *, immediate=False, show=False):
+        if immediate or not self.FLUSH_INTERVAL:
+            room.dirty_publishers.discard(publisher.sid)
+            emit_publisher_patches(
+                room, [room.publisher_updated(publisher, show)])
+            return
+
+        room.dirty_publishers.add(publisher.sid)
+        self._dirty_rooms.add(room)
+        if self._task is None:
+            log.info(f"Starting publisher update flush loop "
+                     f"(every {self.FLUSH_INTERVAL}s)")
+            self._task = run_periodically(
+                self.FLUSH_INTERVAL, self.flush,
+                "Failed to flush publisher updates")
+
+    def flush(self):
+        dirty_rooms, self._dirty_rooms = self._dirty_rooms, set()
+        for room in dirty_rooms:
+            dirty, room.dirty_publishers = room.dirty_publishers, set()
+            patches = []
+            for sid in dirty:
+                try:
+                    publisher = room.publishers[sid]
+                except KeyError:  # disconnected since
+                    continue
+                patches.append(room.publisher_updated(publisher))
+            emit_publisher_patches(room, patches)
+
+
+publisher_updates = PublisherUpdateScheduler()
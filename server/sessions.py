@@ -0,0 +1,73 @@
+"""Publisher sessions, resumable after their connection dropped
+
+Every publisher is given a resume token on connect (in a 'session' event).
+When its connection drops (rather than being closed by either side), a
+publisher which connected with a 'resume' key in its connect auth (None
+until it has a token) is kept in its room, as if still connected, for
+RESUME_GRACE seconds; the others, which can't resume, are released at once.
+If it reconnects in the meantime with {'resume': <token>} as its connect
+auth, it gets its nick, user agent and last state back, and the
+subscribers never see it leave. Tokens are single use: a new one comes with
+every session.
+
+Sessions are held by the worker the publisher was connected to, which a
+load balancer with sticky sessions sends it back to. They are also saved in
+the room's store (see Room.save_session()): after a restart on a journaled
+store, the sessions of the previous run are held again, as if every
+connection had just dropped, and their publishers keep their nick and
+their place in the publisher list (see rooms.recover()).
+
+"""
+import logging
+import secrets
+import time
+
+from server.helpers import run_periodically
+
+log = logging.getLogger(__name__)
+
+
+def new_token():
+    return secrets.token_urlsafe(16)
+
+
+class PublisherSessions:
+    RESUME_GRACE = 30  # seconds, 0 to never hold a publisher
+    SWEEP_INTERVAL = 1  # seconds
+
+    def __init__(self):
+        self._deadlines = {}  # token -> (deadline, room, release)
+        self._task = None
+
+    def hold(self, room, publisher, release):
+        """Keep a publisher whose connection dropped, until it resumes or
+        release(room, publisher) is called when its session expires"""
+        token = publisher.resume_token
+        room.departed[token] = publisher
+        self._deadlines[token] = (time.time() + self.RESUME_GRACE, room,
+                                  release)
+        if self._task is None:
+            self._task = run_periodically(
+                self.SWEEP_INTERVAL, self.expire,
+                "Failed to expire publisher sessions")
+
+    def resume(self, room, token):
+        """The held publisher of that token, None if it isn't (anymore)"""
+        publisher = room.departed.pop(token, None)
+        if publisher is not None:
+            del self._deadlines[token]
+        return publisher
+
+    def expire(self):
+        now = time.time()
+        expired = [token for token, (deadline, _, _)
+                   in self._deadlines.items() if deadline <= now]
+        for token in expired:
+            _, room, release = self._deadlines.pop(token)
+            publisher = room.departed.pop(token)
+            log.info(f"{publisher.nick} didn't resume its session in "
+                     f"{room.id!r}")
+            release(room, publisher)
+
+
+publisher_sessions = PublisherSessions()
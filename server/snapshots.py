@@ -0,0 +1,123 @@
+"""Read-only JSON snapshots of the rooms, for dashboards and other pollers
+
+A room's snapshot is its playback clock, publishers and subscribers, as of
+its version: the number of changes the room went through (see
+Room.changes). It is serialized once per version, however many pollers ask
+for it, and served with an ETag (the hash of its body) so that pollers can
+revalidate it for free.
+
+Pollers wanting to know about changes as soon as they happen ask to wait
+until the version differs from the one they have (?wait=<version>): the
+request is answered when it does, or after its timeout with the same
+snapshot. Waiting requests of a room share a version read every
+POLL_INTERVAL seconds.
+
+Playback positions are sent as an anchor (position at a server timestamp)
+and a rate, to be extrapolated by the pollers: the snapshot only changes
+when the room does.
+
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+from server import rooms, socketio
+
+log = logging.getLogger(__name__)
+
+
+class Snapshot:
+    __slots__ = ("version", "body", "etag")
+
+    def __init__(self, version, data):
+        self.version = version
+        self.body = json.dumps(data, separators=(",", ":")).encode()
+        self.etag = hashlib.sha256(self.body).hexdigest()[:16]
+
+
+class Snapshots:
+    WAIT_TIMEOUT = 25  # seconds, by default
+    MAX_WAIT = 60
+    POLL_INTERVAL = 0.1  # seconds, between version reads while waiting
+
+    def __init__(self):
+        self._cache = {}  # room id -> Snapshot
+        self._versions = {}  # room id -> (read at, version), see version()
+
+    def version(self, room_id):
+        """The room's version, as of at most POLL_INTERVAL seconds ago"""
+        now = time.monotonic()
+        try:
+            read_at, version = self._versions[room_id]
+            if now - read_at < self.POLL_INTERVAL:
+                return version
+        except KeyError:
+            pass
+        version = rooms.Room(room_id, rooms.store).changes
+        self._versions[room_id] = (now, version)
+        return version
+
+    def get(self, room_id):
+        """The current Snapshot of the room, None if it doesn't exist"""
+        room = rooms.Room(room_id, rooms.store)
+        version = room.changes
+        self._versions[room_id] = (time.monotonic(), version)
+        cached = self._cache.get(room_id)
+        if cached is not None and cached.version == version:
+            return cached
+        if room_id not in rooms.store.smembers(rooms.ROOMS_KEY):
+            self._forget(room_id)
+            return None
+        playback = room.playback.dict_repr()
+        del playback['settled_at']  # internal to drift corrections
+        if playback['anchor_position'] is None:  # no report yet
+            playback['anchor_ts'] = None
+        snapshot = self._cache[room_id] = Snapshot(version, {
+            'room': room_id,
+            'version': version,
+            'playback': playback,
+            'publishers': room.publishers_snapshot(),
+            'publishers_version': room.publishers_version,
+            'subscribers': room.subscribers_snapshot(),
+        })
+        return snapshot
+
+    def _forget(self, room_id):
+        self._cache.pop(room_id, None)
+        self._versions.pop(room_id, None)
+
+    def timeout(self, requested):
+        """Seconds to wait, given the requested timeout (None: default)"""
+        if requested is None:
+            return self.WAIT_TIMEOUT
+        return max(0, min(requested, self.MAX_WAIT))
+
+    def wait(self, room_id, version, timeout):
+        """Until the room's version differs from version, or timeout"""
+        deadline = time.monotonic() + timeout
+        while (self.version(room_id) == version
+               and time.monotonic() < deadline):
+            socketio.sleep(self.POLL_INTERVAL)
+
+    async def wait_async(self, room_id, version, timeout):
+        """wait(), on the asyncio engine"""
+        deadline = time.monotonic() + timeout
+        while (self.version(room_id) == version
+               and time.monotonic() < deadline):
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+
+snapshots = Snapshots()
+
+
+def wait_args(args):
+    """(version, timeout) to wait for, from the query string of a snapshot
+    request, None if it doesn't wait. Raises ValueError if they are invalid
+    """
+    if args.get('wait') is None:
+        return None
+    timeout = args.get('timeout')
+    return (int(args['wait']),
+            snapshots.timeout(None if timeout is None else float(timeout)))
@@ -15,7 +15,9 @@ function initialize() {
 function websock() {
   const namespace = '/publish';
   const protocol = window.location.protocol;
-  let socket = io.connect(protocol + '//' + document.domain + ':' + location.port + namespace);
+  const room = new URLSearchParams(window.location.search).get("room");
+  let socket = io.connect(protocol + '//' + document.domain + ':' + location.port + namespace,
+                          {query: room ? {room: room} : {}, transports: transports});
 
   socket.on('connect', function() {
     add_to_log("Connected...");
@@ -72,7 +74,12 @@ function websock() {
   });
 
   socket.on('latency_ping', function(msg) {
-    socket.emit('latency_pong', {'token': msg.token});
+    const received_ts = Date.now() / 1000;
+    socket.emit('latency_pong', {
+      'token': msg.token,
+      't1': received_ts,
+      't2': Date.now() / 1000,
+    });
   });
 
   document.getElementById("send-play-state").onclick = function() {
@@ -7,6 +7,10 @@ window.onload = initialize;
 var nick = null;
 var color = null;
 var current_state = null;
+var publishers = {};
+var publishers_version = null;
+var oldest_history_id = null;  // to page the room's history backward
+var more_history = false;
 
 
 function initialize() {
@@ -78,10 +82,63 @@ function update_state(new_state) {
 }
 
 
+function apply_publisher_patch(patch) {
+  if (patch.old && patch.new) {
+    publishers[patch.new] = publishers[patch.old];
+    delete publishers[patch.old];
+    add_to_log('Publisher "' + patch.old + '" has changed nick to "' + patch.new + '"');
+  } else if (patch.new) {
+    publishers[patch.new] = patch.data;
+    add_to_log('Publisher "' + patch.new + '" has joined.');
+  } else if (patch.old) {
+    delete publishers[patch.old];
+    add_to_log('Publisher "' + patch.old + '" has left.');
+  } else if (patch.update) {
+    Object.assign(publishers[patch.update], patch.data);
+    if (patch.show) {
+      const relevant = publishers[patch.update];
+      add_to_log('Publisher "' + patch.update + '" updated state. (' + JSON.stringify(relevant) + ')');
+    }
+  } else {
+    add_to_log('Error - Invalid data :(');
+  }
+}
+
+
+function render_publishers() {
+  let html_items = "<br/>";
+  for (let x in publishers) {
+    if (!publishers.hasOwnProperty(x)) {
+      continue;
+    }
+    html_items += x + ": " + JSON.stringify(publishers[x]) + "<br/>";
+  }
+
+  let publishers_element = document.getElementById("publishers_info");
+  publishers_element.innerHTML = 'Connected publishers: ' + html_items;
+}
+
+
+function countdown(seconds) {
+  const whole = Math.floor(seconds);
+  // align the ticks on the command's execution time
+  setTimeout(function tick(remaining) {
+    if (remaining > 0) {
+      add_to_log(remaining + "...");
+      setTimeout(tick, 1000, remaining - 1);
+    } else {
+      add_to_log("Now!");
+    }
+  }, (seconds - whole) * 1000, whole);
+}
+
+
 function websock() {
   const namespace = '/subscribe';
   const protocol = window.location.protocol;
-  let socket = io.connect(protocol + '//' + document.domain + ':' + location.port + namespace);
+  const room = new URLSearchParams(window.location.search).get("room");
+  let socket = io.connect(protocol + '//' + document.domain + ':' + location.port + namespace,
+                          {query: room ? {room: room} : {}, transports: transports});
 
   socket.on('connect', function() {
     add_to_log("Connected...");
@@ -108,10 +165,28 @@ function websock() {
     if (msg.state) {  // happens after a state is toggled
       update_state(msg.state);
     }
+
+    if (msg.in >= 1) {  // the command is scheduled, count down to it
+      countdown(msg.in);
+    }
+  });
+
+  socket.on('history', function(msg) {
+    // recent chat and commands of the room, newest first
+    for (const entry of msg.entries.slice().reverse()) {
+      const text = entry.nick ? entry.nick + ': ' + entry.data : entry.data;
+      add_to_log(text, entry.color, new Date(entry.ts * 1000), true);
+    }
+    if (msg.entries.length) {
+      oldest_history_id = msg.entries[0].id;
+    }
+    more_history = msg.more;
   });
 
   socket.on('nick change', function(msg) {
     update_nick(msg.old, msg.new, msg.color);
+    // to get it back when reconnecting after a server restart
+    socket.io.opts.query = Object.assign({}, socket.io.opts.query, {nick: nick});
     update_subscription_list(msg.complete);
   });
 
@@ -130,36 +205,35 @@ function websock() {
   });
 
   socket.on('update publishers', function(msg) {
-    let html_items = "<br/>";
-    const data = msg.data;
-    for (let x in data) {
-      if (!data.hasOwnProperty(x)) {
-        continue;
-      }
-      html_items += x + ": " + JSON.stringify(data[x]) + "<br/>";
-    }
-
-    if (msg.old && msg.new) {
-      add_to_log('Publisher "' + msg.old + '" has changed nick to "' + msg.new + '"');
-    } else if (msg.new) {
-      add_to_log('Publisher "' + msg.new + '" has joined.');
-    } else if (msg.old) {
-      add_to_log('Publisher "' + msg.old + '" has left.');
-    } else if (msg.update) {
-      if (msg.show) {
-        const relevant = msg.data[msg.update];
-        add_to_log('Publisher "' + msg.update + '" updated state. (' + JSON.stringify(relevant) + ')');
-      }
-    } else {
-      // got full data with no nick change, probably on initial connect
-      add_to_log('Received complete publisher list.');
-    }
+    // complete snapshot: on initial connection, or after a resync
+    publishers = msg.data;
+    publishers_version = msg.version;
+    add_to_log('Received complete publisher list.');
 
     if (msg.state) {  // happens on initial connnection
       update_state(msg.state);
     }
-    let publishers_element = document.getElementById("publishers_info");
-    publishers_element.innerHTML = 'Connected publishers: ' + html_items;
+    render_publishers();
+  });
+
+  socket.on('patch publishers', function(msg) {
+    if (publishers_version === null) {
+      return;  // snapshot not received yet, it will include these patches
+    }
+    for (const patch of msg.patches) {
+      if (patch.version <= publishers_version) {
+        continue;  // already included in the snapshot
+      }
+      if (patch.version != publishers_version + 1) {
+        console.log("publishers version gap, requesting a resync...");
+        publishers_version = null;
+        socket.emit("resync publishers", null);
+        return;
+      }
+      apply_publisher_patch(patch);
+      publishers_version = patch.version;
+    }
+    render_publishers();
   });
 
   document.getElementById("send-broadcast").onclick = function() {
@@ -171,6 +245,13 @@ function websock() {
       socket.emit("help", null, function(msg) {
         document.getElementById("broadcast-data").value = "";
       });
+    } else if (content.startsWith('/history')) {
+      document.getElementById("broadcast-data").value = "";
+      if (!more_history) {
+        add_to_log("No older history.");
+      } else {
+        socket.emit("history", {before: oldest_history_id});
+      }
     } else if (content.startsWith('/nick ')) {
       const new_nick = content.substring("/nick ".length);
       socket.emit("change nick", {new: new_nick}, function(msg) {
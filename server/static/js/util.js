@@ -1,10 +1,12 @@
 /*jshint esversion: 6 */
-function add_to_log(text, color) {
+function add_to_log(text, color, date, older) {
+  // date: when it happened (now by default)
+  // older: below everything already logged (e.g. history), instead of above
   'use strict';
   let log_element = document.getElementById("log");
 
   // handle timestamp
-  const now = new Date();
+  const now = date || new Date();
   // const timestamp = now.toLocaleString('sv-SE');
   // const timestamp = now.getHours() + ':' + now.getMinutes() + ':' + now.getSeconds();
   const time_string = now.toTimeString();
@@ -24,6 +26,10 @@ function add_to_log(text, color) {
   }
   newElement.appendChild(textSpan);
 
-  // prepend
-  log_element.prepend(newElement);
+  // newest first
+  if (older) {
+    log_element.append(newElement);
+  } else {
+    log_element.prepend(newElement);
+  }
 }
@@ -0,0 +1,324 @@
+"""State shared by all the server workers (see run_server.py --workers)
+
+The interface mimics a small subset of redis: plain values, sets and hashes,
+all holding json-serializable data. MemoryStore is used when running a
+single worker, FileStore is a stand-in which lets workers of a single host
+share their state without any external service.
+
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import urllib.parse
+
+log = logging.getLogger(__name__)
+
+
+class Store:
+    recovered = False  # holds the state of a previous run, see server.journal
+
+    def get(self, key, default=None):
+        raise NotImplementedError("Please use a subclass")
+
+    def set(self, key, value):
+        raise NotImplementedError("Please use a subclass")
+
+    def delete(self, *keys):
+        raise NotImplementedError("Please use a subclass")
+
+    def incr(self, key):
+        """Increment an integer value (0 if missing), return the result"""
+        raise NotImplementedError("Please use a subclass")
+
+    def sadd(self, key, *members):
+        """Returns how many members weren't in the set already"""
+        raise NotImplementedError("Please use a subclass")
+
+    def srem(self, key, member):
+        raise NotImplementedError("Please use a subclass")
+
+    def spop(self, key):
+        """Remove and return an arbitrary member, None if the set is empty"""
+        raise NotImplementedError("Please use a subclass")
+
+    def smembers(self, key):
+        raise NotImplementedError("Please use a subclass")
+
+    def rpush(self, key, value):
+        """Append to a list, return its length"""
+        raise NotImplementedError("Please use a subclass")
+
+    def ltrim(self, key, start, stop):
+        """Keep list[start:stop + 1] (stop is inclusive, -1 is the end)"""
+        raise NotImplementedError("Please use a subclass")
+
+    def lrange(self, key, start, stop):
+        """list[start:stop + 1] (stop is inclusive, -1 is the end)"""
+        raise NotImplementedError("Please use a subclass")
+
+    def hset(self, key, field, value):
+        raise NotImplementedError("Please use a subclass")
+
+    def hdel(self, key, field):
+        raise NotImplementedError("Please use a subclass")
+
+    def hgetall(self, key):
+        raise NotImplementedError("Please use a subclass")
+
+
+class MemoryStore(Store):
+    """In-process store, only correct with a single worker"""
+
+    def __init__(self):
+        self._values = {}
+        self._sets = {}
+        self._lists = {}
+        self._hashes = {}
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        self._values[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self._values.pop(key, None)
+            self._sets.pop(key, None)
+            self._lists.pop(key, None)
+            self._hashes.pop(key, None)
+
+    def incr(self, key):
+        self._values[key] = self._values.get(key, 0) + 1
+        return self._values[key]
+
+    def sadd(self, key, *members):
+        current = self._sets.setdefault(key, set())
+        size = len(current)
+        current.update(members)
+        return len(current) - size
+
+    def srem(self, key, member):
+        self._sets.get(key, set()).discard(member)
+
+    def spop(self, key):
+        try:
+            return self._sets.get(key, set()).pop()
+        except KeyError:
+            return None
+
+    def smembers(self, key):
+        return set(self._sets.get(key, ()))
+
+    @staticmethod
+    def _slice(start, stop):
+        return slice(start, None if stop == -1 else stop + 1)
+
+    def rpush(self, key, value):
+        values = self._lists.setdefault(key, [])
+        values.append(value)
+        return len(values)
+
+    def ltrim(self, key, start, stop):
+        if key in self._lists:
+            self._lists[key] = self._lists[key][self._slice(start, stop)]
+
+    def lrange(self, key, start, stop):
+        return self._lists.get(key, [])[self._slice(start, stop)]
+
+    def hset(self, key, field, value):
+        self._hashes.setdefault(key, {})[field] = value
+
+    def hdel(self, key, field):
+        self._hashes.get(key, {}).pop(field, None)
+
+    def hgetall(self, key):
+        return dict(self._hashes.get(key, {}))
+
+
+class FileStore(MemoryStore):
+    """Local file stand-in for a shared store, for workers on a single host
+
+    Every operation locks the file, reloads it if another worker changed it,
+    and writes it back if it was modified. Fine for testing, not for load.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self._path = path
+        self._loaded_version = None
+
+    @contextlib.contextmanager
+    def _locked(self, write):
+        with open(self._path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            try:
+                self._reload()
+                yield
+                if write:
+                    self._dump()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _reload(self):
+        try:
+            version = self._file_version()
+        except FileNotFoundError:
+            self._values, self._sets, self._lists, self._hashes = (
+                {}, {}, {}, {})
+            self._loaded_version = None
+            return
+        if version == self._loaded_version:
+            return
+        with open(self._path) as f:
+            data = json.load(f)
+        self._values = data['values']
+        self._sets = {k: set(v) for k, v in data['sets'].items()}
+        self._lists = data['lists']
+        self._hashes = data['hashes']
+        self._loaded_version = version
+
+    def _dump(self):
+        tmp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                'values': self._values,
+                'sets': {k: list(v) for k, v in self._sets.items()},
+                'lists': self._lists,
+                'hashes': self._hashes,
+            }, f)
+        os.replace(tmp_path, self._path)
+        self._loaded_version = self._file_version()
+
+    def _file_version(self):
+        # the file is replaced on every write, so the inode changes too
+        st = os.stat(self._path)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def get(self, key, default=None):
+        with self._locked(write=False):
+            return super().get(key, default)
+
+    def set(self, key, value):
+        with self._locked(write=True):
+            super().set(key, value)
+
+    def delete(self, *keys):
+        with self._locked(write=True):
+            super().delete(*keys)
+
+    def incr(self, key):
+        with self._locked(write=True):
+            return super().incr(key)
+
+    def sadd(self, key, *members):
+        with self._locked(write=True):
+            return super().sadd(key, *members)
+
+    def srem(self, key, member):
+        with self._locked(write=True):
+            super().srem(key, member)
+
+    def spop(self, key):
+        with self._locked(write=True):
+            return super().spop(key)
+
+    def smembers(self, key):
+        with self._locked(write=False):
+            return super().smembers(key)
+
+    def rpush(self, key, value):
+        with self._locked(write=True):
+            return super().rpush(key, value)
+
+    def ltrim(self, key, start, stop):
+        with self._locked(write=True):
+            super().ltrim(key, start, stop)
+
+    def lrange(self, key, start, stop):
+        with self._locked(write=False):
+            return super().lrange(key, start, stop)
+
+    def hset(self, key, field, value):
+        with self._locked(write=True):
+            super().hset(key, field, value)
+
+    def hdel(self, key, field):
+        with self._locked(write=True):
+            super().hdel(key, field)
+
+    def hgetall(self, key):
+        with self._locked(write=False):
+            return super().hgetall(key)
+
+
+class RedisStore(Store):
+    """Needs the redis module (pip install redis)"""
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key, default=None):
+        value = self._redis.get(key)
+        return default if value is None else json.loads(value)
+
+    def set(self, key, value):
+        self._redis.set(key, json.dumps(value))
+
+    def delete(self, *keys):
+        if keys:
+            self._redis.delete(*keys)
+
+    def incr(self, key):
+        return self._redis.incr(key)
+
+    def sadd(self, key, *members):
+        return self._redis.sadd(key, *(json.dumps(m) for m in members))
+
+    def srem(self, key, member):
+        self._redis.srem(key, json.dumps(member))
+
+    def spop(self, key):
+        member = self._redis.spop(key)
+        return None if member is None else json.loads(member)
+
+    def smembers(self, key):
+        return {json.loads(m) for m in self._redis.smembers(key)}
+
+    def rpush(self, key, value):
+        return self._redis.rpush(key, json.dumps(value))
+
+    def ltrim(self, key, start, stop):
+        self._redis.ltrim(key, start, stop)
+
+    def lrange(self, key, start, stop):
+        return [json.loads(v) for v in self._redis.lrange(key, start, stop)]
+
+    def hset(self, key, field, value):
+        self._redis.hset(key, field, json.dumps(value))
+
+    def hdel(self, key, field):
+        self._redis.hdel(key, field)
+
+    def hgetall(self, key):
+        return {k.decode(): json.loads(v)
+                for k, v in self._redis.hgetall(key).items()}
+
+
+def open_store(url):
+    """memory, file:///path/to/file.json, journal:///path/to/directory or
+    redis://host:port/db"""
+    if url == "memory":
+        return MemoryStore()
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        return FileStore(parsed.path)
+    if parsed.scheme == "journal":
+        from server.journal import JournalStore
+        return JournalStore(parsed.path)
+    if parsed.scheme in ("redis", "rediss"):
+        return RedisStore(url)
+    raise ValueError(f"Unsupported store: {url}")
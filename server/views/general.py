@@ -1,11 +1,16 @@
 import logging
 
-from flask import render_template, request
+from flask import Response, abort, render_template, request, url_for
 
 from server import app, socketio
+from server import assets, metrics, rooms
+from server.snapshots import snapshots, wait_args
 
 log = logging.getLogger(__name__)
 
+# fingerprinted url path -> Asset, static filename -> fingerprinted url path
+_assets, _asset_urls = assets.load(app.static_folder)
+
 
 @app.route('/')
 def index():
@@ -17,6 +22,64 @@ def client():
     return render_template('client.html')
 
 
+@app.template_global()
+def asset_url(filename):
+    """Fingerprinted url of a static file, see server.assets"""
+    return url_for('asset', path=_asset_urls[filename])
+
+
+@app.route('/assets/<path:path>')
+def asset(path):
+    try:
+        static = _assets[path]
+    except KeyError:
+        abort(404)
+    encoding = static.negotiate(request.accept_encodings)
+    etag = static.etag(encoding)
+    headers = {'Cache-Control': assets.CACHE_CONTROL, 'ETag': f'"{etag}"',
+               'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    if encoding != "identity":
+        headers['Content-Encoding'] = encoding
+    return Response(static.variants[encoding], mimetype=static.mimetype,
+                    headers=headers)
+
+
+@app.route('/api/rooms')
+def api_rooms():
+    return {'rooms': sorted(rooms.store.smembers(rooms.ROOMS_KEY))}
+
+
+@app.route('/api/rooms/<room_id>')
+def api_room(room_id):
+    """The room's snapshot, see server.snapshots"""
+    try:
+        wait = wait_args(request.args)
+    except ValueError:
+        abort(400)
+    snapshot = snapshots.get(room_id)
+    if snapshot is None:
+        abort(404)
+    # the asyncio engine waited already, it can't sleep in a view
+    if (wait is not None and snapshot.version == wait[0]
+            and socketio.async_mode != 'aiohttp'):
+        snapshots.wait(room_id, *wait)
+        snapshot = snapshots.get(room_id)
+        if snapshot is None:
+            abort(404)
+    headers = {'Cache-Control': 'no-cache', 'ETag': f'"{snapshot.etag}"'}
+    if request.if_none_match.contains_weak(snapshot.etag):
+        return Response(status=304, headers=headers)
+    return Response(snapshot.body, mimetype='application/json',
+                    headers=headers)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @socketio.on_error_default
 def default_error_handler(e):
     log.critical(request.event["message"])
@@ -3,110 +3,159 @@ import random
 import time
 import json
 
-import eventlet
 from flask import request
-from flask_socketio import emit, disconnect
+from flask_socketio import emit, disconnect, join_room
 
-from server import socketio, publishers, subscribers
+from server import socketio, rooms
 from server import PlayerState
-from server.helpers import clean_publishers
+from server import ratelimit
+from server import wire
+from server.helpers import emit_publisher_patches, command_timing
+from server.clock import ClockEstimator
+from server.consensus import Suggestion, sync_consensus
+from server.heartbeat import heartbeat
+from server.metrics import fanout, heartbeat_rtt, instrumented
+from server.scheduler import publisher_updates
+from server.sessions import new_token, publisher_sessions
 from . import SyncSuggestion
 
 log = logging.getLogger(__name__)
 
+_suggestions_fanout = fanout.labels('sync suggestion')
+
 
 class Publisher:
-    PING_DELAY = 5
-    TIMEOUT_THRESHOLD = 12
+    # how far the time of a reported position may be from the time the
+    # report was sent, in seconds, before the latter is used instead
+    MAX_ANCHOR_SKEW = 10
 
-    def __init__(self, sid, nick):
+    def __init__(self, sid, nick, room):
         self.__sid = sid
+        self.room = room
         self.ua = "unknown"
         self.nick = nick
         self.latency = -1
         self.status = PlayerState.UNKNOWN.value
-        self.position = -1
+        self.position = -1  # as of position_ts, see position_at()
+        self.position_ts = None  # server time
+        self.rate = 1.0
         self.length = -1
         self.title = ""
+        self.clock = ClockEstimator()
+        self.last_correction = 0  # see correct_drift()
+        self.wire_format = wire.JSON  # of its reports, see set_ua()
+        self.resume_token = new_token()  # see server.sessions
+        # whether its client resumes sessions, see connect_publisher()
+        self.resumable = False
         self.__ping_token = None
         self.__ping_ts = None
-        self.__heartbeat = eventlet.greenthread.spawn_n(self.__ping)
-        self.__timeout = eventlet.greenthread.spawn_after(
-            self.TIMEOUT_THRESHOLD, self.__process_timeout)
 
-    def __ping(self):
-        log.debug(f"{self.__sid}: ping request")
+    def resumed(self, sid):
+        """Its session was resumed by a new connection"""
+        self.__sid = sid
+        self.resume_token = new_token()
+        self.__ping_token = None
+
+    def ping(self):
+        """Called by the heartbeat service"""
+        log.debug("%s: ping request", self.__sid)
         self.__ping_token = random.randint(1, 10000000)
         self.__ping_ts = time.time()
-        socketio.emit('latency_ping', {"token": self.__ping_token},
+        # offset: our current estimate, for clients to schedule commands
+        socketio.emit('latency_ping',
+                      {"token": self.__ping_token, "ts": self.__ping_ts,
+                       "offset": self.clock.offset},
                       namespace='/publish', room=self.__sid)
-        self.__heartbeat = eventlet.greenthread.spawn_after(self.PING_DELAY,
-                                                            self.__ping)
 
-    def __process_timeout(self):
-        log.info(
-            "{}: no ping reply in {} seconds, setting latency to -1".format(
-                self.__sid, self.TIMEOUT_THRESHOLD))
+    def timed_out(self, silence):
+        """Called by the heartbeat service"""
+        if self.latency == -1:
+            return
+        log.info(f"{self.__sid}: no ping reply in {silence:.0f} seconds, "
+                 f"setting latency to -1")
         self.latency = -1
-        self.__timeout = eventlet.greenthread.spawn_after(
-            self.TIMEOUT_THRESHOLD, self.__process_timeout)
-        socketio.emit('update publishers',
-                      {'data': clean_publishers(), 'update': self.nick,
-                       'show': False}, namespace='/subscribe', broadcast=True)
-
-    def pong(self, token):
-        log.debug(f"{self.__sid}: pong received")
+        publisher_updates.schedule(self.room, self)
+
+    def pong(self, token, received_ts=None, sent_ts=None):
+        """:param received_ts: client time at which the ping was received
+        :param sent_ts: client time at which the pong was sent
+
+        """
+        pong_ts = time.time()
+        log.debug("%s: pong received", self.__sid)
         if not self.__ping_token == token:
             log.warning(f"{self.__sid}: Invalid token, ignoring...")
             return
-        self.latency = round(time.time() - self.__ping_ts, 3)
-        socketio.emit('update publishers',
-                      {'data': clean_publishers(), 'update': self.nick,
-                       'show': False}, namespace='/subscribe', broadcast=True)
-
-        # reset timeout
-        self.__timeout.cancel()
-        self.__timeout = eventlet.greenthread.spawn_after(
-            self.TIMEOUT_THRESHOLD, self.__process_timeout)
+        self.__ping_token = None  # each ping makes for a single sample
+        self.latency = round(pong_ts - self.__ping_ts, 3)
+        heartbeat_rtt.observe(self.latency)
+        self.clock.add_sample(self.__ping_ts, pong_ts, received_ts, sent_ts)
+        heartbeat.alive(self.__sid)
+        publisher_updates.schedule(self.room, self)
+
+    @property
+    def sid(self):
+        return self.__sid
+
+    def anchored(self, position, at, rate=None):
+        """A reported position, as of server time 'at'"""
+        self.position = position
+        self.position_ts = at
+        if isinstance(rate, (int, float)) and rate > 0:
+            self.rate = rate
+
+    def position_at(self, at=None):
+        """Where the player is at server time 'at' (now by default),
+        extrapolated from its last reported position"""
+        if (self.status != PlayerState.PLAYING.value
+                or self.position_ts is None
+                or not isinstance(self.position, (int, float))):
+            return self.position
+        at = time.time() if at is None else at
+        return round(self.position + (at - self.position_ts) * self.rate, 1)
 
     def dict_repr(self):
         """Don't expose private data, this is sent over the wire"""
         return {
             'status': self.status,
-            'position': f'{self.position}/{self.length}',
+            'position': f'{self.position_at()}/{self.length}',
             'latency': self.latency,
             'title': self.title,
             'ua': self.ua,
+            **self.clock.dict_repr(),
         }
 
-    def remove_timeouts(self):
-        log.info(f"Removing timers from {self.__sid}")
-        self.__heartbeat.cancel()
-        self.__timeout.cancel()
-
     def __repr__(self):
         return json.dumps(self.dict_repr())
 
-    def __del__(self):
-        self.remove_timeouts()
-
 
 # publish
 @socketio.on('connect', namespace='/publish')
-def connect_publisher():
-    log.info(f"Connecting publisher {request.sid}")
-    other_publisher_nicks = {z.nick for z in publishers.values()}
-    other_nicks = other_publisher_nicks.union(
-        {z.nick for z in subscribers.values()})
+@instrumented
+def connect_publisher(auth=None):
+    room_id = rooms.room_id_from_request(request.args)
+    log.info(f"Connecting publisher {request.sid} to room {room_id!r}")
+    room = rooms.join(request.sid, room_id)
+    publishers = room.publishers
 
     if request.sid in publishers:
         raise RuntimeError(f"{request.sid} (publisher) Connected twice.")
+    # clients resuming sessions always send a 'resume' key, None (or their
+    # expired token) when there is nothing to resume
+    resumable = isinstance(auth, dict) and 'resume' in auth
+    if resumable and auth['resume']:
+        publisher = publisher_sessions.resume(room, auth['resume'])
+        if publisher is not None:
+            return resume_publisher(room, publisher)
     for i in range(10):
         x = str(random.randint(1, 10000))
-        if x not in other_nicks:
-            publishers[request.sid] = Publisher(sid=request.sid, nick=x)
-            other_publisher_nicks.add(x)
-            other_nicks.add(x)
+        if room.claim_nick(x):
+            publishers[request.sid] = Publisher(
+                sid=request.sid, nick=x, room=room)
+            publishers[request.sid].resumable = resumable
+            heartbeat.add(publishers[request.sid])
+            if resumable:
+                room.save_session(publishers[request.sid])
             break
     else:
         log.info("Couldn't assign a nick, disconnecting the publisher...")
@@ -114,111 +163,217 @@ def connect_publisher():
              {"data": "Failed to assign you a nick", "fatal": True})
         return
 
+    join_room(room.id)
     log.info(f"A publisher just connected (id={request.sid}, nick={x})"
-             f" - total publishers: {len(publishers)}")
-    emit('update publishers',
-         {'data': clean_publishers(), 'new': x, 'old': None},
-         namespace='/subscribe', broadcast=True)
+             f" - total publishers in {room.id!r}: {len(publishers)}")
+    emit('session', {'token': publishers[request.sid].resume_token,
+                     'resumed': False})
+    emit_publisher_patches(
+        room, [room.publisher_joined(publishers[request.sid])])
+    return True
+
+
+def resume_publisher(room, publisher):
+    """Reattach a held publisher (see server.sessions) to this connection,
+    without telling the subscribers, for which it never left"""
+    room.forget_session(publisher.resume_token)
+    publisher.resumed(request.sid)
+    room.save_session(publisher)
+    room.publishers[request.sid] = publisher
+    heartbeat.add(publisher)
+    join_room(room.id)
+    log.info(f"{publisher.nick} resumed its session (id={request.sid})"
+             f" - total publishers in {room.id!r}: {len(room.publishers)}")
+    emit('session', {'token': publisher.resume_token, 'resumed': True,
+                     'nick': publisher.nick,
+                     'wire_format': publisher.wire_format})
     return True
 
 
 @socketio.on('update state', namespace='/publish')
+@instrumented
 def message_trigger(message):
-    log.info(f"Publisher state updated: {message}")
-    nick = publishers[request.sid].nick
-    # TODO: accept partial updates
-    try:
-        status = message['status']
-        title = message['title']
-        position = message['position']
-        length = message['length']
-        show = message.get('show', False)
-        suggest_sync = message.get('suggest_sync', None)
-    except KeyError as e:
-        msg = f"Received missing data: {e}"
-        log.error(msg)
-        emit('log_message', {'data': msg}, namespace='/publish',
-             broadcast=False)
+    received_ts = time.time()
+    room = rooms.room_of(request.sid)
+    publisher = room.publishers[request.sid]
+    if isinstance(message, bytes):
+        try:
+            message = wire.decode_state(message)
+        except ValueError as e:
+            log.error(f"{request.sid}: {e}")
+            emit('log_message', {'data': str(e)})
+            return False
+    log.info("Publisher state updated: %s", message)
+    if not isinstance(message, dict):
+        emit('log_message', {'data': "Received a bad report"})
         return False
-    else:
+    # reports only have the fields which changed since the previous one,
+    # and a position when the player isn't where it was expected to be
+    show = message.get('show', False)
+    suggest_sync = message.get('suggest_sync', None)
+    if suggest_sync and not ratelimit.commands.allow(request.sid, room):
+        # still a valid report, which may get the publisher corrected
+        ratelimit.commands.warn(request.sid)
+        show, suggest_sync = False, None
+    if 'status' in message:
         try:
-            publishers[request.sid].status = PlayerState(status).value
+            publisher.status = PlayerState(message['status']).value
         except ValueError:
-            msg = f"Received bad state: {status}"
+            msg = f"Received bad state: {message['status']}"
             log.error(msg)
             emit('log_message', {'data': msg})
-            publishers[request.sid].status = PlayerState.UNKNOWN.value
+            publisher.status = PlayerState.UNKNOWN.value
             return False
-        else:
-            publishers[request.sid].title = title
-            publishers[request.sid].position = position
-            publishers[request.sid].length = length
-
-        emit('update publishers',
-             {'data': clean_publishers(), 'update': nick, 'show': show},
-             namespace='/subscribe', broadcast=True)
+    if 'title' in message:
+        publisher.title = message['title']
+    if 'length' in message:
+        publisher.length = message['length']
+    reported_at = publisher.clock.sent_at(received_ts)
+    if 'position' in message:
+        at = message.get('at')
+        if (isinstance(at, (int, float))
+                and abs(at - reported_at) <= publisher.MAX_ANCHOR_SKEW):
+            reported_at = at
+        publisher.anchored(message['position'], reported_at,
+                           message.get('rate'))
+
+    publisher_updates.schedule(room, publisher,
+                               immediate=show or bool(suggest_sync),
+                               show=show)
+
+    position = publisher.position_at(reported_at)
+    if not isinstance(position, (int, float)):
+        return  # e.g. nothing playing
+    status = PlayerState(publisher.status)
+    if suggest_sync:
+        try:
+            kind = SyncSuggestion(suggest_sync)
+        except ValueError:
+            msg = f"Received bad suggest_sync: {suggest_sync}"
+            log.error(msg)
+            emit('log_message', {'data': msg})
+            return False
+        suggestion = Suggestion(request.sid, publisher.nick, kind, status,
+                                publisher.title, position, reported_at)
+        if sync_consensus.suggest(room, suggestion,
+                                  broadcast_sync_suggestion):
+            return
+    if 'position' in message:
+        correct_drift(room, publisher, status, position, reported_at)
 
-        if suggest_sync:
-            broadcast_sync_suggestion(
-                suggest_sync, PlayerState(status), position)
 
+def correct_drift(room, publisher, status: PlayerState, position,
+                  reported_at):
+    """Seek a publisher which drifted from the room's playback clock
 
-def broadcast_sync_suggestion(
-        suggest_sync: bool, status: PlayerState, position: int):
-    requester_nick = publishers[request.sid].nick
+    Only this publisher receives the seek, the rest of the room is unaffected
+    """
+    playback = room.playback
+    drift = playback.report(
+        status, publisher.title, position, reported_at,
+        agreed=lambda: reports_agree(room, status, publisher.title))
+    if not playback.needs_correction(drift, publisher.last_correction):
+        return
 
-    if suggest_sync == SyncSuggestion.STATE.value:
-        global current_state
+    publisher.last_correction = time.time()
+    timing = command_timing(room, publishers=[publisher])
+    seek_dst = round(playback.position(timing.get('at')))
+    log.info(f"{publisher.sid} ({publisher.nick}) drifted by {drift:.1f}s, "
+             f"correcting to {seek_dst}")
+    socketio.emit("seek", {"seek": seek_dst, "explicit": False,
+                           "correction": True, **timing},
+                  namespace="/publish", room=publisher.sid)
+
+
+def reports_agree(room, status: PlayerState, title):
+    """Whether all the publishers of the room (on every worker) which play
+    or pause something are in that state, on that title"""
+    reports = {nick: (data['status'], data['title'])
+               for nick, data in room.publishers_snapshot().items()}
+    # ours are fresher than their last publication
+    reports.update((p.nick, (p.status, p.title))
+                   for p in room.publishers.values())
+    comparable = (PlayerState.PLAYING.value, PlayerState.PAUSED.value)
+    return all(report == (status.value, title)
+               for report in reports.values() if report[0] in comparable)
+
+
+def broadcast_sync_suggestion(room, suggestion: Suggestion):
+    """Relay the suggestion which won its window, see server.consensus"""
+    requester_nick = suggestion.nick
+    status = suggestion.status
+    position = suggestion.position
+    timing = command_timing(room)
+    _suggestions_fanout.observe(len(room.publishers) - 1)
+
+    if suggestion.kind == SyncSuggestion.STATE:
         request_str = "Pause"  # default/catch-all
         emit_str = "pause"
 
+        if status in (PlayerState.PLAYING, PlayerState.PAUSED):
+            room.playback.sync_suggested(status, suggestion.title, position,
+                                         suggestion.reported_at)
         if status == PlayerState.PLAYING:
-            current_state = PlayerState.PLAYING
             request_str = "Resume"
             emit_str = "resume"
         if status == PlayerState.PAUSED:
-            current_state = PlayerState.PAUSED
             request_str = "Pause"
             emit_str = "pause"
 
+        room.remember(f'{request_str} requested by "{requester_nick}"')
         socketio.emit(
             "log_message", {
                 "data": f'{request_str} requested by "{requester_nick}"',
-                "state": current_state.value
+                "state": room.current_state.value, **timing,
             },
-            namespace="/subscribe")
-        emit(emit_str, {'explicit': False}, namespace="/publish",
-             broadcast=True, include_self=False)
-
-    elif suggest_sync == SyncSuggestion.SEEK.value:
+            namespace="/subscribe", room=room.id)
+        socketio.emit(emit_str, {'explicit': False, **timing},
+                      namespace="/publish", room=room.id,
+                      skip_sid=suggestion.sid)
+
+    else:  # SyncSuggestion.SEEK
+        if status in (PlayerState.PLAYING, PlayerState.PAUSED):
+            room.playback.sync_suggested(status, suggestion.title, position,
+                                         suggestion.reported_at)
+            # where the requester will be by the time the others seek
+            position = round(room.playback.position(timing.get('at')))
+        room.remember(f'Seek requested by "{requester_nick}"')
         socketio.emit(
             "log_message", {
-                "data": f'Seek requested by "{requester_nick}"',
+                "data": f'Seek requested by "{requester_nick}"', **timing,
             },
-            namespace="/subscribe")
-        emit("seek", {"seek": position, "explicit": False}, namespace="/publish",
-             broadcast=True, include_self=False)
-
-    else:
-        msg = f"Received bad suggest_sync: {suggest_sync}"
-        log.error(msg)
-        emit('log_message', {'data': msg})
-        return False
+            namespace="/subscribe", room=room.id)
+        socketio.emit("seek", {"seek": position, "explicit": False,
+                               **timing},
+                      namespace="/publish", room=room.id,
+                      skip_sid=suggestion.sid)
+    sync_consensus.commanded(room, timing.get('at'))
 
 
 @socketio.on('latency_pong', namespace='/publish')
+@instrumented
 def ping(message):
     try:
-        publishers[request.sid].pong(message['token'])
-    except KeyError:
+        publisher = rooms.room_of(request.sid).publishers[request.sid]
+        token = message['token']
+        # client timestamps, not sent by older clients
+        received_ts = message.get('t1')
+        sent_ts = message.get('t2')
+        if received_ts is not None and sent_ts is not None:
+            received_ts, sent_ts = float(received_ts), float(sent_ts)
+    except (KeyError, TypeError, ValueError):
         emit("log_message", {"data": "Received bad pong", "fatal": True})
+    else:
+        publisher.pong(token, received_ts, sent_ts)
 
 
 @socketio.on("set nick", namespace='/publish')
+@instrumented
 def update_nick(msg):
     log.info("publisher nick change requested")
 
-    old_nick = publishers[request.sid].nick
+    room = rooms.room_of(request.sid)
+    old_nick = room.publishers[request.sid].nick
     try:
         new_nick = msg['new']
     except KeyError:
@@ -229,24 +384,23 @@ def update_nick(msg):
              {"data": f"Your nick is already {new_nick}"})
         return
     else:
-        subscribers_nicks = {z.nick for z in subscribers.values()}
-        other_nicks = subscribers_nicks.union(
-            {z.nick for z in publishers.values()})
-        if new_nick in other_nicks:
+        if not room.claim_nick(new_nick):
             emit("log_message",
                  {"data": f"Nick {new_nick} already exists"})
             return
 
-    publishers[request.sid].nick = new_nick
+    room.release_nick(old_nick)
+    room.publishers[request.sid].nick = new_nick
+    if room.publishers[request.sid].resumable:
+        room.save_session(room.publishers[request.sid])
 
     emit('log_message', {'data': f"nick updated to {new_nick}"},
          broadcast=False)
-    emit('update publishers',
-         {'data': clean_publishers(), 'new': new_nick, 'old': old_nick},
-         namespace='/subscribe', broadcast=True)
+    emit_publisher_patches(room, [room.publisher_renamed(old_nick, new_nick)])
 
 
 @socketio.on("set ua", namespace='/publish')
+@instrumented
 def set_ua(msg):
     log.info("publisher ua change requested")
 
@@ -257,34 +411,84 @@ def set_ua(msg):
              {"data": "obey the API! (missing key 'user_agent')"})
         return
 
-    publishers[request.sid].ua = ua
-    nick = publishers[request.sid].nick
+    room = rooms.room_of(request.sid)
+    publisher = room.publishers[request.sid]
+    publisher.ua = ua
+    # newer clients offer more compact formats for their reports, older
+    # ones don't ask for an acknowledgement and keep sending json
+    publisher.wire_format = wire.negotiate(msg.get('wire_formats', ()))
+    if publisher.resumable:
+        room.save_session(publisher)
 
     emit('log_message', {'data': f"ua set to {ua}"}, broadcast=False)
-    emit('update publishers',
-         {'data': clean_publishers(), 'update': nick, 'show': False},
-         namespace='/subscribe', broadcast=True)
+    publisher_updates.schedule(room, publisher)
+    # partial: newer clients may then only report what changed
+    return {'wire_format': publisher.wire_format, 'partial': True}
 
 
 @socketio.on('disconnect request', namespace='/publish')
+@instrumented
 def disconnect_request():
     log.info('publisher asked for a disconnect, disconnecting...')
-    disconnect()
+    disconnect()  # not a drop: its session isn't held
+
+
+# connections which dropped, rather than were closed by either side: only
+# held for the publishers which can resume them, the others are released
+_RESUMABLE = (socketio.reason.TRANSPORT_CLOSE, socketio.reason.TRANSPORT_ERROR,
+              socketio.reason.PING_TIMEOUT)
 
 
 @socketio.on('disconnect', namespace='/publish')
-def disconnect_publisher():
+@instrumented
+def disconnect_publisher(reason=None):
     try:
-        old_nick = publishers[request.sid].nick
-        publishers[request.sid].remove_timeouts()
-        del publishers[request.sid]
+        room = rooms.room_of(request.sid)
+        publishers = room.publishers
+        publisher = publishers.pop(request.sid)
+        heartbeat.remove(request.sid)
     except KeyError:  # nick was never assigned
         log.info(f'publisher {request.sid} just disconnected without a '
-                 f'nick ever been assigned - total: {len(publishers)}')
+                 f'nick ever been assigned')
     else:
-        log.info(
-            'publisher {} just disconnected - total: {}'.format(
-                request.sid, len(publishers)))
-        emit('update publishers',
-             {'data': clean_publishers(), 'new': None, 'old': old_nick},
-             namespace='/subscribe', broadcast=True)
+        if (publisher.resumable and reason in _RESUMABLE
+                and publisher_sessions.RESUME_GRACE):
+            log.info(f'publisher {request.sid} ({publisher.nick}) lost its '
+                     f'connection ({reason}), holding its session')
+            publisher_sessions.hold(room, publisher, release_publisher)
+        else:
+            log.info(
+                'publisher {} just disconnected - total in {!r}: {}'.format(
+                    request.sid, room.id, len(publishers)))
+            release_publisher(room, publisher)
+    finally:
+        rooms.leave(request.sid)
+        ratelimit.forget(request.sid)
+
+
+def release_publisher(room, publisher):
+    """The publisher is gone for good"""
+    if publisher.resumable:
+        room.forget_session(publisher.resume_token)
+    room.release_nick(publisher.nick)
+    emit_publisher_patches(room, [room.publisher_left(publisher.nick)])
+    rooms.drop_if_empty(room)
+
+
+def restore_sessions(room, sessions):
+    """Hold the publishers of a previous server run (see
+    Room.hold_departed()) for RESUME_GRACE seconds, as if their connection
+    just dropped"""
+    for token, session in sessions.items():
+        publisher = Publisher(sid=None, nick=session['nick'], room=room)
+        publisher.ua = session['ua']
+        publisher.wire_format = session['wire_format']
+        publisher.resumable = True
+        publisher.resume_token = token
+        state = session['state']
+        publisher.status = state.get('status', publisher.status)
+        publisher.title = state.get('title', publisher.title)
+        room.restored(publisher, state)
+        log.info(f"Holding the session of {publisher.nick} in {room.id!r}, "
+                 f"from before the restart")
+        publisher_sessions.hold(room, publisher, release_publisher)
@@ -1,16 +1,21 @@
 import logging
-import random
 
 from flask import request
-from flask_socketio import emit
+from flask_socketio import emit, join_room
 
-from server import socketio, publishers, subscribers
-from server import current_state, PlayerState
-from server import subscribers_nick_presets, subscribers_color_presets
-from server.helpers import clean_publishers, clean_subscribers
+from server import socketio, ratelimit, rooms
+from server import PlayerState
+from server.clock import CommandTiming
+from server.consensus import sync_consensus
+from server.helpers import clean_subscribers, emit_publishers_snapshot
+from server.helpers import command_timing
+from server.metrics import fanout, instrumented
+from server.ratelimit import rate_limited
 
 log = logging.getLogger(__name__)
 
+_commands_fanout = fanout.labels('command')
+
 
 class Subscriber:
     def __init__(self, nick, color):
@@ -25,95 +30,139 @@ class Subscriber:
 
 # subscribe
 @socketio.on('connect', namespace='/subscribe')
+@instrumented
 def connect_subscriber():
-    log.info(f"Connecting subscriber {request.sid}")
-    other_nicks = {z.nick for z in subscribers.values()}.union(
-        {z.nick for z in publishers.values()})
+    room_id = rooms.room_id_from_request(request.args)
+    log.info(f"Connecting subscriber {request.sid} to room {room_id!r}")
+    room = rooms.join(request.sid, room_id)
+    subscribers = room.subscribers
 
     if request.sid in subscribers:
         raise RuntimeError(f"{request.sid} (subscriber) Connected twice.")
 
-    nicks_pool = subscribers_nick_presets
-    for used_nick in other_nicks:
-        try:
-            nicks_pool.remove(used_nick)
-        except ValueError:  # user is using a non-preset nick
-            pass
-
-    colors_pool = subscribers_color_presets
-    for used_color in {z.color for z in subscribers.values()}:
-        try:
-            colors_pool.remove(used_color)
-        except ValueError:  # user is using a non-preset color
-            pass
-
-    if nicks_pool and colors_pool:
-        assigned_nick = random.choice(nicks_pool)
-        assigned_color = random.choice(colors_pool)
+    # the nick it had before a server restart, if any
+    assigned_nick = request.args.get('nick')
+    assigned_color = room.reclaim(assigned_nick)
+    if assigned_color is None:
+        assigned_nick = room.allocate_nick()
+        assigned_color = room.allocate_color() if assigned_nick else None
+    if assigned_nick and assigned_color:
         subscribers[request.sid] = Subscriber(
             nick=assigned_nick, color=assigned_color)
+        room.subscriber_joined(subscribers[request.sid])
     else:
+        if assigned_nick:
+            room.release_nick(assigned_nick)
         log.info("Couldn't assign a nick, disconnecting the subscriber...")
         emit("log_message",
              {"data": "Failed to assign you a nick", "fatal": True})
         return
 
-    log.info("Someone (id={}, nick={}) just subscribed! - total: {}".format(
-        request.sid, assigned_nick, len(subscribers)))
+    join_room(room.id)
+    log.info("Someone (id={}, nick={}) just subscribed to {!r}! - total: {}"
+             .format(request.sid, assigned_nick, room.id, len(subscribers)))
     emit(
         'nick change', {
             'new': assigned_nick, 'old': None,
-            "color": assigned_color, 'complete': clean_subscribers(),
+            "color": assigned_color, 'complete': clean_subscribers(room),
         }, broadcast=False)
     emit('update subscriptions',
-         {'complete': clean_subscribers(), 'new': assigned_nick, 'old': None},
-         broadcast=True, include_self=False)
+         {'complete': clean_subscribers(room), 'new': assigned_nick,
+          'old': None}, room=room.id, include_self=False)
 
-    emit('update publishers',
-         {'data': clean_publishers(), 'state': current_state.value})
+    emit_publishers_snapshot(room, to=request.sid,
+                             state=room.current_state.value)
+    emit_history(room)
     return True
 
 
+def emit_history(room, before=None):
+    entries, more = room.history(before)
+    if entries or before is not None:
+        emit('history', {'entries': entries, 'more': more})
+
+
+@socketio.on("history", namespace='/subscribe')
+@instrumented
+def request_history(msg):
+    """Older history entries, when scrolling back"""
+    room = rooms.room_of(request.sid)
+    try:
+        before = int(msg['before'])
+    except (KeyError, TypeError, ValueError):
+        emit("log_message", {"data": "obey the API! (missing key 'before')"})
+        return
+    emit_history(room, before)
+
+
+@socketio.on("resync publishers", namespace='/subscribe')
+@instrumented
+def resync_publishers(_):
+    """The subscriber missed a patch (version gap), resend everything"""
+    log.info(f"publishers resync requested by {request.sid}")
+    room = rooms.room_of(request.sid)
+    emit_publishers_snapshot(room, to=request.sid)
+
+
 @socketio.on("help", namespace='/subscribe')
+@instrumented
 def display_help(_):
     log.info("help requested")
     emit("log_message", {
         "data": 'Commands are: "/help" "/nick <new_nick>", "/pause", "/resume"'
-                ', "/seek <int>"'})
+                ', "/seek <int>", "/history"'})
 
 
 @socketio.on("pause", namespace='/subscribe')
+@instrumented
+@rate_limited(ratelimit.commands)
 def request_pause(_):
     log.info(f"pause requested by {request.sid}")
-    requester_nick = subscribers[request.sid].nick
-    global current_state
-    current_state = PlayerState.PAUSED
+    room = rooms.room_of(request.sid)
+    requester_nick = room.subscribers[request.sid].nick
+    timing = command_timing(room)
+    room.playback.set_state(PlayerState.PAUSED, timing.get('at'))
+    room.remember(f'Pause requested by "{requester_nick}"')
     emit(
         "log_message", {
             "data": f'Pause requested by "{requester_nick}"',
-            "state": current_state.value
-        }, namespace="/subscribe", broadcast=True, include_self=True)
-    emit("pause", {'explicit': True}, namespace="/publish", broadcast=True)
+            "state": room.current_state.value, **timing,
+        }, namespace="/subscribe", room=room.id, include_self=True)
+    _commands_fanout.observe(len(room.publishers))
+    sync_consensus.commanded(room, timing.get('at'))
+    emit("pause", {'explicit': True, **timing}, namespace="/publish",
+         room=room.id)
 
 
 @socketio.on("resume", namespace='/subscribe')
+@instrumented
+@rate_limited(ratelimit.commands)
 def request_resume(_):
     log.info(f"resume requested by {request.sid}")
-    requester_nick = subscribers[request.sid].nick
-    global current_state
-    current_state = PlayerState.PLAYING
+    room = rooms.room_of(request.sid)
+    requester_nick = room.subscribers[request.sid].nick
+    timing = command_timing(
+        room, countdown=CommandTiming.RESUME_COUNTDOWN)
+    room.playback.set_state(PlayerState.PLAYING, timing.get('at'))
+    room.remember(f'Resume requested by "{requester_nick}"')
     emit(
         "log_message", {
             "data": f'Resume requested by "{requester_nick}"',
-            "state": current_state.value
-        }, namespace="/subscribe", broadcast=True, include_self=True)
-    emit("resume", {'explicit': True}, namespace="/publish", broadcast=True)
+            "state": room.current_state.value, **timing,
+        }, namespace="/subscribe", room=room.id, include_self=True)
+    _commands_fanout.observe(len(room.publishers))
+    sync_consensus.commanded(room, timing.get('at'))
+    emit("resume", {'explicit': True, **timing}, namespace="/publish",
+         room=room.id)
 
 
 @socketio.on("seek", namespace='/subscribe')
+@instrumented
+@rate_limited(ratelimit.commands)
 def request_seek(dst):
     log.info(f"seek requested to {dst} by {request.sid}")
-    requester_nick = subscribers[request.sid].nick
+    room = rooms.room_of(request.sid)
+    requester_nick = room.subscribers[request.sid].nick
     try:
         seek_dst = int(dst['seek'])
     except (KeyError, ValueError):
@@ -122,21 +171,29 @@ def request_seek(dst):
                 dst['seek'])}, namespace="/subscribe")
         return
     else:
+        timing = command_timing(room)
+        room.playback.seek(seek_dst, timing.get('at'))
+        room.remember(f'Seek requested to {seek_dst} by "{requester_nick}"')
         emit("log_message", {
             "data": 'Seek requested to {} by "{}"'.format(seek_dst,
-                                                          requester_nick)},
-             namespace="/subscribe", broadcast=True, include_self=True)
-        emit("seek", {"seek": seek_dst, 'explicit': True},
-             namespace="/publish", broadcast=True)
+                                                          requester_nick),
+            **timing}, namespace="/subscribe", room=room.id, include_self=True)
+        _commands_fanout.observe(len(room.publishers))
+        sync_consensus.commanded(room, timing.get('at'))
+        emit("seek", {"seek": seek_dst, 'explicit': True, **timing},
+             namespace="/publish", room=room.id)
 
 
 @socketio.on("change nick", namespace='/subscribe')
+@instrumented
+@rate_limited(ratelimit.chat)
 def change_nick(msg):
     log.info("subscriber nick change requested")
     # log.info(request.event)
 
-    old_nick = subscribers[request.sid].nick
-    color = subscribers[request.sid].color
+    room = rooms.room_of(request.sid)
+    old_nick = room.subscribers[request.sid].nick
+    color = room.subscribers[request.sid].color
     try:
         new_nick = msg['new']
     except KeyError:
@@ -147,52 +204,65 @@ def change_nick(msg):
              {"data": f'Your nick is already "{new_nick}"'})
         return
     else:
-        other_nicks = {z.nick for z in subscribers.values()}.union(
-            {z.nick for z in publishers.values()})
-        if new_nick in other_nicks:
+        if not room.claim_nick(new_nick):
             emit("log_message",
                  {"data": f"Nick {new_nick} already exists"})
             return
 
-    subscribers[request.sid].nick = new_nick
+    room.release_nick(old_nick)
+    room.subscribers[request.sid].nick = new_nick
+    room.subscriber_renamed(old_nick, room.subscribers[request.sid])
 
     emit('nick change', {'new': new_nick, 'old': old_nick, "color": color,
-                         'complete': clean_subscribers()}, broadcast=False)
+                         'complete': clean_subscribers(room)},
+         broadcast=False)
     emit("update subscriptions",
-         {'complete': clean_subscribers(), 'new': new_nick,
-          'old': old_nick}, broadcast=True, include_self=False)
+         {'complete': clean_subscribers(room), 'new': new_nick,
+          'old': old_nick}, room=room.id, include_self=False)
 
 
 @socketio.on('broadcast message', namespace='/subscribe')
+@instrumented
+@rate_limited(ratelimit.chat)
 def broadcast_message(message):
     """A chat message to other subscribers"""
-    log.info(f"Subscriber broadcasting: {message}")
-    nick = subscribers[request.sid].nick
-    color = subscribers[request.sid].color
+    log.info("Subscriber broadcasting: %s", message)
+    room = rooms.room_of(request.sid)
+    nick = room.subscribers[request.sid].nick
+    color = room.subscribers[request.sid].color
     try:
         content = message['data']
     except KeyError:
         pass
     else:
+        room.remember(content, nick, color)
         emit('log_message', {'data': content, 'nick': nick, 'color': color},
-             broadcast=True, include_self=False)
+             room=room.id, include_self=False)
         return message['data']
 
 
 @socketio.on('disconnect', namespace='/subscribe')
+@instrumented
 def disconnect_subscriber():
     try:
+        room = rooms.room_of(request.sid)
+        subscribers = room.subscribers
         old_nick = subscribers[request.sid].nick
-        del subscribers[request.sid]
+        color = subscribers.pop(request.sid).color
+        room.release_nick(old_nick)
+        room.release_color(color)
+        room.subscriber_left(old_nick)
     except KeyError:  # nick was never assigned
         log.info(
             'subscriber {} just disconnected without a nick having ever been'
-            ' assigned - total: {}'.format(
-                request.sid, len(subscribers)))
+            ' assigned'.format(request.sid))
     else:
         log.info(
-            'subscriber {} just disconnected - total: {}'.format(
-                request.sid, len(subscribers)))
+            'subscriber {} just disconnected - total in {!r}: {}'.format(
+                request.sid, room.id, len(subscribers)))
         emit('update subscriptions',
-             {'complete': clean_subscribers(), 'new': None,
-              'old': old_nick}, broadcast=True)
+             {'complete': clean_subscribers(room), 'new': None,
+              'old': old_nick}, room=room.id)
+    finally:
+        rooms.leave(request.sid)
+        ratelimit.forget(request.sid)
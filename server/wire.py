@@ -0,0 +1,64 @@
+"""Wire formats publishers can send their 'update state' reports in
+
+json is always accepted. Publishers may negotiate msgpack when they set
+their user agent, after which their reports are binary msgpack maps keyed
+by small integers instead of the field names, with the usual player states
+as small integers too.
+
+The tables must match the client's (client/wire.py).
+
+"""
+import logging
+
+try:
+    import msgpack
+except ImportError:  # optional, see server_requirements.txt
+    msgpack = None
+
+log = logging.getLogger(__name__)
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+STATE_FIELDS = (
+    "title", "status", "position", "length", "show", "suggest_sync", "at",
+    "rate",
+)
+STATUSES = ("Playing", "Paused", "Stopped", "Unknown")
+
+
+def negotiate(offered):
+    """The format to use out of the ones a publisher offered, by preference"""
+    if msgpack is not None and MSGPACK in offered:
+        return MSGPACK
+    return JSON
+
+
+def decode_state(data):
+    """'update state' dict from the msgpack bytes sent by a publisher
+
+    Raises ValueError if the data can't be decoded
+    """
+    if msgpack is None:
+        raise ValueError("msgpack isn't installed on the server")
+    try:
+        packed = msgpack.unpackb(data, strict_map_key=False)
+    except Exception as e:
+        raise ValueError(f"Bad msgpack data: {e}") from e
+    if not isinstance(packed, dict):
+        raise ValueError("Bad msgpack data: not a map")
+
+    state = {}
+    for key, value in packed.items():
+        if isinstance(key, int):
+            try:
+                key = STATE_FIELDS[key]
+            except IndexError:
+                continue  # a field from a newer client
+        if key == "status" and isinstance(value, int):
+            try:
+                value = STATUSES[value]
+            except IndexError:
+                value = "Unknown"
+        state[key] = value
+    return state
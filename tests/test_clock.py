@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+from server.clock import ClockEstimator, CommandTiming
+
+
+def exchange(clock, sent, delay_out, delay_back, offset, processing=0.001):
+    """A ping sent at server time 'sent', to a client 'offset' seconds ahead
+    """
+    t0 = sent
+    t1 = t0 + delay_out + offset
+    t2 = t1 + processing
+    t3 = t2 - offset + delay_back
+    return clock.add_sample(t0, t3, t1, t2)
+
+
+def test_offset_and_delay_of_a_symmetric_exchange():
+    clock = ClockEstimator()
+    delay = exchange(clock, 100, 0.05, 0.05, offset=2.5)
+    assert delay == pytest.approx(0.1)
+    assert clock.offset == pytest.approx(2.5)
+    assert clock.srtt == pytest.approx(0.1)
+    assert clock.jitter == pytest.approx(0.05)
+
+
+def test_offset_of_the_lowest_delay_sample_in_the_window():
+    clock = ClockEstimator()
+    exchange(clock, 100, 0.01, 0.01, offset=1.0)
+    # queued on the way out: the offset it suggests is off
+    exchange(clock, 101, 0.4, 0.01, offset=1.0)
+    assert clock.offset == pytest.approx(1.0)
+
+
+def test_best_sample_expires_after_the_window():
+    clock = ClockEstimator()
+    exchange(clock, 100, 0.01, 0.01, offset=1.0)
+    for i in range(ClockEstimator.WINDOW):
+        exchange(clock, 101 + i, 0.1, 0.1, offset=3.0)
+    assert clock.offset == pytest.approx(3.0)
+
+
+def test_round_trip_smoothing():
+    clock = ClockEstimator()
+    clock.add_sample(0, 0.1)
+    clock.add_sample(1, 1.3)
+    assert clock.srtt == pytest.approx(
+        0.1 + ClockEstimator.RTT_ALPHA * (0.3 - 0.1))
+    assert clock.jitter == pytest.approx(
+        0.05 + ClockEstimator.JITTER_BETA * (0.2 - 0.05))
+
+
+def test_older_clients_only_get_a_round_trip():
+    clock = ClockEstimator()
+    assert clock.add_sample(10, 10.2) == pytest.approx(0.2)
+    assert clock.srtt == pytest.approx(0.2)
+    assert clock.offset is None
+
+
+def test_negative_delays_are_clamped():
+    clock = ClockEstimator()
+    assert clock.add_sample(0, 0.01, t1=5.0, t2=5.1) == 0
+
+
+def test_sent_at():
+    clock = ClockEstimator()
+    assert clock.sent_at(50) == 50
+    clock.add_sample(0, 0.4)
+    assert clock.sent_at(50) == pytest.approx(49.8)
+
+
+def test_dict_repr_is_rounded():
+    clock = ClockEstimator()
+    exchange(clock, 100, 0.01234, 0.01234, offset=0.5)
+    assert clock.dict_repr() == {'rtt': 0.025, 'jitter': 0.012,
+                                 'offset': 0.5}
+
+
+@pytest.fixture
+def lead(monkeypatch):
+    monkeypatch.setattr(CommandTiming, 'LEAD', 0.5)
+    monkeypatch.setattr(CommandTiming, 'MAX_LEAD', 5)
+
+
+def lead_of(estimates, countdown=0):
+    before = time.time()
+    at = CommandTiming.execution_time(estimates, countdown)
+    return None if at is None else at - before
+
+
+def test_lead_is_at_least_lead(lead):
+    assert lead_of([]) == pytest.approx(0.5, abs=0.05)
+    assert lead_of([(0.1, 0.01)]) == pytest.approx(0.5, abs=0.05)
+
+
+def test_lead_covers_the_slowest_recipient(lead):
+    # one way delay + twice the jitter
+    assert lead_of([(0.1, 0.01), (2.0, 0.25), (None, None)]) == (
+        pytest.approx(1.5, abs=0.05))
+
+
+def test_lead_is_capped(lead):
+    assert lead_of([(30, 1)]) == pytest.approx(5, abs=0.05)
+
+
+def test_countdown(lead):
+    assert lead_of([(0.1, 0.01)], countdown=3) == pytest.approx(3, abs=0.05)
+
+
+def test_no_lead_means_right_away(monkeypatch):
+    monkeypatch.setattr(CommandTiming, 'LEAD', 0)
+    assert CommandTiming.execution_time([(1, 0.1)]) is None
+    assert CommandTiming.execution_time([(1, 0.1)], countdown=3) is not None
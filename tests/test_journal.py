@@ -0,0 +1,123 @@
+import json
+
+import pytest
+
+from server import helpers
+from server.journal import JournalStore
+
+
+@pytest.fixture(autouse=True)
+def no_background_task(monkeypatch):
+    """The journal is written by a background task of the server, the tests
+    write it themselves (see tick())"""
+    monkeypatch.setattr(helpers, "run_periodically", lambda *args: None)
+
+
+def tick(store):
+    """What the background task does"""
+    write = store._tick()
+    if write is not None:
+        write()
+
+
+def write_snapshot(directory, seq, values):
+    directory.mkdir(exist_ok=True)
+    (directory / "snapshot.json").write_text(json.dumps({
+        'seq': seq, 'values': values, 'sets': {}, 'lists': {},
+        'hashes': {}}))
+
+
+def test_fresh_directory(tmp_path):
+    store = JournalStore(str(tmp_path))
+    assert not store.recovered
+    assert store.get("anything") is None
+
+
+def test_recovers_the_journal(tmp_path):
+    store = JournalStore(str(tmp_path))
+    store.set("playback", {"state": "Paused"})
+    store.sadd("rooms", "a", "b")
+    store.rpush("history", "hello")
+    store.hset("publishers", "alice", {"status": "Playing"})
+    store.incr("version")
+    store.flush()
+
+    recovered = JournalStore(str(tmp_path))
+    assert recovered.recovered
+    assert recovered.get("playback") == {"state": "Paused"}
+    assert recovered.smembers("rooms") == {"a", "b"}
+    assert recovered.lrange("history", 0, -1) == ["hello"]
+    assert recovered.hgetall("publishers") == {
+        "alice": {"status": "Playing"}}
+    assert recovered.get("version") == 1
+
+
+def test_spop_is_recorded_by_its_effect(tmp_path):
+    store = JournalStore(str(tmp_path))
+    store.sadd("free_nicks", "a", "b", "c")
+    popped = store.spop("free_nicks")
+    store.flush()
+
+    recovered = JournalStore(str(tmp_path))
+    assert recovered.smembers("free_nicks") == {"a", "b", "c"} - {popped}
+
+
+def test_torn_last_record_after_a_snapshot(tmp_path):
+    write_snapshot(tmp_path, 2, {"version": 2, "title": "movie"})
+    (tmp_path / "journal.log").write_text(
+        '[2, "set", "version", 2]\n'  # already in the snapshot
+        '[3, "set", "version", 3]\n'
+        '[4, "set", "title", "other movie"]\n'
+        '[5, "set", "version", 5]\n'
+        '[6, "set", "tit')  # never fsynced in full
+
+    store = JournalStore(str(tmp_path))
+    assert store.recovered
+    assert store.get("version") == 5
+    assert store.get("title") == "other movie"
+    assert store._seq == 5
+
+
+def test_records_in_the_snapshot_are_skipped(tmp_path):
+    write_snapshot(tmp_path, 10, {"version": 10})
+    (tmp_path / "journal.log").write_text('[9, "set", "version", 9]\n')
+
+    assert JournalStore(str(tmp_path)).get("version") == 10
+
+
+def test_recovery_starts_a_new_snapshot_and_journal(tmp_path):
+    write_snapshot(tmp_path, 1, {"version": 1})
+    (tmp_path / "journal.log").write_text('[2, "set", "version", 2]\n')
+
+    store = JournalStore(str(tmp_path))
+    snapshot = json.loads((tmp_path / "snapshot.json").read_text())
+    assert (snapshot['seq'], snapshot['values']) == (2, {"version": 2})
+    assert (tmp_path / "journal.log").read_text() == ""
+    # and goes on from there
+    store.set("version", 3)
+    store.flush()
+    assert JournalStore(str(tmp_path)).get("version") == 3
+
+
+def test_tick_writes_the_pending_records(tmp_path):
+    store = JournalStore(str(tmp_path))
+    store.set("version", 1)
+    assert (tmp_path / "journal.log").read_text() == ""
+    tick(store)
+    assert (tmp_path / "journal.log").read_text() == (
+        '[1, "set", "version", 1]\n')
+    assert store._tick() is None  # nothing left to write
+
+
+def test_tick_snapshots_when_due(tmp_path, monkeypatch):
+    monkeypatch.setattr(JournalStore, "SNAPSHOT_INTERVAL", 0)
+    store = JournalStore(str(tmp_path))
+    store.set("version", 1)
+    write = store._tick()
+    store.set("version", 2)  # while the snapshot is being written
+    write()
+    snapshot = json.loads((tmp_path / "snapshot.json").read_text())
+    assert (snapshot['seq'], snapshot['values']) == (1, {"version": 1})
+    assert (tmp_path / "journal.log").read_text() == ""
+    tick(store)
+    assert JournalStore(str(tmp_path)).get("version") == 2
@@ -0,0 +1,157 @@
+import time
+
+import pytest
+
+from server import PlayerState
+from server.playback import PlaybackClock
+
+PLAYING, PAUSED = PlayerState.PLAYING, PlayerState.PAUSED
+
+
+@pytest.fixture
+def changes():
+    return []
+
+
+@pytest.fixture
+def clock(changes):
+    return PlaybackClock(on_change=changes.append)
+
+
+def settled(clock, at):
+    """A time past the settle period of the last anchor, from 'at'"""
+    return at + clock.SETTLE_PERIOD + 0.1
+
+
+def test_unknown_until_the_first_report(clock):
+    assert clock.position() is None
+
+
+def test_first_report_is_the_reference(clock, changes):
+    now = time.time()
+    assert clock.report(PLAYING, "movie", 100, now) is None
+    assert (clock.state, clock.title) == (PLAYING, "movie")
+    assert clock.position(now + 10) == pytest.approx(110)
+    assert len(changes) == 1
+
+
+def test_first_report_must_be_playing_or_paused(clock, changes):
+    assert clock.report(PlayerState.STOPPED, "", 0, time.time()) is None
+    assert clock.position() is None
+    assert not changes
+
+
+def test_extrapolation_follows_the_rate(clock):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    clock.rate = 1.5
+    assert clock.position(now + 10) == pytest.approx(115)
+
+
+def test_paused_clock_stands_still(clock):
+    now = time.time()
+    clock.report(PAUSED, "movie", 100, now)
+    assert clock.position(now + 60) == 100
+
+
+def test_set_state_anchors_at_the_extrapolated_position(clock):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    clock.set_state(PAUSED, now + 10)
+    assert clock.state == PAUSED
+    assert clock.position(now + 100) == pytest.approx(110)
+    clock.set_state(PLAYING, now + 20)
+    assert clock.position(now + 25) == pytest.approx(115)
+
+
+def test_seek(clock, changes):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    clock.seek(500, now + 1)
+    assert clock.position(now + 3) == pytest.approx(502)
+    assert len(changes) == 2
+
+
+def test_report_drift(clock):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    at = settled(clock, now)
+    assert clock.report(PLAYING, "movie", 100 + (at - now) + 4, at) == (
+        pytest.approx(4))
+
+
+def test_no_drift_in_the_settle_period(clock):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    clock.seek(500, now + 1)
+    assert clock.report(PLAYING, "movie", 100, now + 2) is None
+
+
+def test_other_state_or_title_isnt_comparable(clock, changes):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    at = settled(clock, now)
+    assert clock.report(PAUSED, "movie", 103, at) is None
+    assert clock.report(PLAYING, "other movie", 5, at) is None
+    assert clock.state == PLAYING and clock.title == "movie"
+    assert len(changes) == 1
+
+
+def test_reanchored_when_all_reports_agree(clock, changes):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    at = settled(clock, now)
+    assert clock.report(PAUSED, "movie", 103, at, agreed=lambda: False) is (
+        None)
+    assert clock.state == PLAYING
+    assert clock.report(PAUSED, "movie", 103, at, agreed=lambda: True) is (
+        None)
+    assert clock.state == PAUSED
+    assert clock.position(at + 60) == 103
+    assert len(changes) == 2
+
+
+def test_agreement_only_asked_for_a_new_state(clock):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    at = settled(clock, now)
+
+    def agreed():
+        raise AssertionError("the report has the same state")
+
+    clock.report(PLAYING, "movie", 100 + (at - now), at, agreed=agreed)
+    # nor before the players settled
+    clock.seek(10, at)
+    clock.report(PAUSED, "movie", 10, at + 1, agreed=agreed)
+
+
+def test_sync_suggested(clock):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    clock.sync_suggested(PAUSED, "movie", 42, now + 1)
+    assert clock.state == PAUSED
+    assert clock.position(now + 30) == 42
+
+
+def test_needs_correction(clock):
+    threshold = clock.DRIFT_THRESHOLD
+    assert not clock.needs_correction(None, 0)
+    assert not clock.needs_correction(threshold - 0.1, 0)
+    assert clock.needs_correction(-threshold - 0.1, 0)
+    # not again during the cooldown
+    assert not clock.needs_correction(threshold + 1, time.time() - 1)
+
+
+def test_round_trip_through_the_store(clock):
+    now = time.time()
+    clock.report(PLAYING, "movie", 100, now)
+    clock.rate = 2.0
+    copy = PlaybackClock.from_dict(clock.dict_repr())
+    assert copy.dict_repr() == clock.dict_repr()
+    assert copy.position(now + 5) == pytest.approx(110)
+
+
+def test_from_nothing():
+    clock = PlaybackClock.from_dict(None)
+    assert clock.state == PAUSED
+    assert clock.position() is None
@@ -0,0 +1,92 @@
+import types
+
+import pytest
+
+from server import ratelimit
+from server.ratelimit import RateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setattr(ratelimit, "limiters", [])
+    return RateLimiter("test", rate=1, room_rate=3)
+
+
+def room():
+    return types.SimpleNamespace(rate_buckets={})
+
+
+def takes(bucket, count):
+    return sum(bucket.take() for _ in range(count))
+
+
+def test_bucket_starts_full(clock):
+    bucket = TokenBucket(rate=2, capacity=5)
+    assert takes(bucket, 10) == 5
+
+
+def test_bucket_refills_at_its_rate(clock):
+    bucket = TokenBucket(rate=2, capacity=5)
+    takes(bucket, 5)
+    clock.now += 0.4
+    assert not bucket.take()  # 0.8 token
+    clock.now += 0.1
+    assert bucket.take()
+    clock.now += 1.5
+    assert takes(bucket, 5) == 3
+
+
+def test_bucket_refills_up_to_its_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=5)
+    takes(bucket, 5)
+    clock.now += 3600
+    assert takes(bucket, 10) == 5
+
+
+def test_client_burst_then_rate(clock, limiter):
+    the_room = room()
+    burst = limiter.rate * limiter.BURST_WINDOW
+    assert sum(limiter.allow("a", the_room) for _ in range(burst + 5)) == (
+        burst)
+    clock.now += 1
+    assert limiter.allow("a", the_room)
+    assert not limiter.allow("a", the_room)
+
+
+def test_room_limit_is_shared_by_its_clients(clock, limiter):
+    the_room, other_room = room(), room()
+    burst = limiter.room_rate * limiter.BURST_WINDOW
+    allowed = sum(limiter.allow(f"client{i}", the_room)
+                  for i in range(burst + 5))
+    assert allowed == burst
+    assert limiter.allow("someone else", other_room)
+
+
+def test_no_limit(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit, "limiters", [])
+    unlimited = RateLimiter("test", rate=0, room_rate=0)
+    the_room = room()
+    assert all(unlimited.allow("a", the_room) for _ in range(1000))
+
+
+def test_forget_drops_the_client_bucket(clock, limiter):
+    the_room = room()
+    while limiter.allow("a", the_room):
+        pass
+    ratelimit.forget("a")
+    assert limiter.allow("a", the_room)
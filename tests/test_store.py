@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from server import helpers
+from server.journal import JournalStore
+from server.store import FileStore, MemoryStore, RedisStore, open_store
+
+
+@pytest.fixture(params=["memory", "file", "journal", "redis"])
+def store(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        return MemoryStore()
+    if request.param == "file":
+        return FileStore(str(tmp_path / "store.json"))
+    if request.param == "journal":
+        # the journal is written by a background task of the server
+        monkeypatch.setattr(helpers, "run_periodically", lambda *args: None)
+        return JournalStore(str(tmp_path / "journal"))
+    # a database the tests may empty, e.g. redis://localhost:6379/15
+    url = os.environ.get("REDIS_URL")
+    if not url:
+        pytest.skip("REDIS_URL isn't set")
+    pytest.importorskip("redis")
+    store = RedisStore(url)
+    store._redis.flushdb()
+    return store
+
+
+def test_values(store):
+    assert store.get("missing") is None
+    assert store.get("missing", 0) == 0
+    store.set("playback", {"state": "Playing", "anchor": 1.5})
+    assert store.get("playback") == {"state": "Playing", "anchor": 1.5}
+
+
+def test_incr(store):
+    assert store.incr("version") == 1
+    assert store.incr("version") == 2
+    assert store.get("version") == 2
+
+
+def test_sets(store):
+    assert store.sadd("nicks", "a", "b") == 2
+    assert store.sadd("nicks", "b", "c") == 1
+    store.srem("nicks", "a")
+    store.srem("nicks", "missing")
+    assert store.smembers("nicks") == {"b", "c"}
+    popped = {store.spop("nicks"), store.spop("nicks")}
+    assert popped == {"b", "c"}
+    assert store.spop("nicks") is None
+    assert store.smembers("missing") == set()
+
+
+def test_lists(store):
+    for i in range(5):
+        assert store.rpush("history", {"id": i}) == i + 1
+    assert store.lrange("history", 0, -1) == [{"id": i} for i in range(5)]
+    assert store.lrange("history", -2, -1) == [{"id": 3}, {"id": 4}]
+    assert store.lrange("history", 0, 1) == [{"id": 0}, {"id": 1}]
+    store.ltrim("history", -3, -1)
+    assert store.lrange("history", 0, -1) == [{"id": i} for i in (2, 3, 4)]
+    assert store.lrange("missing", 0, -1) == []
+
+
+def test_hashes(store):
+    store.hset("publishers", "alice", {"status": "Playing"})
+    store.hset("publishers", "bob", {"status": "Paused"})
+    store.hset("publishers", "alice", {"status": "Paused"})
+    store.hdel("publishers", "bob")
+    store.hdel("publishers", "missing")
+    assert store.hgetall("publishers") == {"alice": {"status": "Paused"}}
+    assert store.hgetall("missing") == {}
+
+
+def test_delete_any_kind(store):
+    store.set("value", 1)
+    store.sadd("set", "a")
+    store.rpush("list", 1)
+    store.hset("hash", "field", 1)
+    store.delete("value", "set", "list", "hash", "missing")
+    assert store.get("value") is None
+    assert store.smembers("set") == set()
+    assert store.lrange("list", 0, -1) == []
+    assert store.hgetall("hash") == {}
+
+
+def test_file_stores_share_their_state(tmp_path):
+    path = str(tmp_path / "store.json")
+    first, second = FileStore(path), FileStore(path)
+    first.sadd("nicks", "alice")
+    assert not second.sadd("nicks", "alice")
+    assert second.incr("version") == 1
+    assert first.incr("version") == 2
+
+
+def test_open_store(tmp_path):
+    assert isinstance(open_store("memory"), MemoryStore)
+    assert isinstance(open_store(f"file://{tmp_path}/store.json"), FileStore)
+    with pytest.raises(ValueError):
+        open_store("ftp://somewhere")